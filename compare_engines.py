@@ -0,0 +1,98 @@
+#!/usr/bin/python3.7
+"""
+Script to compare the speed and accuracy of different analysis
+configurations ("engines") on the same synthetic scans, so the trade-off can
+be chosen for each station.
+
+The engines are read from a JSON file of the form:
+    {"full": {},
+     "coarse": {"settings": {"model_res": 0.05}}}
+where "settings" override the station settings and "common" overrides the
+analysis common. The first engine is the reference.
+
+Example:
+    python3 compare_engines.py --scans 10 --engines engines.json
+"""
+
+import os
+import json
+import argparse
+import logging
+import pandas as pd
+
+from openso2.program_setup import read_settings
+from openso2.benchmark import prepare_dataset, compare_engines, append_history
+
+# Engines compared if no file is given
+DEFAULT_ENGINES = {'full':      {},
+                   'res_0.02':  {'settings': {'model_res': 0.02}},
+                   'res_0.05':  {'settings': {'model_res': 0.05}},
+                   'tiered':    {'settings': {'tiered_fit': True}},
+                   'shared_cal': {'settings': {'shared_calibration': True}},
+                   'prealign':  {'settings': {'prealign': 'scan'}},
+                   'varpro':    {'settings': {'fit_solver': 'varpro'}},
+                   'least_squares': {'settings': {'fit_solver':
+                                                  'least_squares'}}}
+
+#==============================================================================
+#============================== Parse arguments ===============================
+#==============================================================================
+
+parser = argparse.ArgumentParser(description='Compare Open SO2 analysis '
+                                             + 'configurations')
+parser.add_argument('--engines', default=None,
+                    help='JSON file of the engines to compare')
+parser.add_argument('--scans', type=int, default=10,
+                    help='Number of scans to analyse')
+parser.add_argument('--data', default='Synthetic/benchmark/',
+                    help='Folder of the synthetic dataset, generated if '
+                         + 'missing')
+parser.add_argument('--settings', default='data_bases/station_settings.txt',
+                    help='Station settings file')
+parser.add_argument('--out', default='Results/engine_comparison/',
+                    help='Folder to save the comparison to')
+parser.add_argument('--history', default=None,
+                    help='Benchmark history file to add the results to')
+
+#==============================================================================
+#=========================== Begin the main program ===========================
+#==============================================================================
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+
+    settings = read_settings(args.settings)
+
+    # Read the engines
+    if args.engines is not None:
+        with open(args.engines, 'r') as r:
+            engines = json.load(r)
+    else:
+        engines = DEFAULT_ENGINES
+
+    # Get the dataset
+    scan_paths, so2_truth, flux_truth = prepare_dataset(args.data, settings,
+                                                        args.scans)
+
+    # Run the comparison
+    summary, spectra, fluxes, records = compare_engines(scan_paths, settings,
+                                                        engines, so2_truth,
+                                                        flux_truth)
+
+    # Report and save
+    with pd.option_context('display.width', 200,
+                           'display.max_columns', None):
+        print(summary.T)
+
+    os.makedirs(args.out, exist_ok=True)
+    summary.to_csv(f'{args.out}summary.csv')
+    spectra.to_csv(f'{args.out}spectra.csv')
+    fluxes.to_csv(f'{args.out}fluxes.csv')
+
+    if args.history is not None:
+        for record in records.values():
+            append_history(args.history, record)
@@ -0,0 +1,73 @@
+#!/usr/bin/python3.7
+"""
+Script to generate a synthetic dataset of scans, with the true SO2 columns and
+fluxes, for benchmarking and testing the analysis.
+
+Example:
+    python3 generate_dataset.py 2019-07-01 --days 2 --out Synthetic/
+"""
+
+import argparse
+import datetime
+import logging
+
+from openso2.program_setup import read_settings
+from openso2.synthetic import generate_dataset
+
+#==============================================================================
+#============================== Parse arguments ===============================
+#==============================================================================
+
+parser = argparse.ArgumentParser(description='Generate synthetic Open SO2 '
+                                             + 'scans')
+parser.add_argument('start_date', help='First day to generate (yyyy-mm-dd)')
+parser.add_argument('--days', type=int, default=1,
+                    help='Number of days to generate')
+parser.add_argument('--out', default='Synthetic/',
+                    help='Folder to write the dataset to')
+parser.add_argument('--settings', default='data_bases/station_settings.txt',
+                    help='Station settings file')
+parser.add_argument('--interval', type=float, default=300,
+                    help='Time between scans (s)')
+parser.add_argument('--start_hour', type=float, default=None,
+                    help='Hour to start scanning. Defaults to the settings')
+parser.add_argument('--stop_hour', type=float, default=None,
+                    help='Hour to stop scanning. Defaults to the settings')
+parser.add_argument('--windspeed', type=float, default=10.0,
+                    help='Mean wind speed (m/s)')
+parser.add_argument('--plume_az', type=float, default=260.0,
+                    help='Plume azimuth (degrees from North)')
+parser.add_argument('--plume_height', type=float, default=915.0,
+                    help='Plume height (m)')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Seed for the noise')
+parser.add_argument('--catalog', default=None,
+                    help='Scan catalog in which to record the scans')
+
+#==============================================================================
+#=========================== Begin the main program ===========================
+#==============================================================================
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+
+    # Read in the station settings
+    settings = read_settings(args.settings)
+
+    scan_paths = generate_dataset(args.out, settings,
+                                  datetime.date.fromisoformat(args.start_date),
+                                  n_days=args.days,
+                                  scan_interval=args.interval,
+                                  start_hour=args.start_hour,
+                                  stop_hour=args.stop_hour,
+                                  windspeed=args.windspeed,
+                                  plume_az=args.plume_az,
+                                  plume_height=args.plume_height,
+                                  seed=args.seed,
+                                  catalog_path=args.catalog)
+
+    logging.info(f'Generated {len(scan_paths)} scans in {args.out}')
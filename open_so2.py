@@ -13,7 +13,6 @@ from tkinter import ttk
 import tkinter as tk
 import traceback
 import datetime as dt
-import pandas as pd
 import tkinter.scrolledtext as tkst
 import tkinter.messagebox as tkMessageBox
 from multiprocessing import Process, Queue
@@ -23,9 +22,11 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolb
 
 from openso2.program_setup import get_station_info, update_resfp
 from openso2.station_com import Station, sync_psudostation, get_station_status
-from openso2.analyse_scan import calc_plume_height, get_wind
+from openso2.analyse_scan import calc_plume_height, get_wind, \
+                                 read_so2_results, FLUX_COLUMNS
 from openso2.calc_scan_flux import calc_scan_flux, get_station_data
 from openso2.julian_time import hms_to_julian
+from openso2.catalog import open_catalog
 from openso2.gui_funcs import update_graph, make_input
 
 # Define some fonts to use in the program
@@ -110,6 +111,10 @@ class mygui(tk.Tk):
         self.heights = []
         self.speeds  = []
 
+        # Create holder for the catalog of synced files
+        self.catalog = None
+        self.indexed = []
+
         # Populate the flux dictionaries with arrays for each staiton
         for station in self.station_info.keys():
             self.times[station]   = []
@@ -407,6 +412,12 @@ class mygui(tk.Tk):
                 axes  = [self.ax0]
                 update_graph(lines, axes, self.canvas, data)
 
+        # Open the catalog of synced files
+        catalog_path = self.res_fpath.get() + 'catalog.db'
+        if self.catalog is None or self.catalog.db_path != catalog_path:
+            self.catalog = open_catalog(catalog_path)
+            self.indexed = []
+
         # Create dictinary to hold the file paths
         self.so2_fpaths  = {}
         self.spec_fpaths = {}
@@ -425,6 +436,13 @@ class mygui(tk.Tk):
             os.makedirs(self.so2_fpaths[station],  exist_ok = True)
             os.makedirs(self.spec_fpaths[station], exist_ok = True)
 
+            # Catalog any files already in the folders
+            for folder, kind in [[self.so2_fpaths[station], 'so2'],
+                                 [self.spec_fpaths[station], 'spectra']]:
+                if self.catalog is not None and folder not in self.indexed:
+                    self.catalog.index_folder(folder, kind, status='synced')
+                    self.indexed.append(folder)
+
             # Create the results file if it doesn't exist
             if not Path(self.flux_fpaths[station]).is_file():
 
@@ -465,7 +483,7 @@ class mygui(tk.Tk):
             logging.info(f'Syncing {station} station')
             p = Process(target = sync_psudostation,
                         args = (self.stat_com[station], local_dir, remote_dir,
-                                self.q))
+                                self.q, self.catalog))
             p.start()
 
         # Begin the function to check on the process progress
@@ -536,7 +554,7 @@ class mygui(tk.Tk):
                         scan_time = hms_to_julian(scan_ts)
 
                         # Get the scan data
-                        df = pd.read_parquet(fpath)
+                        df = read_so2_results(fpath, FLUX_COLUMNS)
 
                         if df['so2'][0] == None:
                             wind_speed = np.nan
@@ -3,13 +3,22 @@
 Contains functions to read and analyse raw scan files and processed SO2 files.
 """
 
+import os
+import time
+import sqlite3
 import logging
 import numpy as np
 import pandas as pd
 import datetime as dt
+from multiprocessing import Pool, current_process
 from math import radians, cos, tan, pi
 
-from openso2.fit import fit_spec
+from openso2.fit import fit_spec, quick_fit, triage_spectra, prealign, \
+                        clear_sky_fit, PARAM_NAMES
+from openso2.catalog import open_catalog, parse_scan_fname
+from openso2.clear_sky import ClearSkyLibrary
+from openso2.shared_refs import attach_common
+from openso2.exposure import snap_int_time
 
 #==============================================================================
 #================================= Read Scan ==================================
@@ -51,17 +60,48 @@ def read_scan(fpath):
         # Read in the numpy file
         data = np.load(fpath)
 
-        # Create empty arrays to hold the spectra
-        w, h = data.shape
-        info = np.zeros((w, 7))
-        spec = np.zeros((w, h - 7))
+        return unpack_scan(data, fpath)
+
+    except Exception:
+        return 1, 0, 0, 0
+
+#==============================================================================
+#================================ Unpack Scan =================================
+#==============================================================================
+
+def unpack_scan(data, fpath):
 
-        # Unpack the data
-        for n, line in enumerate(data):
+    '''
+    Function to unpack a scan array in the Open SO2 format, as read from a scan
+    file or handed over in memory by the acquisition. When the scan is already
+    held as floats the info and spectra are returned as views, not copies.
+
+    **Parameters:**
+
+    data : array
+        The scan data, with the spectrum info followed by the spectrum on each
+        row
 
-            # Split the spectrum from the spectrum info
-            info[n] = data[n][:7]
-            spec[n] = data[n][7:]
+    fpath : str
+        File path (or name) of the scan, used to get the station details
+
+    **Returns:**
+
+    err, wavelength, info, spec
+        As for read_scan
+    '''
+
+    try:
+
+        # Drop any unused rows of a buffer slot, which have no integration
+        #  time
+        w, h = data.shape
+        if w > 1 and np.any(data[1:, 6] == 0):
+            data = data[np.append(True, data[1:, 6] != 0)]
+
+        # Split the spectrum info from the spectra
+        info = np.asarray(data[:, :7], dtype = float)
+        spec = np.asarray(data[:, 7:], dtype = float)
 
         # Get the station data
         scanner, spec_name, intercept, c1, c2, c3 = get_spec_details(fpath)
@@ -77,6 +117,39 @@ def read_scan(fpath):
     except Exception:
         return 1, 0, 0, 0
 
+#==============================================================================
+#============================== Split Scan Darks ==============================
+#==============================================================================
+
+def split_scan_darks(info, spec):
+
+    '''
+    Function to separate the extra darks saved at the end of a scan, one for
+    each integration time used other than that of the scan dark, from the
+    spectra. These rows have a spec_n of -1.
+
+    **Parameters:**
+
+    info : array
+        Acquisition info for each row of the scan
+
+    spec : array
+        The spectrum of each row of the scan
+
+    **Returns:**
+
+    info, spec : array
+        The info and spectra without the extra darks
+
+    darks : dict
+        The extra dark spectra keyed by their integration time (ms)
+    '''
+
+    is_dark = info[:, 0] < 0
+    darks = {float(i[6]): s for i, s in zip(info[is_dark], spec[is_dark])}
+
+    return info[~is_dark], spec[~is_dark], darks
+
 #==============================================================================
 #================================ Analyse Scan ================================
 #==============================================================================
@@ -100,7 +173,55 @@ def analyse_scan(scan_path, save_results = True, save_path = None, **common):
         parent folder
 
     common : dict
-        Common dictionary of keyword parameters used by the program
+        Common dictionary of keyword parameters used by the program. If it
+        holds a "scan_buffer" and "scan_slot" the scan is taken from the
+        buffer instead of being read from scan_path. If it holds a
+        "dark_library" the darks for spectra measured at a different
+        integration time to the scan dark, and not saved with the scan, are
+        taken from the library. Spectra without a dark are given a
+        fit_quality of 0. If it holds a "scan_noise" array, from
+        acquire_scan, the noise of each spectrum is added to the results
+
+    The time, number of forward model evaluations, final cost and stopping
+    reason of each fit are added to the results, along with whether the fit
+    was started from the previous spectrum. These are summarised for the scan
+    by summarise_fits, which is logged, held in the attrs of the results and
+    added to "fit_metrics.csv" in the results folder.
+
+    If common holds an "analysis_deadline", a time.time() by which the scan
+    should be analysed, each fit is given a share of the time left. If the
+    analysis falls behind the remaining fits use the cheaper fit_maxfev_behind
+    and fit_tol_behind settings. Fits stopped by their budget keep the best
+    parameters found, with nan errors, and are flagged in the budget_limited
+    column rather than given a fit_quality of 0.
+
+    The spectra are fitted in fit_segments (default analysis_workers) angular
+    segments, each warm started along itself from the first guess, so that
+    with analysis_workers greater than 1 the segments are fitted concurrently
+    in a pool of processes with the same results as when fitted in turn. If
+    common holds "worker_slots", a semaphore shared by the analyses running
+    at once, each pool process takes a slot, bounding the processes started.
+    The pool is not used when the analysis already runs in a pool worker.
+
+    If common holds "tiered_fit" as True the scan is first screened with
+    quick_fit. Only spectra chosen by triage_spectra get the full fit, the
+    rest keep their quick fit result with a fit_status of "quick".
+
+    If common holds "prealign" as "scan" or "spectrum" the first guess shift
+    and stretch are estimated by cross-correlation with prealign, from the
+    mean of the scan or for each spectrum. The estimate for a spectrum is used
+    when it cannot be started from the fit of the spectrum before.
+
+    If common holds "reference_mode" as "clear_sky" the spectra are fitted
+    with clear_sky_fit against a measured plume free spectrum, chosen by
+    find_clear_sky_refs, with a fit_status of "clear_sky". The amounts held
+    in the reference, from a quick fit of it, are added to the results.
+    Spectra without a reference get the full fit.
+
+    If common holds "shared_calibration" as True the shift and stretch are
+    fitted once for the scan by calibrate_scan and held fixed for the other
+    fits. The calibration is held in the attrs of the results and added to
+    "calibration.csv" in the results folder.
 
     **Returns:**
 
@@ -110,19 +231,44 @@ def analyse_scan(scan_path, save_results = True, save_path = None, **common):
     Written by Ben Esse, January 2019
     '''
 
-    # Read in the scan data
-    err, x, info_block, spec_block = read_scan(scan_path)
+    # Attach to the reference arrays if they are held in shared memory
+    common = attach_common(common)
 
-    # Set the column names for the output file
-    columns = ['time', 'motor_pos', 'angle', 'int_time', 'coads', 'w_lo',
-               'w_hi', 'spec_max_int', 'fit_max_int', 'fit_quality', 'p0',
-               'p0_e', 'p1', 'p1_e', 'p2', 'p2_e', 'p3', 'p3_e', 'shift',
-               'shift_e', 'stretch', 'stretch_e', 'ring', 'ring_e', 'so2',
-               'so2_e', 'no2', 'no2_e', 'o3', 'o3_e']
+    # Check if the scan was handed over in memory
+    buffer = common.pop('scan_buffer', None)
+    slot = common.pop('scan_slot', None)
 
-    # Initialise the dataframe
-    df = pd.DataFrame(index = np.arange(spec_block.shape[0]-1),
-                      columns=columns)
+    try:
+        return _analyse_scan(scan_path, save_results, save_path, buffer, slot,
+                             common)
+
+    # Free the buffer slot once the analysis is finished with it
+    finally:
+        if buffer is not None and slot is not None:
+            buffer.release(slot)
+
+def _analyse_scan(scan_path, save_results, save_path, buffer, slot, common):
+
+    '''Analyse the scan, see analyse_scan'''
+
+    # Read in the scan data, from the buffer if it is held there
+    if buffer is not None and slot is not None:
+        err, x, info_block, spec_block = unpack_scan(buffer.array(slot),
+                                                     scan_path)
+    else:
+        err, x, info_block, spec_block = read_scan(scan_path)
+
+    # Set the column names for the output file,
+    #  with a value and error for each fit parameter
+    param_names = common.get('param_names', PARAM_NAMES)
+    so2_i = param_names.index('so2')
+    columns = ['time', 'motor_pos', 'angle', 'int_time', 'coads',
+               'spec_noise', 'w_lo', 'w_hi', 'spec_max_int', 'fit_max_int',
+               'fit_quality']
+    for name in param_names:
+        columns += [name, f'{name}_e']
+    columns += ['fit_time', 'nfev', 'fit_cost', 'fit_status', 'warm_start',
+                'budget_limited']
 
     # Logthe start of the scan
     logging.info(f'Start scan {common["scan_no"]} analysis')
@@ -130,73 +276,204 @@ def analyse_scan(scan_path, save_results = True, save_path = None, **common):
     # Check for read error
     if err == 0:
 
+        # Separate the darks saved for the other integration times
+        info_block, spec_block, scan_darks = split_scan_darks(info_block,
+                                                              spec_block)
+
+        # Initialise the dataframe
+        df = pd.DataFrame(index = np.arange(spec_block.shape[0]-1),
+                          columns=columns)
+
         # Find fit region
         common['idx'] = np.where(np.logical_and(common['wave_start'] <= x,
                                                 x <= common['wave_stop']))
         grid = x[common['idx']]
 
         # Extract the dark spectrum
-        common['dark'] = spec_block[0]
-
-        for n in range(1, spec_block.shape[0]):
-
-            # Extract spectrum info
-            info = info_block[n]
-            n_aq, h, m, s, motor_pos, int_time, coadds = info
-
-            # Convert motor position to angle
-            angle = float(motor_pos) / common['steps_per_degree']
-
-            # Subtract the home offset
-            angle -= common['home_offset']
-
-            # Convert time to decimal hours
-            start_time = dt.time(int(h), int(m), int(s))
-
-            # Extract spectrum
-            y = spec_block[n]
-
-            # Fit the spectrum
-            popt, perr, fitted_flag = fit_spec(common, [x, y], grid)
-
-            # Make the fit quality flag
-            if max(y[common['idx']]) > 50000:
-                fit_quality = 0
-            #elif max(y[common['idx']]) < 4000:
-            #    fit_quality = 0
-            elif not fitted_flag:
-                fit_quality = 0
-            elif popt[7] < -2.463e17:
-                fit_quality = 0
+        scan_dark = spec_block[0]
+        dark_int_time = info_block[0][6]
+        dark_library = common.get('dark_library')
+
+        # Find the time of the scan, to check the library darks are fresh
+        try:
+            scan_time = parse_scan_fname(scan_path)['timestamp'].timestamp()
+        except (ValueError, IndexError):
+            scan_time = None
+
+        # Find the dark for each spectrum. Spectra measured at a different
+        #  integration time to the scan dark use the dark saved with the scan
+        #  for their integration time, or else a library dark. If neither is
+        #  found the scan dark is used and the spectrum is flagged
+        darks = [scan_dark]
+        no_dark = np.full(spec_block.shape[0], False)
+        for n, int_time in enumerate(info_block[1:, 6], start=1):
+            dark = None
+            if int_time != dark_int_time:
+                dark = scan_darks.get(float(int_time))
+                if dark is None and dark_library is not None:
+                    dark = dark_library.get(int_time, now=scan_time)
+                no_dark[n] = dark is None
+            darks.append(scan_dark if dark is None else dark)
+        if no_dark.any():
+            logging.warning(f'Scan {common["scan_no"]} has no dark for '
+                            + f'{no_dark.sum()} spectra at other integration '
+                            + 'times, these are flagged as bad')
+
+        # Correct the spectra for the dark and flat for the quick fit and
+        #  pre-alignment
+        n_specs = spec_block.shape[0] - 1
+        tiered_fit = common.get('tiered_fit', False)
+        shared_calibration = common.get('shared_calibration', False)
+        prealign_mode = common.get('prealign', 'none')
+        clear_sky = common.get('reference_mode', 'solar') == 'clear_sky'
+        if tiered_fit or shared_calibration or prealign_mode != 'none' \
+                or clear_sky:
+            spectra = np.array([np.subtract(spec_block[n], darks[n])
+                                [common['idx']] for n in range(1, n_specs+1)])
+            spectra = np.divide(spectra, common['flat'])
+
+        # Estimate the shift and stretch by cross-correlation, either once
+        #  from the scan mean or for every spectrum
+        prealigned = None
+        if prealign_mode == 'scan':
+            shift, stretch = prealign(common, spectra.mean(axis=0), grid)
+            common['params'] = np.array(common['params'], dtype=float)
+            common['params'][4:6] = shift[0], stretch[0]
+        elif prealign_mode == 'spectrum':
+            prealigned = np.column_stack(prealign(common, spectra, grid))
+
+        # Fit the shift and stretch once for the scan and hold them fixed
+        calibration = None
+        if shared_calibration:
+            calibration = calibrate_scan(common, x, spec_block, darks,
+                                         spectra, grid)
+
+        # Screen the scan with a quick fit, so that only the spectra in or
+        #  near the plume, or poorly fitted, get the full fit. Spectra that
+        #  are not fully fitted keep the linear fit result
+        full_fit = np.full(n_specs, True)
+        if tiered_fit or clear_sky:
+            t0 = time.perf_counter()
+            quick_amts, quick_errs, quick_resid = quick_fit(common, spectra,
+                                                            grid)
+            lin_amts, lin_errs = quick_amts, quick_errs
+            lin_time = (time.perf_counter() - t0) / n_specs
+            lin_status = np.full(n_specs, 'quick', dtype=object)
+        if tiered_fit:
+            full_fit = triage_spectra(quick_amts[:, so2_i-6],
+                                      quick_resid, common)
+            full_fit |= spectra.max(axis=1) <= 3000
+            logging.info(f'Scan {common["scan_no"]} quick fit, '
+                         + f'{full_fit.sum()} of {n_specs} spectra need the '
+                         + 'full fit')
+
+        # Fit against a measured clear sky reference, leaving spectra without
+        #  one to the other fits
+        clear_sky_ref = None
+        if clear_sky:
+            t0 = time.perf_counter()
+            ref_idx, references, clear_sky_ref = find_clear_sky_refs(
+                common, scan_path, info_block, spec_block, spectra,
+                quick_amts[:, so2_i-6])
+            c_amts, c_errs, c_resid = clear_sky_fit(common, spectra, grid,
+                                                    references, ref_idx)
+
+            # Add the amounts in the references, so the results are on the
+            #  same scale as the solar fits
+            if len(references) > 0:
+                ref_amts, ref_errs, ref_resid = quick_fit(common, references,
+                                                          grid)
+                c_amts += ref_amts[ref_idx]
+                c_errs = np.sqrt(c_errs**2 + ref_errs[ref_idx]**2)
+            has_ref = np.logical_and(np.isfinite(c_amts[:, so2_i-6]),
+                                     spectra.max(axis=1) > 3000)
+            lin_amts = np.where(has_ref[:, None], c_amts, lin_amts)
+            lin_errs = np.where(has_ref[:, None], c_errs, lin_errs)
+            lin_status[has_ref] = 'clear_sky'
+            full_fit &= ~has_ref
+            lin_time += (time.perf_counter() - t0) / n_specs
+            logging.info(f'Scan {common["scan_no"]} clear sky fit, '
+                         + f'{has_ref.sum()} of {n_specs} spectra fitted, '
+                         + f'reference from {clear_sky_ref}')
+
+        # Get the noise of each spectrum, if recorded by the acquisition
+        scan_noise = common.pop('scan_noise', None)
+        if scan_noise is None or len(scan_noise) != spec_block.shape[0]:
+            scan_noise = np.full(spec_block.shape[0], np.nan)
+
+        # Split the scan into angular segments. Each segment warm starts
+        #  along itself from the scan first guess, so the segments give the
+        #  same results whether fitted one after another or concurrently
+        n_workers = int(common.get('analysis_workers', 1))
+        n_segments = max(int(common.get('fit_segments', n_workers)), 1)
+        segments = [ns for ns in np.array_split(
+                        np.arange(1, spec_block.shape[0]), n_segments)
+                    if len(ns) > 0]
+        workers = min(n_workers, len(segments))
+
+        # Worker processes cannot start their own pool
+        if workers > 1 and current_process().daemon:
+            workers = 1
+
+        # Hold the scan data used by the segment fits
+        scan = {'x': x, 'grid': grid, 'info_block': info_block,
+                'spec_block': spec_block, 'darks': darks,
+                'scan_noise': scan_noise, 'full_fit': full_fit,
+                'no_dark': no_dark,
+                'prealigned': prealigned, 'so2_i': so2_i,
+                'deadline': common.get('analysis_deadline')}
+        if tiered_fit or clear_sky:
+            scan.update(lin_amts=lin_amts, lin_errs=lin_errs,
+                        lin_time=lin_time, lin_status=lin_status)
+
+        # Take a slot for each pool process from those shared by the
+        #  analyses running at once, fitting in turn if there are too few
+        slots = common.get('worker_slots')
+        taken = 0
+        if workers > 1 and slots is not None:
+            while taken < workers and slots.acquire(block=False):
+                taken += 1
+            workers = taken if taken > 1 else 1
+
+        # Fit the segments, giving each pool process a contiguous chunk of
+        #  them. The pool processes are handed only the fit settings and the
+        #  scan data when they start
+        try:
+            if workers > 1:
+                chunks = [[segments[j] for j in js] for js in
+                          np.array_split(np.arange(len(segments)), workers)]
+                fit_common = {key: val for key, val in common.items()
+                              if key not in _POOL_SKIP}
+                with Pool(workers, initializer=_init_fit_pool,
+                          initargs=[fit_common, scan]) as pool:
+                    results = pool.map(_fit_chunk, chunks)
             else:
-                fit_quality = 1
-
-            # Pull the fit metadata together
-            fit_data = [
-                        start_time,
-                        motor_pos,
-                        angle,
-                        int_time,
-                        coadds,
-                        common['wave_start'],
-                        common['wave_stop'],
-                        max(y),
-                        max(y[common['idx']]),
-                        fit_quality
-                        ]
-
-            # Add the fit results to the metadata
-            for i in range(len(popt)):
-                fit_data += [popt[i], perr[i]]
-
-            # Add to the dataframe
+                results = [_fit_segments(common, scan, segments)]
+        finally:
+            for _ in range(taken):
+                slots.release()
+
+        # Put the results together in order
+        rows = [row for result in results for row in result[0]]
+        for n, fit_data in zip(np.concatenate(segments), rows):
             df.iloc[n-1] = fit_data
-
-            # Update fit parameters
-            if fitted_flag == True and fit_quality == 1:
-                common['params'] = popt
-
-        logging.info(f'Scan {str(common["scan_no"])} analysis complete')
+        behind = any(result[1] for result in results)
+
+        # Summarise the fits
+        summary = summarise_fits(df)
+        summary['behind'] = behind
+        df.attrs['fit_summary'] = summary
+        if calibration is not None:
+            df.attrs['calibration'] = calibration
+        if clear_sky_ref is not None:
+            df.attrs['clear_sky_ref'] = clear_sky_ref
+
+        logging.info(f'Scan {str(common["scan_no"])} analysis complete: '
+                     + f'{summary["n_fits"]} fits in '
+                     + f'{summary["fit_time_total"]:.2f} s, mean '
+                     + f'{summary["nfev_mean"]:.1f} evaluations, '
+                     + f'{summary["n_failed"]} failed, '
+                     + f'{summary["n_budget_limited"]} budget limited')
 
         if save_results == True:
 
@@ -211,13 +488,582 @@ def analyse_scan(scan_path, save_results = True, save_path = None, **common):
             # Try to save in the parquet format
             try:
                 df.to_parquet(fpath + '.parquet')
+                fpath += '.parquet'
 
             # Else save as a .csv
             except ImportError:
                 df.to_csv(fpath + '.csv')
+                fpath += '.csv'
+
+            # Record the fit summary, to track the analysis cost over the day
+            save_fit_summary(f'{save_path}fit_metrics.csv',
+                             scan_path.split('/')[-1], summary)
+
+            # Record the scan calibration, to track its drift
+            if calibration is not None:
+                save_calibration(f'{save_path}calibration.csv',
+                                 scan_path.split('/')[-1], calibration)
+
+            # Record the analysis in the catalog
+            update_catalog(common.get('catalog_path'), scan_path, 'analysed',
+                           fpath)
 
         return df
 
+    else:
+        logging.warning(f'Failed to read scan {scan_path}')
+        update_catalog(common.get('catalog_path'), scan_path, 'failed')
+
+#==============================================================================
+#================================ Fit Segments ================================
+#==============================================================================
+
+# Items of common not needed by the segment fits, so not sent to the pool
+_POOL_SKIP = ['dark_library', 'clear_sky_library', 'worker_slots']
+
+# The fit settings and scan data held by each pool process
+_pool_data = {}
+
+def _init_fit_pool(common, scan):
+
+    '''
+    Hold the fit settings and scan data in a pool process, see analyse_scan
+    '''
+
+    _pool_data['common'] = common
+    _pool_data['scan'] = scan
+
+def _fit_chunk(segments):
+
+    '''
+    Fit a chunk of the scan segments in a pool process, see _fit_segments
+    '''
+
+    return _fit_segments(_pool_data['common'], _pool_data['scan'], segments)
+
+def _fit_segments(common, scan, segments):
+
+    '''
+    Fit segments of a scan one after another, see analyse_scan. Takes the
+    common, the scan data and the spectrum numbers of each segment, and
+    returns the result rows and whether the fits fell behind. The time left
+    is shared between all the spectra still to fit
+    '''
+
+    rows = []
+    behind = False
+    for k, ns in enumerate(segments):
+        n_after = sum(len(later) for later in segments[k+1:])
+        seg_rows, seg_behind = _fit_segment(common, scan, ns, n_after)
+        rows += seg_rows
+        behind = behind or seg_behind
+
+    return rows, behind
+
+def _fit_segment(common, scan, ns, n_after):
+
+    '''
+    Fit a segment of a scan, see analyse_scan. Takes the common, the scan
+    data, the spectrum numbers of the segment and the number of spectra
+    fitted after it, and returns the result rows and whether the fits fell
+    behind
+    '''
+
+    # Fit with a copy of common, so the segments start from the same
+    #  parameters
+    common = dict(common)
+    x, grid = scan['x'], scan['grid']
+    info_block, spec_block = scan['info_block'], scan['spec_block']
+    full_fit, prealigned = scan['full_fit'], scan['prealigned']
+    so2_i = scan['so2_i']
+
+    # The first fit starts from the initial parameters
+    warm_start = False
+    last_good = False
+    fit_info = {}
+    rows = []
+
+    # Get the analysis deadline
+    deadline = scan['deadline']
+    behind = False
+    total_fit_time = 0.0
+
+    for k, n in enumerate(ns):
+
+        # Extract spectrum info
+        info = info_block[n]
+        n_aq, h, m, s, motor_pos, coadds, int_time = info
+
+        # Convert motor position to angle
+        angle = float(motor_pos) / common['steps_per_degree']
+
+        # Subtract the home offset
+        angle -= common['home_offset']
+
+        # Convert time to decimal hours
+        start_time = dt.time(int(h), int(m), int(s))
+
+        # Set the dark spectrum
+        common['dark'] = scan['darks'][n]
+
+        # Extract spectrum
+        y = spec_block[n]
+
+        # Share the time left between the remaining fits, switching to
+        #  cheaper fits if the analysis is falling behind
+        if deadline is not None:
+            n_left = len(ns) - k + n_after
+            time_left = deadline - time.time()
+            common['fit_time_limit'] = max(
+                common.get('fit_time_factor', 3) * time_left / n_left,
+                common.get('fit_min_time', 0.1))
+
+            mean_fit_time = total_fit_time / max(k, 1)
+            if not behind and k > 0 and mean_fit_time * n_left > time_left:
+                behind = True
+                common['fit_maxfev'] = common.get('fit_maxfev_behind', 100)
+                common['fit_tol'] = common.get('fit_tol_behind', 1e-4)
+                logging.info(f'Scan {common["scan_no"]} analysis behind, '
+                             + f'using cheaper fits from spectrum {n}')
+
+        # Start from the pre-aligned shift and stretch, unless warm
+        #  starting from the last spectrum
+        if prealigned is not None and not last_good \
+                and 'fixed_params' not in common:
+            common['params'] = np.array(common['params'], dtype=float)
+            common['params'][4:6] = prealigned[n-1]
+
+        # Fit the spectrum
+        if full_fit[n-1]:
+            popt, perr, fitted_flag = fit_spec(common, [x, y], grid,
+                                               fit_info)
+
+        # Otherwise keep the quick or clear sky fit, which have no
+        #  intensity polynomial and use the first guess shift and stretch
+        else:
+            popt = np.concatenate([np.full(4, np.nan),
+                                   common['params'][4:6],
+                                   scan['lin_amts'][n-1]])
+            perr = np.concatenate([np.full(6, np.nan),
+                                   scan['lin_errs'][n-1]])
+            fitted_flag = True
+            fit_info.update(fit_time=scan['lin_time'], nfev=0,
+                            fit_cost=np.nan,
+                            fit_status=scan['lin_status'][n-1],
+                            budget_limited=False)
+
+        # Make the fit quality flag. Fits stopped by their budget keep the
+        #  best result found, flagged in budget_limited
+        budget_result = fit_info.get('budget_limited', False) \
+            and np.isfinite(popt[so2_i])
+        if max(y[common['idx']]) > 50000:
+            fit_quality = 0
+        elif scan['no_dark'][n]:
+            fit_quality = 0
+        #elif max(y[common['idx']]) < 4000:
+        #    fit_quality = 0
+        elif not fitted_flag and not budget_result:
+            fit_quality = 0
+        elif popt[so2_i] < -2.463e17:
+            fit_quality = 0
+        else:
+            fit_quality = 1
+
+        # Pull the fit metadata together
+        fit_data = [
+                    start_time,
+                    motor_pos,
+                    angle,
+                    int_time,
+                    coadds,
+                    scan['scan_noise'][n],
+                    common['wave_start'],
+                    common['wave_stop'],
+                    max(y),
+                    max(y[common['idx']]),
+                    fit_quality
+                    ]
+
+        # Add the fit results to the metadata
+        for i in range(len(popt)):
+            fit_data += [popt[i], perr[i]]
+
+        # Add the fit details
+        fit_data += [fit_info['fit_time'], fit_info['nfev'],
+                     fit_info['fit_cost'], fit_info['fit_status'],
+                     warm_start, fit_info['budget_limited']]
+        total_fit_time += fit_info['fit_time']
+
+        rows.append(fit_data)
+
+        # Update fit parameters
+        last_good = fitted_flag == True and fit_quality == 1 \
+            and full_fit[n-1]
+        if last_good:
+            common['params'] = popt
+            warm_start = True
+
+    return rows, behind
+
+#==============================================================================
+#=============================== Calibrate Scan ===============================
+#==============================================================================
+
+def calibrate_scan(common, x, spec_block, darks, spectra, grid):
+
+    '''
+    Function to fit the wavelength shift and stretch once for a scan, from the
+    brightest unsaturated spectrum outside the plume, and hold them fixed for
+    the rest of the scan. The fitted parameters are used as the first guess
+    for the other spectra
+
+    **Parameters:**
+
+    common : dict
+        Common dictionary of parameters used by the program. The fixed shift
+        and stretch are set in its "fixed_params"
+
+    x : array
+        Wavelength grid of the spectrometer
+
+    spec_block : 2D array
+        The scan spectra, with the dark first
+
+    darks : list
+        The dark spectrum for each row of spec_block
+
+    spectra : 2D array
+        The dark and flat corrected spectra in the fit window, excluding the
+        dark
+
+    grid : array
+        Measurement wavelength grid over which the fit occurs
+
+    **Returns:**
+
+    calibration : dict or None
+        The spec_n of the spectrum used, and the shift, shift_e, stretch and
+        stretch_e. None if the fit failed, in which case nothing is fixed
+    '''
+
+    common.pop('fixed_params', None)
+
+    # Find the spectra outside the plume with the quick fit
+    amts, errs, resid = quick_fit(common, spectra, grid)
+    so2_i = common.get('param_names', PARAM_NAMES).index('so2') - 6
+    so2 = np.nan_to_num(amts[:, so2_i], nan=np.inf)
+    raw_max = spec_block[1:, common['idx'][0]].max(axis=1)
+    usable = raw_max <= 50000
+    clear = np.logical_and(usable, so2 < common.get('triage_so2', 5e16))
+    if not clear.any():
+        clear = usable if usable.any() else np.full(len(spectra), True)
+
+    # Use the brightest
+    candidates = np.where(clear)[0]
+    spec_n = int(candidates[np.argmax(spectra[candidates].max(axis=1))]) + 1
+
+    # Fit it with a free shift and stretch
+    common['dark'] = darks[spec_n]
+    popt, perr, fitted_flag = fit_spec(common, [x, spec_block[spec_n]], grid)
+
+    if not fitted_flag:
+        logging.warning(f'Scan {common["scan_no"]} calibration failed, '
+                        + 'fitting shift and stretch for each spectrum')
+        return None
+
+    common['params'] = popt
+    common['fixed_params'] = {4: popt[4], 5: popt[5]}
+
+    logging.info(f'Scan {common["scan_no"]} calibrated from spectrum '
+                 + f'{spec_n}: shift {popt[4]:.4f}, stretch {popt[5]:.4f}')
+
+    return {'spec_n': spec_n, 'shift': popt[4], 'shift_e': perr[4],
+            'stretch': popt[5], 'stretch_e': perr[5]}
+
+#==============================================================================
+#============================= Find Clear Sky Refs ============================
+#==============================================================================
+
+def find_clear_sky_refs(common, scan_path, info_block, spec_block, spectra,
+                        so2):
+
+    '''
+    Function to choose the measured clear sky reference spectra for a scan.
+    The unsaturated spectra of the scan with a quick fit SO2 below the
+    clear_sky_so2 setting (default 5e16 molecules/cm2) are averaged to give
+    the reference for all the spectra. If the scan has none, each spectrum
+    uses the latest clear sky spectrum measured at the same motor position in
+    the clear sky library, if recent enough.
+
+    The clear spectra of the scan are added to the library, which is taken
+    from the "clear_sky_library" in common, or made and kept there if not
+    given.
+
+    **Parameters:**
+
+    common : dict
+        Common dictionary of keyword parameters used by the program
+
+    scan_path : str
+        The file path of the scan, used to find the date
+
+    info_block, spec_block : 2D array
+        The info and spectra of each row of the scan, the first being the dark
+
+    spectra : 2D array
+        The spectra, corrected for dark and flat, in the fit window
+
+    so2 : array
+        The quick fit SO2 amount of each spectrum
+
+    **Returns:**
+
+    ref_idx : array
+        The reference used for each spectrum, -1 if none
+
+    references : 2D array
+        The reference spectra
+
+    clear_sky_ref : str
+        Where the references came from, "scan (n spectra)" or "library"
+    '''
+
+    library = common.get('clear_sky_library')
+    if library is None:
+        library = ClearSkyLibrary(common)
+        common['clear_sky_library'] = library
+    library.load()
+
+    # Find the time of each spectrum
+    try:
+        date = parse_scan_fname(scan_path)['timestamp'].date()
+    except (ValueError, IndexError):
+        date = dt.date.today()
+    timestamps = [dt.datetime.combine(date, dt.time(int(h), int(m), int(s))
+                                      ).timestamp()
+                  for h, m, s in info_block[1:, 1:4]]
+    motor_pos = info_block[1:, 4]
+
+    # Find the clear spectra, and add them to the library
+    raw_max = spec_block[1:, common['idx'][0]].max(axis=1)
+    clear = np.logical_and.reduce([
+        np.nan_to_num(so2, nan=np.inf) < common.get('clear_sky_so2', 5e16),
+        raw_max <= 50000, spectra.max(axis=1) > 3000])
+    for n in np.where(clear)[0]:
+        library.add(motor_pos[n], spectra[n], timestamps[n])
+    library.save()
+
+    # Use the mean of the clear spectra of the scan, each scaled to the
+    #  same mean intensity, to keep the noise of the reference down
+    if clear.any():
+        clear_specs = spectra[clear]
+        scale = clear_specs.mean(axis=1, keepdims=True)
+        reference = np.mean(clear_specs / scale, axis=0) * scale.mean()
+        return np.zeros(len(spectra), dtype=int), reference[None, :], \
+            f'scan ({clear.sum()} spectra)'
+
+    # Otherwise use the library spectra at the same angles
+    ref_idx = np.full(len(spectra), -1)
+    references = []
+    for n in range(len(spectra)):
+        ref = library.get(motor_pos[n], timestamps[n], spectra.shape[1])
+        if ref is not None:
+            ref_idx[n] = len(references)
+            references.append(ref)
+    if len(references) == 0:
+        references = np.zeros([0, spectra.shape[1]])
+
+    return ref_idx, np.array(references), 'library'
+
+#==============================================================================
+#============================= Save Calibration ===============================
+#==============================================================================
+
+def save_calibration(fpath, scan_name, calibration):
+
+    '''
+    Function to add the calibration of a scan to the calibration file, so the
+    drift of the shift and stretch can be tracked
+
+    **Parameters:**
+
+    fpath : str
+        File path to the calibration .csv file. Created if it does not exist
+
+    scan_name : str
+        File name of the scan
+
+    calibration : dict
+        The scan calibration, as returned by calibrate_scan
+
+    **Returns:**
+
+    None
+    '''
+
+    columns = ['spec_n', 'shift', 'shift_e', 'stretch', 'stretch_e']
+    line = ','.join([scan_name] + [str(calibration[c]) for c in columns])
+
+    # Write the header for a new file
+    if not os.path.isfile(fpath):
+        line = ','.join(['scan'] + columns) + '\n' + line
+
+    with open(fpath, 'a') as w:
+        w.write(line + '\n')
+
+def read_calibration(fpath):
+
+    '''
+    Function to read a calibration file, finding the drift of the shift and
+    stretch from scan to scan
+
+    **Parameters:**
+
+    fpath : str
+        File path to the calibration .csv file
+
+    **Returns:**
+
+    df : pandas.DataFrame
+        The calibration of each scan, indexed by scan file name, with the
+        change in shift and stretch from the previous scan in shift_drift and
+        stretch_drift
+    '''
+
+    df = pd.read_csv(fpath, index_col='scan').sort_index()
+    df['shift_drift'] = df['shift'].diff()
+    df['stretch_drift'] = df['stretch'].diff()
+
+    return df
+
+#==============================================================================
+#=============================== Summarise Fits ===============================
+#==============================================================================
+
+def summarise_fits(df):
+
+    '''
+    Function to summarise the fit details of a scan, to show which spectra
+    take the analysis time
+
+    **Parameters:**
+
+    df : pandas.DataFrame
+        The scan results, as returned by analyse_scan
+
+    **Returns:**
+
+    summary : dict
+        The scan fit metrics:
+            - n_fits: number of spectra
+            - fit_time_total, fit_time_mean, fit_time_max: fit wall time (s)
+            - slowest_spectrum: the index of the slowest fit
+            - nfev_mean, nfev_max: forward model evaluations per fit
+            - n_warm_start: fits started from the previous spectrum
+            - n_failed: fits that gave no result (error or low intensity)
+            - n_budget_limited: fits stopped by their time or evaluation budget
+            - n_<status>: the number of fits with each fit_status
+    '''
+
+    fit_time = df['fit_time'].astype(float)
+    nfev = df['nfev'].astype(float)
+    status = df['fit_status']
+
+    summary = {'n_fits': len(df),
+               'fit_time_total': float(fit_time.sum()),
+               'fit_time_mean': float(fit_time.mean()),
+               'fit_time_max': float(fit_time.max()),
+               'slowest_spectrum': int(fit_time.idxmax()) if len(df) else -1,
+               'nfev_mean': float(nfev.mean()),
+               'nfev_max': int(nfev.max()) if len(df) else 0,
+               'n_warm_start': int(df['warm_start'].astype(bool).sum()),
+               'n_failed': int(status.isin(['error', 'low_intensity'])
+                               .sum()),
+               'n_budget_limited': int(df['budget_limited'].astype(bool)
+                                       .sum())}
+
+    for key in ['converged', 'quick', 'clear_sky', 'max_evals',
+                'time_budget', 'error', 'low_intensity']:
+        summary[f'n_{key}'] = int((status == key).sum())
+
+    return summary
+
+def save_fit_summary(fpath, scan_name, summary):
+
+    '''
+    Function to add the fit summary of a scan to the fit metrics file, so the
+    analysis cost can be tracked from scan to scan
+
+    **Parameters:**
+
+    fpath : str
+        File path to the fit metrics .csv file. Created if it does not exist
+
+    scan_name : str
+        File name of the scan
+
+    summary : dict
+        The scan fit summary, as returned by summarise_fits
+
+    **Returns:**
+
+    None
+    '''
+
+    columns = list(summary.keys())
+    line = ','.join([scan_name] + [str(summary[c]) for c in columns])
+
+    # Write the header for a new file
+    if not os.path.isfile(fpath):
+        line = ','.join(['scan'] + columns) + '\n' + line
+
+    with open(fpath, 'a') as w:
+        w.write(line + '\n')
+
+#==============================================================================
+#=============================== Update Catalog ===============================
+#==============================================================================
+
+def update_catalog(catalog_path, scan_path, status, so2_path=None):
+
+    '''
+    Function to record the analysis status of a scan, and its results file, in
+    the scan catalog
+
+    **Parameters:**
+
+    catalog_path : str or None
+        File path to the catalog database. If None nothing is recorded
+
+    scan_path : str
+        File path to the analysed scan
+
+    status : str
+        Analysis status of the scan, e.g. "analysed" or "failed"
+
+    so2_path : str, optional
+        File path to the saved results file
+
+    **Returns:**
+
+    None
+    '''
+
+    catalog = open_catalog(catalog_path)
+    if catalog is None:
+        return
+
+    try:
+        # Add the scan if it is not yet catalogued, e.g. if it is still being
+        #  saved
+        if not catalog.set_status(scan_path, status):
+            catalog.add_file(scan_path, kind='spectra', status=status,
+                             checksum='')
+        if so2_path is not None:
+            catalog.add_file(so2_path, kind='so2', status=status)
+    except sqlite3.Error:
+        logging.warning('Failed to update scan catalog', exc_info=True)
+
 #==============================================================================
 #============================== Update Int Time ===============================
 #==============================================================================
@@ -242,11 +1088,12 @@ def update_int_time(common, settings):
         New integration time for the next scan
     '''
 
-    # Load the previous scan
-    err, x, info, spec = read_scan(common['scan_fpath'])
-
-    # Find the maximum intensity
-    max_int = np.max(spec)
+    # Find the maximum intensity, recorded during the scan if available
+    if common.get('scan_max_int') is not None:
+        max_int = common['scan_max_int']
+    else:
+        err, x, info, spec = read_scan(common['scan_fpath'])
+        max_int = np.max(spec)
 
     # Scale the intensity to the target
     scale = settings['target_int'] / max_int
@@ -254,21 +1101,14 @@ def update_int_time(common, settings):
     # Scale the integration time by this factor
     int_time = common['spec_int_time'] * scale
 
-    # Find the nearest integration time
-    int_times = np.arange(start = settings['min_int_time'],
-                          stop  = settings['max_int_time'] + settings['int_time_step'],
-                          step  = settings['int_time_step'])
-
-    # Find the nearest value
-    diff = ((int_times - int_time)**2)**0.5
-    idx = np.where(diff == min(diff))[0][0]
-    new_int_time = int(int_times[idx])
+    # Find the nearest allowed integration time
+    new_int_time = snap_int_time(int_time, settings)
 
     # Log change
     logging.info('Updated integration time to ' + str(new_int_time) + ' ms')
 
     # Return the updated integration time
-    return int(int_times[idx])
+    return new_int_time
 
 #==============================================================================
 #=============================== Read Scan SO2 ================================
@@ -305,6 +1145,47 @@ def read_scan_so2(fpath):
 
     return jul_time, motor_pos, scan_angles, so2_cds, so2_err
 
+#==============================================================================
+#============================= Read SO2 Results ===============================
+#==============================================================================
+
+# Columns used by the home station flux calculation
+FLUX_COLUMNS = ['angle', 'fit_quality', 'so2', 'so2_e']
+
+def read_so2_results(fpath, columns=None):
+
+    '''
+    Function to read a scan results file (as written by analyse_scan), reading
+    only the requested columns.
+
+    **Parameters:**
+
+    fpath : str
+        File path to the .parquet or .csv results file
+
+    columns : list, optional
+        The columns to read. If None all columns are read
+
+    **Returns:**
+
+    df : pandas.DataFrame
+        The scan results
+    '''
+
+    if columns is not None:
+        columns = list(columns)
+
+    # Read only the required columns from the file
+    if fpath.endswith('.csv'):
+        if columns is None:
+            df = pd.read_csv(fpath, index_col=0)
+        else:
+            df = pd.read_csv(fpath, usecols=columns)
+    else:
+        df = pd.read_parquet(fpath, columns=columns)
+
+    return df
+
 #==============================================================================
 #=============================== Calc Scan Flux ===============================
 #==============================================================================
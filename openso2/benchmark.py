@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+"""
+Module to benchmark the speed and accuracy of the analysis on synthetic scans,
+keeping a history of the results to catch regressions.
+"""
+
+import os
+import glob
+import json
+import time
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+import datetime as dt
+
+from openso2.fit import fit_spec
+from openso2.analyse_scan import read_scan, analyse_scan, get_spec_details
+from openso2.program_setup import build_common
+from openso2.calc_scan_flux import calc_scan_flux, get_station_data
+from openso2.synthetic import generate_dataset, read_truth
+
+# Metrics where a higher value is better, all others are better lower
+HIGHER_IS_BETTER = ['read_mb_per_s', 'fit_spectra_per_s',
+                    'analyse_spectra_per_s', 'flux_scans_per_s']
+
+#==============================================================================
+#=============================== Prepare Dataset ==============================
+#==============================================================================
+
+def prepare_dataset(data_path, settings, n_scans, start_date=None,
+                    scan_interval=300, seed=0):
+
+    '''
+    Function to find the scans of a synthetic dataset, generating it if
+    needed, along with the ground truth
+
+    **Parameters:**
+
+    data_path : str
+        Folder of the synthetic dataset
+
+    settings : dict
+        Dictionary of station settings
+
+    n_scans : int
+        Number of scans wanted
+
+    start_date : datetime.date, optional
+        Day to generate. Default is 2019-07-01
+
+    scan_interval : float, optional
+        Time between scans (s). Default is 300
+
+    seed : int, optional
+        Seed for the noise. Default is 0
+
+    **Returns:**
+
+    scan_paths : list
+        File paths of the scans
+
+    so2_truth, flux_truth : pandas.DataFrame
+        The ground truth, as returned by read_truth
+    '''
+
+    if start_date is None:
+        start_date = dt.date(2019, 7, 1)
+
+    day_path = f'{data_path}{start_date}/'
+    scan_paths = sorted(glob.glob(f'{day_path}spectra/*.npy'))
+
+    # Generate the scans if there are not enough
+    if len(scan_paths) < n_scans \
+            or not os.path.isfile(f'{day_path}truth/flux_truth.csv'):
+        start_hour = settings['start_time']
+        stop_hour = start_hour + n_scans * scan_interval / 3600
+        scan_paths = generate_dataset(data_path, settings, start_date,
+                                      scan_interval=scan_interval,
+                                      start_hour=start_hour,
+                                      stop_hour=stop_hour, seed=seed)
+
+    so2_truth, flux_truth = read_truth(day_path)
+
+    return scan_paths[:n_scans], so2_truth, flux_truth
+
+#==============================================================================
+#================================ Run Benchmark ===============================
+#==============================================================================
+
+def run_benchmark(scan_paths, common, so2_truth, flux_truth, label='default',
+                  n_fit_scans=2, volc_loc=(16.7103, -62.1773)):
+
+    '''
+    Function to benchmark the analysis on a set of synthetic scans. Measures:
+        - read_mb_per_s: read_scan throughput
+        - fit_spectra_per_s: fit_spec throughput, on the first n_fit_scans
+        - analyse_spectra_per_s: analyse_scan throughput
+        - flux_scans_per_s: calc_scan_flux throughput
+        - latency_mean_s, latency_p95_s: time from reading a scan to its flux
+        - nfev_mean, fit_time_p95_s: forward model evaluations and wall time
+          of each fit in analyse_scan
+        - so2_rms_error, so2_bias: fitted minus true SO2 (molecules/cm2) of
+          the good fits
+        - so2_failure_rate: fraction of spectra without a good fit
+        - flux_mean_rel_error, flux_rms_rel_error: relative error of the
+          scan fluxes
+
+    **Parameters:**
+
+    scan_paths : list
+        File paths of the scans
+
+    common : dict
+        Common dictionary used for the analysis, as made by build_common
+
+    so2_truth, flux_truth : pandas.DataFrame
+        The ground truth, as returned by read_truth
+
+    label : str, optional
+        Name of the analysis configuration, recorded with the results
+
+    n_fit_scans : int, optional
+        Number of scans used to time fit_spec alone. Default is 2
+
+    volc_loc : tuple, optional
+        Volcano location (lat, lon) used for the fluxes
+
+    **Returns:**
+
+    record : dict
+        The benchmark record, holding the metrics and run details
+
+    results : pandas.DataFrame
+        Fitted and true SO2 of every spectrum, indexed by file name and
+        spectrum number
+
+    fluxes : pandas.DataFrame
+        Fitted and true flux of every scan, indexed by file name
+    '''
+
+    stat_info = get_station_data(common['station_name'])
+
+    # Time reading the scans, repeating for at least half a second so the
+    #  rate is stable
+    scan_bytes = sum(os.path.getsize(f) for f in scan_paths)
+    n_bytes = 0
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < 0.5:
+        for fpath in scan_paths:
+            read_scan(fpath)
+        n_bytes += scan_bytes
+    read_time = time.perf_counter() - t0
+
+    # Time fitting alone
+    n_fit = 0
+    fit_time = 0.0
+    for fpath in scan_paths[:n_fit_scans]:
+        err, x, info_block, spec_block = read_scan(fpath)
+        fit_common = dict(common)
+        fit_common['idx'] = np.where(np.logical_and(
+            common['wave_start'] <= x, x <= common['wave_stop']))
+        fit_common['dark'] = spec_block[0]
+        grid = x[fit_common['idx']]
+        t0 = time.perf_counter()
+        for y in spec_block[1:]:
+            popt, perr, fitted_flag = fit_spec(fit_common, [x, y], grid)
+
+            # Start the next fit from the last, as analyse_scan does
+            if fitted_flag:
+                fit_common['params'] = popt
+        fit_time += time.perf_counter() - t0
+        n_fit += len(spec_block) - 1
+
+    # Analyse each scan and find its flux
+    results = []
+    fluxes = []
+    latencies = []
+    analyse_time = 0.0
+    flux_time = 0.0
+    n_spectra = 0
+    for fpath in scan_paths:
+
+        fname = os.path.basename(fpath)
+        truth = flux_truth.loc[fname]
+
+        t0 = time.perf_counter()
+        df = analyse_scan(fpath, False, **dict(common))
+        t1 = time.perf_counter()
+        df = df[['angle', 'so2', 'so2_e', 'fit_quality', 'fit_time',
+                 'nfev']].astype(float)
+        flux, flux_err = calc_scan_flux(df, stat_info, volc_loc,
+                                        truth['windspeed'], truth['plume_az'],
+                                        truth['plume_height'])
+        t2 = time.perf_counter()
+
+        analyse_time += t1 - t0
+        flux_time += t2 - t1
+        latencies.append(t2 - t0)
+        n_spectra += len(df)
+
+        df['fname'] = fname
+        df['spec_n'] = np.arange(1, len(df) + 1)
+        results.append(df)
+        fluxes.append([fname, flux, truth['flux']])
+
+    results = pd.concat(results).set_index(['fname', 'spec_n'])
+    results['so2_true'] = so2_truth['so2'].reindex(results.index)
+    fluxes = pd.DataFrame(fluxes, columns=['fname', 'flux', 'flux_true']
+                          ).set_index('fname')
+
+    # Find the accuracy
+    good = results[results['fit_quality'] == 1]
+    so2_diff = good['so2'] - good['so2_true']
+    flux_rel = (fluxes['flux'] - fluxes['flux_true']) / fluxes['flux_true']
+
+    metrics = {
+        'read_mb_per_s': n_bytes / 1e6 / read_time,
+        'fit_spectra_per_s': n_fit / fit_time if fit_time > 0 else np.nan,
+        'analyse_spectra_per_s': n_spectra / analyse_time,
+        'flux_scans_per_s': len(scan_paths) / flux_time,
+        'latency_mean_s': float(np.mean(latencies)),
+        'latency_p95_s': float(np.percentile(latencies, 95)),
+        'nfev_mean': float(results['nfev'].mean()),
+        'fit_time_p95_s': float(np.percentile(results['fit_time'], 95)),
+        'so2_rms_error': float(np.sqrt(np.mean(so2_diff**2))),
+        'so2_bias': float(np.mean(so2_diff)),
+        'so2_failure_rate': 1 - len(good) / len(results),
+        'flux_mean_rel_error': float(np.mean(np.abs(flux_rel))),
+        'flux_rms_rel_error': float(np.sqrt(np.mean(flux_rel**2)))
+        }
+
+    record = {'timestamp': dt.datetime.now().isoformat(timespec='seconds'),
+              'label': label,
+              'commit': _git_commit(),
+              'host': platform.node(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'n_scans': len(scan_paths),
+              'n_spectra': n_spectra,
+              'metrics': {key: float(val) for key, val in metrics.items()}}
+
+    return record, results, fluxes
+
+def _git_commit():
+
+    '''Return the current git commit, or None if not in a repository'''
+
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#==============================================================================
+#=================================== History ==================================
+#==============================================================================
+
+def append_history(fpath, record):
+
+    '''
+    Function to add a benchmark record to the history file, which holds one
+    JSON record per line
+
+    **Parameters:**
+
+    fpath : str
+        File path to the history file
+
+    record : dict
+        The benchmark record
+
+    **Returns:**
+
+    None
+    '''
+
+    folder = os.path.dirname(fpath)
+    if folder != '':
+        os.makedirs(folder, exist_ok=True)
+
+    with open(fpath, 'a') as a:
+        a.write(json.dumps(record) + '\n')
+
+def load_history(fpath, label=None):
+
+    '''
+    Function to read the benchmark records from the history file, optionally
+    only those with the given label. Returns an empty list if there is no
+    history
+    '''
+
+    if not os.path.isfile(fpath):
+        return []
+
+    with open(fpath, 'r') as r:
+        records = [json.loads(line) for line in r if line.strip() != '']
+
+    if label is not None:
+        records = [rec for rec in records if rec['label'] == label]
+
+    return records
+
+#==============================================================================
+#=============================== Find Regressions =============================
+#==============================================================================
+
+def find_regressions(record, previous, tolerance=0.1):
+
+    '''
+    Function to compare a benchmark record with a previous one, finding the
+    metrics that have got worse by more than the tolerance
+
+    **Parameters:**
+
+    record : dict
+        The new benchmark record
+
+    previous : dict
+        The record to compare against
+
+    tolerance : float, optional
+        Fractional change allowed before a metric is flagged. Default is 0.1
+
+    **Returns:**
+
+    regressions : dict
+        The fractional change of each metric that has got worse
+    '''
+
+    regressions = {}
+
+    for key, new in record['metrics'].items():
+
+        old = previous['metrics'].get(key)
+        if old is None or not np.isfinite(old) or not np.isfinite(new):
+            continue
+
+        # The failure rate is already a fraction, so compare directly
+        if key == 'so2_failure_rate':
+            change = new - old
+        elif old == 0:
+            continue
+        elif key == 'so2_bias':
+            change = (abs(new) - abs(old)) / abs(old)
+        else:
+            change = (new - old) / abs(old)
+
+        if key in HIGHER_IS_BETTER:
+            change = -change
+
+        if change > tolerance:
+            regressions[key] = change
+
+    return regressions
+
+#==============================================================================
+#=============================== Compare Engines ==============================
+#==============================================================================
+
+def compare_engines(scan_paths, settings, engines, so2_truth, flux_truth,
+                    ref_path='data_bases/Ref/'):
+
+    '''
+    Function to run the same scans through several analysis configurations
+    ("engines") and compare them side by side. The first engine is the
+    reference the others are compared against.
+
+    Each engine is given as a dictionary, which may hold:
+        - settings: settings overriding the station settings when building
+          the common, e.g. {"model_res": 0.05}
+        - common: values overriding the built common
+
+    **Parameters:**
+
+    scan_paths : list
+        File paths of the scans
+
+    settings : dict
+        Dictionary of station settings
+
+    engines : dict
+        The engines to compare, as {name: engine}
+
+    so2_truth, flux_truth : pandas.DataFrame
+        The ground truth, as returned by read_truth
+
+    ref_path : str, optional
+        The folder holding the reference files
+
+    **Returns:**
+
+    summary : pandas.DataFrame
+        For each engine the wall time of the whole benchmark run, the
+        analysis throughput and its speedup over the reference engine (both
+        from the analyse_scan time only), the failure rate and the errors
+        against the truth and the reference engine
+
+    spectra : pandas.DataFrame
+        The true SO2 and the SO2 and fit quality from each engine for every
+        spectrum
+
+    fluxes : pandas.DataFrame
+        The true flux and the flux from each engine for every scan
+
+    records : dict
+        The benchmark record of each engine
+    '''
+
+    spec_name = get_spec_details(f'x_x_{settings["station_name"]}_')[1]
+
+    spectra = None
+    fluxes = None
+    records = {}
+    rows = []
+
+    for name, engine in engines.items():
+
+        # Build the common for this engine
+        engine_settings = {**settings, **engine.get('settings', {})}
+        common = build_common(engine_settings, spec_name, ref_path=ref_path)
+        common.update(engine.get('common', {}))
+
+        t0 = time.perf_counter()
+        record, results, scan_fluxes = run_benchmark(scan_paths, common,
+                                                     so2_truth, flux_truth,
+                                                     label=name)
+        wall_time = time.perf_counter() - t0
+        records[name] = record
+
+        # Collect the results side by side
+        if spectra is None:
+            spectra = results[['so2_true']].copy()
+            fluxes = scan_fluxes[['flux_true']].copy()
+            ref = name
+        spectra[f'so2_{name}'] = results['so2']
+        spectra[f'fit_quality_{name}'] = results['fit_quality']
+        fluxes[f'flux_{name}'] = scan_fluxes['flux']
+
+        # Compare with the reference engine, using spectra both fit well
+        both = (spectra[f'fit_quality_{ref}'] == 1) \
+            & (spectra[f'fit_quality_{name}'] == 1)
+        so2_diff = spectra[f'so2_{name}'][both] - spectra[f'so2_{ref}'][both]
+        flux_diff = (fluxes[f'flux_{name}'] - fluxes[f'flux_{ref}']) \
+            / fluxes[f'flux_{ref}']
+
+        metrics = record['metrics']
+        rows.append({'engine': name,
+                     'wall_time_s': wall_time,
+                     'analyse_spectra_per_s': metrics['analyse_spectra_per_s'],
+                     'failure_rate': metrics['so2_failure_rate'],
+                     'so2_rms_error': metrics['so2_rms_error'],
+                     'flux_mean_rel_error': metrics['flux_mean_rel_error'],
+                     'so2_rms_diff': float(np.sqrt(np.mean(so2_diff**2))),
+                     'so2_max_diff': float(np.max(np.abs(so2_diff)))
+                                     if len(so2_diff) > 0 else np.nan,
+                     'flux_mean_rel_diff': float(np.mean(np.abs(flux_diff))),
+                     'failure_rate_diff': metrics['so2_failure_rate']
+                         - records[ref]['metrics']['so2_failure_rate'],
+                     'speedup': metrics['analyse_spectra_per_s']
+                         / records[ref]['metrics']['analyse_spectra_per_s']})
+
+    summary = pd.DataFrame(rows).set_index('engine')
+
+    return summary, spectra, fluxes, records
@@ -0,0 +1,522 @@
+# -*- coding: utf-8 -*-
+"""
+Module to keep a local SQLite catalog of scan and result files, so that scans
+can be listed, synced and queued for analysis without scanning directories.
+"""
+
+import os
+import sqlite3
+import hashlib
+import logging
+import threading
+import datetime as dt
+from contextlib import contextmanager
+
+# Lock held while a connection is open. Processes are not forked while it is
+#  held, as a child forked part way through an update (e.g. by a scan writer
+#  thread) inherits the SQLite lock state and blocks on the database
+_lock = threading.Lock()
+
+def _reset_lock():
+    global _lock
+    _lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=lambda: _lock.acquire(),
+                        after_in_parent=lambda: _lock.release(),
+                        after_in_child=_reset_lock)
+
+#==============================================================================
+#============================== Parse Scan Fname ==============================
+#==============================================================================
+
+def parse_scan_fname(fname):
+
+    '''
+    Function to extract the scan details held in an Open SO2 file name. Both
+    scan files ("yyyymmdd_HHMMSS_STATION_v_1_1_BlockN.npy") and their results
+    files ("..._BlockN_so2.parquet") are understood.
+
+    **Parameters:**
+
+    fname : str
+        File name or path of the scan or results file
+
+    **Returns:**
+
+    details : dict
+        Dictionary containing the scan "timestamp" (datetime), "station" name
+        and "scan_no"
+    '''
+
+    # Get just the file name
+    fname = os.path.basename(fname.replace('\\', '/'))
+
+    # Split into the info pieces
+    parts = fname.split('_')
+
+    # Extract the start time from the date and time stamps
+    timestamp = dt.datetime.strptime(parts[0] + parts[1], '%Y%m%d%H%M%S')
+
+    # Extract the scan number from the "BlockN" piece
+    scan_no = int(parts[6][5:].split('.')[0])
+
+    return {'timestamp': timestamp, 'station': parts[2], 'scan_no': scan_no}
+
+#==============================================================================
+#================================ Calc Checksum ===============================
+#==============================================================================
+
+def calc_checksum(fpath=None, data=None):
+
+    '''
+    Function to calculate the MD5 checksum of a file, or of the bytes that are
+    about to be written to it
+
+    **Parameters:**
+
+    fpath : str, optional
+        File path to the file to read
+
+    data : bytes, optional
+        File contents. If given the file is not read
+
+    **Returns:**
+
+    checksum : str
+        The hex digest of the file contents
+    '''
+
+    md5 = hashlib.md5()
+
+    if data is not None:
+        md5.update(data)
+
+    else:
+        with open(fpath, 'rb') as r:
+            for chunk in iter(lambda: r.read(1 << 20), b''):
+                md5.update(chunk)
+
+    return md5.hexdigest()
+
+#==============================================================================
+#================================ Scan Catalog ================================
+#==============================================================================
+
+class ScanCatalog:
+
+    '''
+    Catalog of the scan (spectra) and results (so2) files held on a station or
+    the home computer. Each file is recorded with its acquisition details and
+    analysis status so that listing, sync differences and backlog discovery
+    are indexed queries instead of directory listings.
+
+    A new connection is opened for each operation so the object can be passed
+    freely to other processes.
+
+    **Parameters:**
+
+    db_path : str, optional
+        File path to the SQLite database. Created if it does not exist.
+        Default is "Results/catalog.db"
+    '''
+
+    columns = ['path', 'dir', 'fname', 'kind', 'station', 'spectrometer',
+               'scan_no', 'start_time', 'end_time', 'int_time', 'coadds',
+               'max_int', 'status', 'checksum', 'updated']
+
+    def __init__(self, db_path='Results/catalog.db'):
+
+        self.db_path = db_path
+
+        # Make sure the parent folder exists
+        db_dir = os.path.dirname(db_path)
+        if db_dir != '':
+            os.makedirs(db_dir, exist_ok=True)
+
+        # Create the table and indices
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS scans (
+                                path         TEXT PRIMARY KEY,
+                                dir          TEXT,
+                                fname        TEXT NOT NULL,
+                                kind         TEXT NOT NULL,
+                                station      TEXT,
+                                spectrometer TEXT,
+                                scan_no      INTEGER,
+                                start_time   TEXT,
+                                end_time     TEXT,
+                                int_time     REAL,
+                                coadds       INTEGER,
+                                max_int      REAL,
+                                status       TEXT,
+                                checksum     TEXT,
+                                updated      TEXT)''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_station_time
+                            ON scans (station, kind, start_time)''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_status
+                            ON scans (kind, status)''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_fname
+                            ON scans (fname)''')
+
+            # Add the folder of each file to catalogs made before it was
+            #  recorded
+            names = [row[1] for row in
+                     conn.execute('PRAGMA table_info(scans)').fetchall()]
+            if 'dir' not in names:
+                conn.execute('ALTER TABLE scans ADD COLUMN dir TEXT')
+                paths = conn.execute('SELECT path FROM scans').fetchall()
+                conn.executemany('UPDATE scans SET dir = ? WHERE path = ?',
+                                 [[_file_dir(path), path]
+                                  for path, in paths])
+            conn.execute('''CREATE INDEX IF NOT EXISTS idx_dir
+                            ON scans (dir, fname)''')
+
+    @contextmanager
+    def _connect(self):
+
+        '''Open a connection to the database, committing and closing it at
+        the end of the block'''
+
+        with _lock:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            try:
+                with conn:
+                    yield conn
+            finally:
+                conn.close()
+
+#==============================================================================
+#================================= Add File ===================================
+#==============================================================================
+
+    def add_file(self, fpath, kind='spectra', status=None, spectrometer=None,
+                 info=None, spec=None, checksum=None, keep_status=False):
+
+        '''
+        Function to add or update a file in the catalog
+
+        **Parameters:**
+
+        fpath : str
+            File path to the scan or results file
+
+        kind : str, optional
+            The type of file, either "spectra" (raw scans) or "so2" (results).
+            Default is "spectra"
+
+        status : str, optional
+            The file status, e.g. "acquired", "analysed", "failed" or
+            "synced". Default is None
+
+        spectrometer : str, optional
+            Serial number of the spectrometer. Default is None
+
+        info : array, optional
+            The scan info block ([spec_n, hour, minute, second, motor_pos,
+            coadds, int_time] for each spectrum). Used to record the scan end
+            time, integration time and coadds
+
+        spec : array, optional
+            The scan spectra. Used to record the maximum intensity
+
+        checksum : str, optional
+            The MD5 checksum of the file. If None it is calculated from the
+            file if it exists
+
+        keep_status : bool, optional
+            If True and the file is already catalogued with a status, that
+            status is kept. Default is False
+
+        **Returns:**
+
+        None
+        '''
+
+        fname = os.path.basename(fpath.replace('\\', '/'))
+
+        # Pull the details from the file name
+        try:
+            details = parse_scan_fname(fname)
+            station = details['station']
+            scan_no = details['scan_no']
+            start_time = details['timestamp']
+        except (IndexError, ValueError):
+            station, scan_no, start_time = None, None, None
+
+        # Pull the acquisition details from the scan data
+        end_time, int_time, coadds, max_int = None, None, None, None
+        if info is not None and start_time is not None:
+            h, m, s = info[-1][1:4]
+            end_time = start_time.replace(hour=int(h), minute=int(m),
+                                          second=int(s))
+            coadds = int(info[-1][5])
+            int_time = float(info[-1][6])
+        if spec is not None:
+            max_int = float(spec.max())
+
+        # Get the file checksum
+        if checksum is None and os.path.isfile(fpath):
+            checksum = calc_checksum(fpath)
+
+        row = [fpath, _file_dir(fpath), fname, kind, station, spectrometer,
+               scan_no, _isoformat(start_time), _isoformat(end_time),
+               int_time, coadds, max_int, status, checksum,
+               dt.datetime.now().isoformat()]
+
+        # Insert the row, keeping any previous details that are not updated
+        with self._connect() as conn:
+            conn.execute(f'''INSERT INTO scans ({', '.join(self.columns)})
+                             VALUES ({', '.join('?' * len(row))})
+                             ON CONFLICT(path) DO UPDATE SET
+                             spectrometer = COALESCE(excluded.spectrometer,
+                                                     spectrometer),
+                             end_time = COALESCE(excluded.end_time, end_time),
+                             int_time = COALESCE(excluded.int_time, int_time),
+                             coadds   = COALESCE(excluded.coadds, coadds),
+                             max_int  = COALESCE(excluded.max_int, max_int),
+                             status   = CASE WHEN ? THEN
+                                            COALESCE(status, excluded.status)
+                                            ELSE
+                                            COALESCE(excluded.status, status)
+                                            END,
+                             checksum = COALESCE(excluded.checksum, checksum),
+                             updated  = excluded.updated''',
+                         row + [keep_status])
+
+#==============================================================================
+#================================ Set Status ==================================
+#==============================================================================
+
+    def set_status(self, fpath, status):
+
+        '''
+        Function to update the status of a file in the catalog. Returns False
+        if the file is not catalogued
+        '''
+
+        with self._connect() as conn:
+            cursor = conn.execute('''UPDATE scans SET status = ?, updated = ?
+                                     WHERE path = ?''',
+                                  [status, dt.datetime.now().isoformat(),
+                                   fpath])
+
+        return cursor.rowcount > 0
+
+#==============================================================================
+#================================ List Files ==================================
+#==============================================================================
+
+    def list_files(self, station=None, kind=None, status=None, start=None,
+                   stop=None, column='path'):
+
+        '''
+        Function to list catalogued files matching the given filters, ordered
+        by scan start time
+
+        **Parameters:**
+
+        station : str, optional
+            Station name
+
+        kind : str, optional
+            File type, "spectra" or "so2"
+
+        status : str, optional
+            File status
+
+        start, stop : datetime, optional
+            Limits on the scan start time (inclusive)
+
+        column : str, optional
+            The column to return. Default is "path"
+
+        **Returns:**
+
+        files : list
+            List of the requested column for each matching file
+        '''
+
+        if column not in self.columns:
+            raise ValueError(f'Column {column} not recognised')
+
+        # Build the query from the given filters
+        query = f'SELECT {column} FROM scans WHERE 1'
+        args = []
+        for key, val in [['station', station], ['kind', kind],
+                         ['status', status]]:
+            if val is not None:
+                query += f' AND {key} = ?'
+                args.append(val)
+        if start is not None:
+            query += ' AND start_time >= ?'
+            args.append(_isoformat(start))
+        if stop is not None:
+            query += ' AND start_time <= ?'
+            args.append(_isoformat(stop))
+        query += ' ORDER BY start_time, scan_no'
+
+        with self._connect() as conn:
+            rows = conn.execute(query, args).fetchall()
+
+        return [row[0] for row in rows]
+
+#==============================================================================
+#=============================== Missing Fnames ===============================
+#==============================================================================
+
+    def missing_fnames(self, fnames, kind=None, local_dir=None):
+
+        '''
+        Function to find which of a list of file names are not yet in the
+        catalog, for example to find the files to sync from a station
+
+        **Parameters:**
+
+        fnames : list
+            File names to check
+
+        kind : str, optional
+            Only compare against files of this type
+
+        local_dir : str, optional
+            Only compare against files held in this directory
+
+        **Returns:**
+
+        missing : list
+            The file names in fnames that are not catalogued, in the same order
+        '''
+
+        # Build the query from the given filters
+        query = 'SELECT fname FROM scans WHERE 1'
+        args = []
+        if kind is not None:
+            query += ' AND kind = ?'
+            args.append(kind)
+        if local_dir is not None:
+            query += ' AND dir = ?'
+            args.append(os.path.normpath(local_dir.replace('\\', '/')))
+
+        # Find which of the file names are catalogued, in batches to stay
+        #  within the SQLite limit on query parameters
+        fnames = list(fnames)
+        known = set()
+        with self._connect() as conn:
+            for i in range(0, len(fnames), 500):
+                batch = fnames[i:i+500]
+                rows = conn.execute(f'''{query} AND fname IN
+                                        ({', '.join('?' * len(batch))})''',
+                                    args + batch).fetchall()
+                known.update(row[0] for row in rows)
+
+        return [fname for fname in fnames if fname not in known]
+
+#==============================================================================
+#================================ Index Folder ================================
+#==============================================================================
+
+    def index_folder(self, folder, kind='spectra', status=None):
+
+        '''
+        Function to add any files in a folder that are not yet catalogued, for
+        example files created before the catalog existed
+
+        **Parameters:**
+
+        folder : str
+            File path to the folder
+
+        kind : str, optional
+            The type of files in the folder, "spectra" or "so2"
+
+        status : str, optional
+            The status to give the new files
+
+        **Returns:**
+
+        new_fpaths : list
+            File paths of the newly catalogued files
+        '''
+
+        fnames = sorted(os.listdir(folder))
+        new_fnames = self.missing_fnames(fnames, local_dir=folder)
+        new_fpaths = [os.path.join(folder, fname) for fname in new_fnames]
+
+        for fpath in new_fpaths:
+            self.add_file(fpath, kind=kind, status=status)
+
+        return new_fpaths
+
+#==============================================================================
+#=================================== Get Row ==================================
+#==============================================================================
+
+    def get(self, fpath):
+
+        '''
+        Function to return the catalog entry of a file as a dictionary, or None
+        if it is not catalogued
+        '''
+
+        with self._connect() as conn:
+            row = conn.execute(f'''SELECT {', '.join(self.columns)} FROM scans
+                                   WHERE path = ?''', [fpath]).fetchone()
+
+        if row is None:
+            return None
+
+        return dict(zip(self.columns, row))
+
+#==============================================================================
+#================================= File Dir ===================================
+#==============================================================================
+
+def _file_dir(fpath):
+
+    '''Get the normalised folder of a file path, as held in the catalog'''
+
+    return os.path.dirname(os.path.normpath(fpath.replace('\\', '/')))
+
+#==============================================================================
+#================================ Isoformat ===================================
+#==============================================================================
+
+def _isoformat(timestamp):
+
+    '''Convert a datetime to an ISO string, passing through None'''
+
+    if timestamp is None:
+        return None
+
+    return timestamp.isoformat()
+
+#==============================================================================
+#=========================== Open Catalog Logged ==============================
+#==============================================================================
+
+def open_catalog(db_path):
+
+    '''
+    Function to open a catalog, logging rather than raising if it cannot be
+    opened so that acquisition and analysis carry on without it
+
+    **Parameters:**
+
+    db_path : str or None
+        File path to the SQLite database. If None then None is returned
+
+    **Returns:**
+
+    catalog : ScanCatalog or None
+        The opened catalog
+    '''
+
+    if db_path is None:
+        return None
+
+    try:
+        return ScanCatalog(db_path)
+    except sqlite3.Error:
+        logging.warning('Failed to open scan catalog', exc_info=True)
+        return None
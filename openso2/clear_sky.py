@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Module to hold a library of measured clear sky spectra, used as the reference
+spectra when a scan has no plume free spectrum of its own.
+"""
+
+import os
+import logging
+import numpy as np
+
+#==============================================================================
+#============================== Clear Sky Library =============================
+#==============================================================================
+
+class ClearSkyLibrary:
+
+    '''
+    Library of clear sky spectra keyed by the scanner motor position. Each
+    entry holds the latest plume free spectrum measured at that position,
+    corrected for the dark and flat in the fit window, and the time it was
+    measured. Entries older than the maximum age are not used.
+
+    As each scan is analysed in its own process the library can be kept in a
+    file, which is reloaded before and saved after each scan.
+
+    The settings used are:
+        - clear_sky_max_age (optional): time after which a clear sky
+          spectrum is not used (s). Default is 3600
+
+    **Parameters:**
+
+    settings : dict
+        Dictionary of station settings
+
+    fpath : str, optional
+        The .npz file in which the library is kept
+    '''
+
+    def __init__(self, settings, fpath=None):
+
+        self.max_age = settings.get('clear_sky_max_age', 3600)
+        self.fpath = fpath
+
+        # Entries are held as {motor_pos: [spec, timestamp]}
+        self.entries = {}
+
+#==============================================================================
+#===================================== Add ====================================
+#==============================================================================
+
+    def add(self, motor_pos, spec, timestamp):
+
+        '''
+        Function to add a clear sky spectrum to the library, replacing any
+        older entry at the same motor position
+
+        **Parameters:**
+
+        motor_pos : int
+            The scanner motor position of the spectrum
+
+        spec : array
+            The spectrum, corrected for the dark and flat in the fit window
+
+        timestamp : float
+            Time the spectrum was measured, as given by datetime.timestamp()
+
+        **Returns:**
+
+        None
+        '''
+
+        key = int(motor_pos)
+        if key in self.entries and self.entries[key][1] > timestamp:
+            return
+
+        self.entries[key] = [np.array(spec, dtype=float), float(timestamp)]
+
+#==============================================================================
+#===================================== Get ====================================
+#==============================================================================
+
+    def get(self, motor_pos, timestamp, n_pixels=None):
+
+        '''
+        Function to get the clear sky spectrum measured at a motor position
+        within the maximum age of a time
+
+        **Parameters:**
+
+        motor_pos : int
+            The scanner motor position
+
+        timestamp : float
+            The time of the spectrum to be fitted
+
+        n_pixels : int, optional
+            If given only spectra of this length are returned, so entries from
+            a different fit window are not used
+
+        **Returns:**
+
+        spec : array or None
+            The clear sky spectrum, or None if there is no recent entry
+        '''
+
+        entry = self.entries.get(int(motor_pos))
+        if entry is None or abs(timestamp - entry[1]) > self.max_age:
+            return None
+        if n_pixels is not None and len(entry[0]) != n_pixels:
+            return None
+
+        return entry[0]
+
+#==============================================================================
+#================================ Save and Load ===============================
+#==============================================================================
+
+    def save(self):
+
+        '''
+        Function to save the library to its file, if it has one. The file is
+        replaced in one step so a reader never sees it half written
+
+        **Returns:**
+
+        None
+        '''
+
+        keys = list(self.entries.keys())
+        if self.fpath is None or len(keys) == 0:
+            return
+
+        folder = os.path.dirname(self.fpath)
+        if folder != '':
+            os.makedirs(folder, exist_ok=True)
+
+        tmp_fpath = f'{self.fpath}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_fpath,
+                 keys=np.array(keys, dtype=int),
+                 specs=np.array([self.entries[k][0] for k in keys]),
+                 timestamps=np.array([self.entries[k][1] for k in keys]))
+        os.replace(tmp_fpath, self.fpath)
+
+    def load(self):
+
+        '''
+        Function to load the entries saved in the library file, keeping any
+        newer entries already held
+
+        **Returns:**
+
+        None
+        '''
+
+        if self.fpath is None or not os.path.isfile(self.fpath):
+            return
+
+        try:
+            data = np.load(self.fpath)
+        except (OSError, ValueError):
+            logging.warning(f'Failed to load clear sky library {self.fpath}')
+            return
+
+        for key, spec, timestamp in zip(data['keys'], data['specs'],
+                                        data['timestamps']):
+            self.add(key, spec, timestamp)
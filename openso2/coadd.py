@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Module to average (coadd) spectrometer readouts as they are taken, rejecting
+spikes and estimating the noise of the averaged spectrum.
+"""
+
+import numpy as np
+
+#==============================================================================
+#============================== Coadd Accumulator =============================
+#==============================================================================
+
+class CoaddAccumulator:
+
+    '''
+    Streaming coadder. Each readout is added to a running mean and variance
+    for every pixel (Welford's algorithm) held in preallocated arrays, so the
+    memory used does not depend on the number of coadds.
+
+    Once a few readouts have been taken, pixels that lie too far from the
+    running mean (e.g. cosmic ray hits) are left out of the average. If too
+    many pixels of one readout are rejected (e.g. a USB glitch) the whole
+    readout is dropped.
+
+    **Parameters:**
+
+    n_pixels : int
+        Number of pixels in each readout
+
+    spike_sigma : float, optional
+        Distance from the running mean, in standard deviations, beyond which a
+        pixel is rejected. Default is 6
+
+    glitch_fraction : float, optional
+        Fraction of rejected pixels above which a whole readout is dropped.
+        Default is 0.1
+
+    min_reads : int, optional
+        Number of readouts needed before spikes are rejected. Default is 3
+    '''
+
+    def __init__(self, n_pixels, spike_sigma=6, glitch_fraction=0.1,
+                 min_reads=3):
+
+        self.n_pixels = n_pixels
+        self.spike_sigma = spike_sigma
+        self.glitch_fraction = glitch_fraction
+        self.min_reads = max(min_reads, 2)
+
+        # Running statistics for each pixel
+        self._mean = np.zeros(n_pixels)
+        self.mean = self._mean
+        self.m2 = np.zeros(n_pixels)
+        self.count = np.zeros(n_pixels)
+
+        # Work arrays
+        self._delta = np.zeros(n_pixels)
+        self._limit = np.zeros(n_pixels)
+        self._keep = np.zeros(n_pixels, dtype=bool)
+
+        self.reset()
+
+#==============================================================================
+#==================================== Reset ===================================
+#==============================================================================
+
+    def reset(self, out=None):
+
+        '''
+        Function to start a new spectrum
+
+        **Parameters:**
+
+        out : array, optional
+            Array to accumulate the mean into, e.g. a row of the scan array.
+            If None an internal array is used
+
+        **Returns:**
+
+        None
+        '''
+
+        self.mean = self._mean if out is None else out
+        self.mean[:] = 0
+        self.m2[:] = 0
+        self.count[:] = 0
+        self.n_reads = 0
+        self.n_dropped = 0
+        self.n_rejected = 0
+
+#==============================================================================
+#===================================== Add ====================================
+#==============================================================================
+
+    def add(self, readout):
+
+        '''
+        Function to add a readout to the average
+
+        **Parameters:**
+
+        readout : array
+            The spectrometer readout
+
+        **Returns:**
+
+        accepted : bool
+            False if the readout was dropped as a glitch
+        '''
+
+        delta = np.subtract(readout, self.mean, out=self._delta)
+
+        # Find the pixels to keep, once the spread is known
+        keep = self._keep
+        if self.n_reads >= self.min_reads:
+
+            # Spike limit from the spread, with a shot noise floor so a very
+            #  stable pixel is not rejected
+            limit = np.divide(self.m2, np.maximum(self.count - 1, 1),
+                              out=self._limit)
+            np.maximum(limit, np.abs(self.mean), out=limit)
+            np.sqrt(limit, out=limit)
+            limit *= self.spike_sigma
+            np.less_equal(np.abs(delta), limit, out=keep)
+
+            n_reject = self.n_pixels - np.count_nonzero(keep)
+            if n_reject > self.glitch_fraction * self.n_pixels:
+                self.n_dropped += 1
+                return False
+            self.n_rejected += n_reject
+
+        else:
+            keep[:] = True
+
+        # Update the running mean and variance of the kept pixels
+        self.count += keep
+        delta *= keep
+        self.mean += delta / np.maximum(self.count, 1)
+        self.m2 += delta * (readout - self.mean)
+        self.n_reads += 1
+
+        return True
+
+#==============================================================================
+#================================= Statistics =================================
+#==============================================================================
+
+    def std(self):
+
+        '''Return the standard deviation of the readouts for each pixel'''
+
+        return np.sqrt(self.m2 / np.maximum(self.count - 1, 1))
+
+    def noise(self):
+
+        '''
+        Function to estimate the noise of the averaged spectrum, as the median
+        standard error of the mean across the pixels. Returns nan if fewer
+        than two readouts were taken
+        '''
+
+        if self.n_reads < 2:
+            return np.nan
+
+        return float(np.median(self.std() / np.sqrt(self.count)))
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Module to hold a library of dark spectra, so that darks can be reused across
+scans rather than measured at the start of every scan.
+"""
+
+import os
+import time
+import logging
+import numpy as np
+
+#==============================================================================
+#================================ Dark Library ================================
+#==============================================================================
+
+class DarkLibrary:
+
+    '''
+    Library of dark spectra keyed by integration time and coadds. Each entry
+    records when it was measured and, if known, the detector temperature. An
+    entry is fresh until it is older than the refresh period or the detector
+    temperature has moved too far, after which it should be remeasured.
+
+    Darks for integration times without an entry are interpolated, pixel by
+    pixel, between the nearest fresh entries either side, since the dark
+    signal is an offset plus a dark current that grows linearly with the
+    integration time.
+
+    The settings used are:
+        - dark_refresh (optional): time after which a dark is remeasured (s).
+          Default is 1800
+        - dark_max_temp_diff (optional): change in detector temperature after
+          which a dark is remeasured (degC). Default is 2
+        - dark_coadds (optional): the number of coadds used to measure each
+          dark. Default is the coadds setting
+
+    **Parameters:**
+
+    settings : dict
+        Dictionary of station settings
+    '''
+
+    def __init__(self, settings):
+
+        self.refresh = settings.get('dark_refresh', 1800)
+        self.max_temp_diff = settings.get('dark_max_temp_diff', 2)
+        self.coadds = settings.get('dark_coadds', settings.get('coadds', 1))
+
+        # Entries are held as {(int_time, coadds): [spec, timestamp, temp]}
+        self.entries = {}
+
+#==============================================================================
+#===================================== Add ====================================
+#==============================================================================
+
+    def add(self, spec, int_time, coadds, temperature=None, timestamp=None):
+
+        '''
+        Function to add a measured dark to the library, replacing any entry
+        with the same integration time and coadds
+
+        **Parameters:**
+
+        spec : array
+            The dark spectrum, averaged over the coadds
+
+        int_time : float
+            Integration time of the dark (ms)
+
+        coadds : int
+            Number of coadds averaged in the dark
+
+        temperature : float, optional
+            Detector temperature when the dark was measured (degC)
+
+        timestamp : float, optional
+            Time the dark was measured, as given by time.time(). Defaults to
+            now
+
+        **Returns:**
+
+        None
+        '''
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        self.entries[(float(int_time), int(coadds))] = \
+            [np.array(spec, dtype=float), timestamp, temperature]
+
+        # Drop entries that are well out of date
+        self.entries = {key: val for key, val in self.entries.items()
+                        if timestamp - val[1] < 2 * self.refresh}
+
+#==============================================================================
+#=================================== Fresh ====================================
+#==============================================================================
+
+    def _fresh(self, entry, temperature=None, now=None):
+
+        '''Check if an entry can still be used'''
+
+        if now is None:
+            now = time.time()
+
+        spec, timestamp, temp = entry
+
+        if abs(now - timestamp) > self.refresh:
+            return False
+
+        if temperature is not None and temp is not None \
+                and abs(temperature - temp) > self.max_temp_diff:
+            return False
+
+        return True
+
+    def is_fresh(self, int_time, coadds=None, temperature=None):
+
+        '''
+        Function to check if the library holds a fresh dark for an integration
+        time, without interpolating
+
+        **Parameters:**
+
+        int_time : float
+            Integration time (ms)
+
+        coadds : int, optional
+            Number of coadds. Defaults to the dark_coadds setting
+
+        temperature : float, optional
+            Current detector temperature (degC)
+
+        **Returns:**
+
+        fresh : bool
+            True if a fresh entry exists
+        '''
+
+        if coadds is None:
+            coadds = self.coadds
+
+        entry = self.entries.get((float(int_time), int(coadds)))
+
+        return entry is not None and self._fresh(entry, temperature)
+
+#==============================================================================
+#===================================== Get ====================================
+#==============================================================================
+
+    def get(self, int_time, coadds=None, temperature=None, now=None):
+
+        '''
+        Function to get the dark spectrum for an integration time. A fresh
+        entry with matching integration time (and coadds if given) is returned
+        directly, otherwise the dark is interpolated from the fresh entries
+        either side.
+
+        **Parameters:**
+
+        int_time : float
+            Integration time (ms)
+
+        coadds : int, optional
+            Number of coadds. If given an entry with matching coadds is
+            preferred
+
+        temperature : float, optional
+            Current detector temperature (degC)
+
+        now : float, optional
+            The time the dark is needed for, as given by time.time(), e.g.
+            the time of a scan being reanalysed. Defaults to now
+
+        **Returns:**
+
+        dark : array or None
+            The dark spectrum, or None if no fresh darks cover the
+            integration time
+        '''
+
+        int_time = float(int_time)
+        if now is None:
+            now = time.time()
+
+        # Find the fresh entries, keeping the most averaged for each
+        #  integration time
+        fresh = {}
+        for (t, n), entry in self.entries.items():
+            if not self._fresh(entry, temperature, now):
+                continue
+            if t not in fresh or n > fresh[t][0]:
+                fresh[t] = [n, entry[0]]
+
+        # Check for an exact match
+        if coadds is not None:
+            entry = self.entries.get((int_time, int(coadds)))
+            if entry is not None and self._fresh(entry, temperature, now):
+                return entry[0]
+        if int_time in fresh:
+            return fresh[int_time][1]
+
+        # Otherwise interpolate between the nearest entries either side
+        lower = [t for t in fresh if t < int_time]
+        upper = [t for t in fresh if t > int_time]
+        if len(lower) == 0 or len(upper) == 0:
+            return None
+
+        t0 = max(lower)
+        t1 = min(upper)
+        w = (int_time - t0) / (t1 - t0)
+
+        return (1 - w) * fresh[t0][1] + w * fresh[t1][1]
+
+#==============================================================================
+#================================ Save and Load ===============================
+#==============================================================================
+
+    def save(self, fpath):
+
+        '''
+        Function to save the library to a numpy .npz file, so it can be
+        reloaded when the program restarts
+
+        **Parameters:**
+
+        fpath : str
+            File path to save to
+
+        **Returns:**
+
+        None
+        '''
+
+        keys = list(self.entries.keys())
+        if len(keys) == 0:
+            return
+
+        folder = os.path.dirname(fpath)
+        if folder != '':
+            os.makedirs(folder, exist_ok=True)
+
+        temps = [np.nan if self.entries[k][2] is None else self.entries[k][2]
+                 for k in keys]
+
+        np.savez(fpath,
+                 keys=np.array(keys, dtype=float),
+                 specs=np.array([self.entries[k][0] for k in keys]),
+                 timestamps=np.array([self.entries[k][1] for k in keys]),
+                 temps=np.array(temps, dtype=float))
+
+    def load(self, fpath):
+
+        '''
+        Function to load entries saved with save. Stale entries are kept, but
+        are not used until remeasured
+
+        **Parameters:**
+
+        fpath : str
+            File path to the saved library
+
+        **Returns:**
+
+        None
+        '''
+
+        if not os.path.isfile(fpath):
+            return
+
+        try:
+            data = np.load(fpath)
+        except (OSError, ValueError):
+            logging.warning(f'Failed to load dark library {fpath}')
+            return
+
+        for [t, n], spec, timestamp, temp in zip(data['keys'], data['specs'],
+                                                 data['timestamps'],
+                                                 data['temps']):
+            temp = None if np.isnan(temp) else float(temp)
+            self.entries[(float(t), int(n))] = [spec, float(timestamp), temp]
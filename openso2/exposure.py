@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Module to control the spectrometer exposure (integration time) from the
+intensities measured during each scan.
+"""
+
+import logging
+import numpy as np
+
+#==============================================================================
+#=============================== Snap Int Time ================================
+#==============================================================================
+
+def snap_int_time(int_time, settings):
+
+    '''
+    Function to round an integration time to the nearest allowed value, set by
+    the min_int_time, max_int_time and int_time_step settings
+
+    **Parameters:**
+
+    int_time : float
+        The integration time in ms
+
+    settings : dict
+        Dictionary of station settings
+
+    **Returns:**
+
+    int_time : int
+        The nearest allowed integration time in ms
+    '''
+
+    lo = settings['min_int_time']
+    hi = settings['max_int_time']
+    step = settings['int_time_step']
+
+    # Round to the nearest step, keeping within the limits
+    n = np.round((int_time - lo) / step)
+    n = np.clip(n, 0, (hi - lo) // step)
+
+    return int(lo + n * step)
+
+#==============================================================================
+#============================= Exposure Controller ============================
+#==============================================================================
+
+class ExposureController:
+
+    '''
+    Predicts the integration time of the next scan from the peak intensities
+    of recent scans. The sky brightness (peak counts per ms of integration) is
+    tracked with double exponential (Holt) smoothing, so that a steady change
+    in brightness, e.g. as cloud moves in, is followed without lag while noise
+    between scans is damped.
+
+    The settings used are:
+        - target_int: the target peak intensity
+        - min_int_time, max_int_time, int_time_step: the allowed integration
+          times (ms)
+        - exposure_alpha (optional): smoothing of the brightness level, 0 - 1.
+          Default is 0.6
+        - exposure_beta (optional): smoothing of the brightness trend, 0 - 1.
+          Default is 0.3
+        - exposure_damping (optional): damping of the trend when predicting
+          the next scan, 0 - 1. Default is 0.5
+        - saturation_int (optional): intensity above which a spectrum is
+          treated as saturated. Default is 65000
+
+    **Parameters:**
+
+    settings : dict
+        Dictionary of station settings
+    '''
+
+    def __init__(self, settings):
+
+        self.settings = settings
+        self.alpha = settings.get('exposure_alpha', 0.6)
+        self.beta = settings.get('exposure_beta', 0.3)
+        self.damping = settings.get('exposure_damping', 0.5)
+        self.saturation = settings.get('saturation_int', 65000)
+
+        # The smoothed brightness and its trend (counts/ms per scan)
+        self.level = None
+        self.trend = 0.0
+
+#==============================================================================
+#=================================== Update ===================================
+#==============================================================================
+
+    def update(self, peak_int, int_time):
+
+        '''
+        Function to update the controller with the peak intensity of the last
+        scan and predict the next integration time
+
+        **Parameters:**
+
+        peak_int : float
+            Peak intensity measured during the last scan
+
+        int_time : float
+            Integration time of the last scan (ms)
+
+        **Returns:**
+
+        new_int_time : int
+            Integration time for the next scan (ms)
+        '''
+
+        brightness = peak_int / int_time
+
+        if self.level is None:
+            # First scan, start from the measured brightness
+            self.level = brightness
+            self.trend = 0.0
+
+        elif peak_int >= self.saturation:
+            # The brightness is at least the measured value. Reset rather than
+            #  smooth so the exposure drops straight away
+            self.level = max(brightness, self.level + self.trend) * 2
+            self.trend = 0.0
+            brightness = self.level
+
+        else:
+            last_level = self.level
+            self.level = self.alpha * brightness \
+                         + (1 - self.alpha) * (self.level + self.trend)
+            self.trend = self.beta * (self.level - last_level) \
+                         + (1 - self.beta) * self.trend
+
+        # Predict the brightness of the next scan, not letting it fall below
+        #  half the measured value
+        forecast = max(self.level + self.damping * self.trend,
+                       0.5 * brightness, 1e-6)
+
+        # Scale the integration time to reach the target intensity
+        new_int_time = snap_int_time(self.settings['target_int'] / forecast,
+                                     self.settings)
+
+        # Log change
+        logging.info(f'Updated integration time to {new_int_time} ms')
+
+        return new_int_time
+
+#==============================================================================
+#============================ Angle Exposure Table ============================
+#==============================================================================
+
+class AngleExposureTable:
+
+    '''
+    Table of integration times for each step of the scan, learned from the
+    sky brightness measured at each angle in previous scans. This allows the
+    bright sky near the zenith and the darker sky near the horizon to both be
+    exposed close to the target intensity.
+
+    The settings used are those of ExposureController, plus:
+        - angle_exposure_alpha (optional): smoothing of the brightness at each
+          angle between scans, 0 - 1. Default is 0.5
+
+    **Parameters:**
+
+    settings : dict
+        Dictionary of station settings
+    '''
+
+    def __init__(self, settings):
+
+        self.settings = settings
+        self.alpha = settings.get('angle_exposure_alpha', 0.5)
+        self.saturation = settings.get('saturation_int', 65000)
+
+        # Smoothed brightness (counts/ms) at each step, nan until measured
+        self.brightness = np.full(settings['specs_per_scan'], np.nan)
+
+#==============================================================================
+#=================================== Update ===================================
+#==============================================================================
+
+    def update(self, peaks, int_times):
+
+        '''
+        Function to update the table with the intensities of the last scan
+
+        **Parameters:**
+
+        peaks : array
+            Peak intensity of each spectrum in the scan
+
+        int_times : array
+            Integration time (ms) of each spectrum in the scan
+
+        **Returns:**
+
+        None
+        '''
+
+        brightness = np.divide(peaks, int_times)
+
+        # Saturated spectra only give a lower limit, so double it to make
+        #  sure the exposure drops
+        saturated = np.asarray(peaks) >= self.saturation
+        brightness[saturated] *= 2
+
+        # Smooth with the previous scans, replacing unmeasured or saturated
+        #  steps
+        new = np.logical_or(np.isnan(self.brightness), saturated)
+        self.brightness = np.where(new, brightness,
+                                   self.alpha * brightness
+                                   + (1 - self.alpha) * self.brightness)
+
+#==============================================================================
+#================================= Int Times ==================================
+#==============================================================================
+
+    def int_times(self, default_int_time):
+
+        '''
+        Function to get the integration time for each step of the next scan
+
+        **Parameters:**
+
+        default_int_time : int
+            Integration time (ms) used for steps with no measured brightness,
+            and for the dark spectrum (step 0)
+
+        **Returns:**
+
+        int_times : array
+            Integration time (ms) for each step of the scan
+        '''
+
+        int_times = np.full(len(self.brightness), default_int_time)
+
+        for n, b in enumerate(self.brightness):
+            if n > 0 and np.isfinite(b) and b > 0:
+                int_times[n] = snap_int_time(self.settings['target_int'] / b,
+                                             self.settings)
+
+        return int_times
@@ -2,10 +2,12 @@
 Contains functions to fit UV spectra to retrieve volcanic SO2 slant column densities.
 """
 
+import time
 import logging
 import numpy as np
 from scipy.interpolate import griddata
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, least_squares
+from scipy.ndimage import uniform_filter1d
 
 #==============================================================================
 #================================= make_poly ==================================
@@ -39,11 +41,19 @@ def make_poly(grid, coefs):
 
     return poly
 
+#==============================================================================
+#============================= FitBudgetExceeded ==============================
+#==============================================================================
+
+class FitBudgetExceeded(Exception):
+
+    '''Raised to stop a fit that has run out of time'''
+
 #==============================================================================
 #================================== fit_spec ==================================
 #==============================================================================
 
-def fit_spec(common, spectrum, grid):
+def fit_spec(common, spectrum, grid, fit_info=None):
 
     '''
     Function to fit measured spectrum using a full forward model including a 
@@ -62,8 +72,27 @@ def fit_spec(common, spectrum, grid):
     grid : 1D array
         Measurement wavelength grid over which the fit occurs
 
-    q : queue (optional)
-        Queue to which to add the output if threaded (default = None)
+    fit_info : dict (optional)
+        If given, filled with details of the fit:
+            - fit_time: wall time of the fit (s)
+            - nfev: number of forward model evaluations
+            - fit_cost: final cost, half the sum of the squared residuals
+            - fit_status: why the fit stopped, one of "converged",
+              "max_evals", "time_budget", "error" or "low_intensity"
+            - budget_limited: whether the fit ran out of evaluations or time
+
+    The fit is limited by the optional common entries fit_maxfev (maximum
+    forward model evaluations), fit_time_limit (maximum wall time, s) and
+    fit_tol (convergence tolerance). A fit stopped by these is flagged as
+    failed, but returns the best parameters found with nan errors.
+
+    Parameters can be held fixed with the common entry fixed_params, a dict
+    of {parameter index: value}. These are returned with nan errors.
+
+    The solver is chosen by the common entry fit_solver, one of the SOLVERS:
+        - "curve_fit": scipy curve_fit on all the parameters (default)
+        - "least_squares": scipy least_squares, see solve_least_squares
+        - "varpro": variable projection, see fit_varpro
 
     **Returns:**
         
@@ -101,33 +130,95 @@ def fit_spec(common, spectrum, grid):
     # Divide by flat spectrum
     y = np.divide(y, common['flat'])
 
+    # Get the solver
+    solver_name = common.get('fit_solver') or 'curve_fit'
+    if solver_name not in SOLVERS:
+        raise ValueError(f'Fit solver {solver_name} not recognised. Must be '
+                         + f'one of {list(SOLVERS)}')
+    solver = SOLVERS[solver_name]
+
+    # Get the fit time budget (s)
+    time_limit = common.get('fit_time_limit')
+
+    # Hold any fixed parameters at their values, fitting only the rest
+    fixed = common.get('fixed_params') or {}
+    p0 = np.array(common['params'], dtype=float)
+    for i, val in fixed.items():
+        p0[i] = val
+    free = np.array([i not in fixed for i in range(len(p0))])
+
+    def full_params(free_params):
+        params = p0.copy()
+        params[free] = free_params
+        return params
+
+    t0 = time.perf_counter()
+    cost = np.nan
+
+    # Count the forward model evaluations, keeping the best parameters found
+    #  in case the fit is stopped early
+    nfev = [0]
+    best = [np.inf, None]
+    def count_eval():
+        if time_limit is not None and time.perf_counter() - t0 > time_limit:
+            raise FitBudgetExceeded()
+        nfev[0] += 1
+
+    def fwd_model(grid, *free_params):
+        count_eval()
+        params = full_params(free_params)
+        fit = ifit_fwd_model(grid, *params)
+        resid = np.sum(np.subtract(y, fit)**2)
+        if resid < best[0]:
+            best[:] = [resid, params]
+        return fit
+
     # Appempt to fit!
     if not np.any(y == 0) and max(y) > 3000:
         try:
             # Fit
-            popt, pcov = curve_fit(ifit_fwd_model, 
-                                   grid, 
-                                   y, 
-                                   p0 = common['params'])
+            popt, perr, cost = solver(fwd_model, grid, y, p0, free, common,
+                                      count_eval)
 
-            # Get fit errors
-            perr = np.sqrt(np.diag(pcov))
+            # Find the final cost if the solver does not give it
+            if fit_info is not None and np.isnan(cost):
+                cost = 0.5 * np.sum(np.subtract(y, ifit_fwd_model(grid,
+                                                                  *popt))**2)
 
             # Fit successful
             fitted_flag = True
+            status = 'converged'
 
         # If fit fails, report and carry on
-        except (RuntimeError, ValueError, np.linalg.linalg.LinAlgError):
-
-            # Fill returned arrays with nans
-            popt = np.full(len(common['params']), np.nan)
+        except (RuntimeError, ValueError, np.linalg.LinAlgError,
+                FitBudgetExceeded) as e:
+
+            # Find why the fit stopped
+            if isinstance(e, FitBudgetExceeded):
+                status = 'time_budget'
+            elif isinstance(e, RuntimeError) and 'maxfev' in str(e):
+                status = 'max_evals'
+            else:
+                status = 'error'
+
+            # Fill returned arrays with nans, or the best parameters found if
+            #  the fit ran out of budget
+            if status != 'error' and best[1] is not None:
+                popt = np.array(best[1], dtype=float)
+                cost = 0.5 * best[0]
+            else:
+                popt = np.full(len(common['params']), np.nan)
             perr = np.full(len(common['params']), np.nan)
 
             # Turn off fitted flag
             fitted_flag = False
 
             # Log
-            logging.warning('Fit failed')
+            if status == 'error' or best[1] is None:
+                logging.warning(f'Fit failed ({status})')
+            else:
+                logging.info(f'Fit stopped ({status}), keeping the best '
+                             + 'parameters found')
 
     else:
         # Fill returned arrays with nans
@@ -136,20 +227,728 @@ def fit_spec(common, spectrum, grid):
 
         # Turn off fitted flag
         fitted_flag = False
+        status = 'low_intensity'
 
         # Log
         logging.warning('Intensity too low')
 
+    # Record the fit details
+    if fit_info is not None:
+        fit_info['fit_time'] = time.perf_counter() - t0
+        fit_info['nfev'] = nfev[0]
+        fit_info['fit_cost'] = cost
+        fit_info['fit_status'] = status
+        fit_info['budget_limited'] = status in ['max_evals', 'time_budget']
+
     # Return results, either to a queue if threaded, or as an array if not
     return popt, perr, fitted_flag
 
 
+#==============================================================================
+#=================================== Solvers ==================================
+#==============================================================================
+
+# Names of the fit parameters, in the order of ifit_fwd_model, for the default
+#  absorbers
+PARAM_NAMES = ['p0', 'p1', 'p2', 'p3', 'shift', 'stretch', 'ring', 'so2',
+               'no2', 'o3']
+
+# Each solver is called as solver(fwd_model, grid, y, p0, free, common, count)
+#  where fwd_model(grid, *params) gives the model for the free parameters,
+#  p0 holds all the first guess parameters, free is a bool array of the
+#  parameters to fit and count is called for each model evaluation made
+#  outside fwd_model. Solvers return the full popt and perr, with nan errors
+#  for fixed parameters, and the final cost (nan if not known). They raise
+#  RuntimeError, with "maxfev" in the message if the evaluation limit is
+#  reached, ValueError or LinAlgError if the fit fails.
+
+def _expand(values, free, fill):
+
+    '''Put values for the free parameters into a full parameter array'''
+
+    full = np.array(fill, dtype = float) if np.ndim(fill) \
+        else np.full(len(free), fill, dtype = float)
+    full[free] = values
+    return full
+
+def solve_curve_fit(fwd_model, grid, y, p0, free, common, count = None):
+
+    '''
+    Solver fitting all the free parameters with scipy curve_fit, limited by
+    the common entries fit_maxfev and fit_tol
+    '''
+
+    kwargs = {}
+    if common.get('fit_maxfev'):
+        kwargs['maxfev'] = int(common['fit_maxfev'])
+    if common.get('fit_tol'):
+        kwargs['ftol'] = common['fit_tol']
+        kwargs['xtol'] = common['fit_tol']
+
+    popt, pcov = curve_fit(fwd_model, grid, y, p0 = p0[free], **kwargs)
+
+    return _expand(popt, free, p0), _expand(np.sqrt(np.diag(pcov)), free,
+                                            np.nan), np.nan
+
+def solve_least_squares(fwd_model, grid, y, p0, free, common, count = None):
+
+    '''
+    Solver fitting all the free parameters with scipy least_squares, with the
+    parameters scaled so the steps are well conditioned. The common entries
+    used are:
+        - fit_method: "trf" (default), "dogbox" or "lm". Bounds need "trf"
+          or "dogbox"
+        - fit_x_scale: "jac" to scale by the Jacobian column norms
+          (default), "params" to scale by the size of the first guess, or a
+          number
+        - fit_bounds: dict of {parameter index: (lower, upper)}, see
+          parse_bounds
+        - fit_ftol, fit_xtol, fit_gtol: the tolerances. Default 1e-8. These
+          are all replaced by fit_tol if it is set
+        - fit_maxfev: the maximum number of model evaluations
+    '''
+
+    x0 = p0[free]
+    method = common.get('fit_method', 'trf')
+
+    # Scale the parameters
+    x_scale = common.get('fit_x_scale', 'jac')
+    if x_scale == 'params':
+        x_scale = np.where(np.abs(x0) > 0, np.abs(x0), 1.0)
+    elif x_scale != 'jac':
+        x_scale = float(x_scale)
+
+    # Set the bounds, which lm cannot use
+    bounds = (-np.inf, np.inf)
+    fit_bounds = common.get('fit_bounds') or {}
+    if len(fit_bounds) > 0:
+        lower = np.full(len(free), -np.inf)
+        upper = np.full(len(free), np.inf)
+        for i, (lo, hi) in fit_bounds.items():
+            lower[i], upper[i] = lo, hi
+        bounds = (lower[free], upper[free])
+        x0 = np.clip(x0, bounds[0], bounds[1])
+        if method == 'lm':
+            method = 'trf'
+
+    # Set the tolerances and evaluation limit
+    tols = {key: common.get(f'fit_{key}', 1e-8)
+            for key in ['ftol', 'xtol', 'gtol']}
+    if common.get('fit_tol'):
+        tols = {key: common['fit_tol'] for key in tols}
+    max_nfev = int(common['fit_maxfev']) if common.get('fit_maxfev') else None
+
+    result = least_squares(lambda p: fwd_model(grid, *p) - y, x0,
+                           method = method, x_scale = x_scale,
+                           bounds = bounds, max_nfev = max_nfev, **tols)
+
+    if result.status == 0:
+        raise RuntimeError('Number of evaluations has reached maxfev')
+    if not result.success:
+        raise RuntimeError(result.message)
+
+    # Find the covariance from the Jacobian, as curve_fit does, scaling the
+    #  columns so small singular values are not lost
+    norms = np.linalg.norm(result.jac, axis = 0)
+    norms[norms == 0] = 1
+    U, sv, VT = np.linalg.svd(result.jac / norms, full_matrices = False)
+    keep = sv > np.finfo(float).eps * max(result.jac.shape) * sv[0]
+    VT = VT[keep] / sv[keep, None]
+    dof = max(len(y) - len(x0), 1)
+    pcov = VT.T @ VT * 2 * result.cost / dof / np.outer(norms, norms)
+
+    return _expand(result.x, free, p0), _expand(np.sqrt(np.diag(pcov)), free,
+                                                np.nan), result.cost
+
+def solve_varpro(fwd_model, grid, y, p0, free, common, count = None):
+
+    '''
+    Solver using variable projection, see fit_varpro. The shift and stretch
+    are held fixed if either is fixed
+    '''
+
+    return fit_varpro(common, y, grid, p0, fixed_shift = not all(free[4:6]),
+                      count = count)
+
+# The available solvers, by name. Others can be added here
+SOLVERS = {'curve_fit': solve_curve_fit,
+           'least_squares': solve_least_squares,
+           'varpro': solve_varpro}
+
+def parse_bounds(text, names=PARAM_NAMES):
+
+    '''
+    Function to read parameter bounds from a settings string of the form
+    "name:lower:upper,name:lower:upper", e.g. "so2:-1e18:1e20,shift:-1:1",
+    with the parameter names
+
+    **Parameters:**
+
+    text : str
+        The bounds string. An empty string gives no bounds
+
+    names : list, optional
+        The parameter names, as held in common['param_names']. Default is
+        PARAM_NAMES
+
+    **Returns:**
+
+    bounds : dict
+        The bounds as {parameter index: (lower, upper)}
+    '''
+
+    bounds = {}
+    for item in text.split(','):
+        if item.strip() == '':
+            continue
+        name, lo, hi = item.strip().split(':')
+        bounds[names.index(name)] = (float(lo), float(hi))
+
+    return bounds
+
+#==============================================================================
+#================================= fit_varpro =================================
+#==============================================================================
+
+def fit_varpro(common, y, grid, p0, fixed_shift=False, count=None):
+
+    '''
+    Function to fit a spectrum by variable projection. Only the shift and
+    stretch are solved nonlinearly. For each trial shift and stretch the
+    polynomial and absorber amounts are solved exactly by linear least
+    squares, in log space with the model linearised about the current
+    amounts. The convolutions only depend on the amounts, so they are made
+    once per linearisation and each trial only interpolates and solves a
+    small linear system.
+
+    The linearisation is repeated about the fitted amounts (varpro_iterations
+    in common, default 2) and the polynomial is then found in intensity
+    space, so the parameters are in the form used by ifit_fwd_model.
+
+    **Parameters:**
+
+    common : dictionary
+        Common dictionary of parameters and variables passed from the main
+        program to subroutines
+
+    y : array
+        The measured spectrum, corrected for dark and flat, in the fit window
+
+    grid : array
+        Measurement wavelength grid over which the fit occurs
+
+    p0 : array
+        The first guess parameters, in the order of ifit_fwd_model
+
+    fixed_shift : bool, optional
+        If True the shift and stretch are held at their first guess, leaving
+        only the linear solve. Default is False
+
+    count : function, optional
+        Called for each trial shift and stretch, e.g. to count evaluations
+
+    **Returns:**
+
+    popt : array
+        The fitted parameters
+
+    perr : array
+        The error in the fitted parameters, nan for the shift and stretch if
+        they are fixed
+
+    cost : float
+        The final cost, half the sum of the squared intensity residuals
+    '''
+
+    if np.any(y <= 0):
+        raise ValueError('Spectrum must be positive for the log fit')
+
+    model_grid = common['model_grid']
+    line = np.linspace(0, 1, num = len(model_grid))
+    M = common['xsec_matrix']
+    log_y = np.log(y)
+
+    # The polynomial is on a scaled grid for the log fit
+    x = (grid - grid.mean()) / (grid.max() - grid.min())
+    P = np.column_stack([x**0, x, x**2, x**3])
+
+    def interp(conv, shift_stretch):
+        shift_grid = model_grid + shift_stretch[0] + line * shift_stretch[1]
+        return np.column_stack([np.interp(grid, shift_grid, c)
+                                for c in conv.T])
+
+    amts = np.array(p0[6:], dtype = float)
+    shift_stretch = np.array(p0[4:6], dtype = float)
+    jac = None
+
+    for i in range(int(common.get('varpro_iterations', 2))):
+
+        # Convolve the model and its derivative for each absorber, at the
+        #  current amounts
+        F = common['sol'] * np.exp(M @ amts)
+        conv = np.column_stack([np.convolve(v, common['ils'], 'same')
+                                for v in np.column_stack([F, F[:, None] * M]
+                                                         ).T])
+
+        def solve(shift_stretch):
+
+            '''Solve the linear parameters for a shift and stretch'''
+
+            C = interp(conv, shift_stretch)
+            A = np.column_stack([P, C[:, 1:] / C[:, :1]])
+            b = log_y - np.log(C[:, 0])
+            norms = np.linalg.norm(A, axis = 0)
+            coefs = np.linalg.lstsq(A / norms, b, rcond = None)[0]
+
+            return A, b, coefs / norms, norms
+
+        def resid(shift_stretch):
+            if count is not None:
+                count()
+            A, b, coefs, norms = solve(shift_stretch)
+            return b - A @ coefs
+
+        # Solve the shift and stretch
+        if not fixed_shift:
+            result = least_squares(resid, shift_stretch, method = 'lm',
+                                   x_scale = [0.1, 0.1])
+            shift_stretch = result.x
+            jac = result.jac
+
+        # Update the amounts
+        A, b, coefs, norms = solve(shift_stretch)
+        amts = amts + coefs[4:]
+
+    # Find the errors in the log fit
+    dof = max(len(grid) - A.shape[1] - 2, 1)
+    rms = np.sqrt(np.sum((b - A @ coefs)**2) / dof)
+    An = A / norms
+    amt_err = np.sqrt(np.diag(np.linalg.inv(An.T @ An)))[4:] / norms[4:] * rms
+    if jac is not None:
+        ss_err = np.sqrt(np.diag(np.linalg.inv(jac.T @ jac))) * rms
+    else:
+        ss_err = np.full(2, np.nan)
+
+    # Find the polynomial in intensity space at the fitted amounts
+    F = common['sol'] * np.exp(M @ amts)
+    conv = np.column_stack([np.convolve(F * model_grid**k, common['ils'],
+                                        'same') for k in range(4)])
+    B = interp(conv, shift_stretch)
+    norms = np.linalg.norm(B, axis = 0)
+    poly = np.linalg.lstsq(B / norms, y, rcond = None)[0]
+    fit = (B / norms) @ poly
+    dof = max(len(grid) - len(p0), 1)
+    s2 = np.sum((y - fit)**2) / dof
+    poly_err = np.sqrt(np.diag(np.linalg.inv((B / norms).T @ (B / norms)))
+                       * s2) / norms
+    poly = poly / norms
+
+    popt = np.concatenate([poly, shift_stretch, amts])
+    perr = np.concatenate([poly_err, ss_err, amt_err])
+    cost = 0.5 * np.sum((y - fit)**2)
+
+    return popt, perr, cost
+
+#==============================================================================
+#=============================== linearise_model ==============================
+#==============================================================================
+
+def linearise_model(common, grid):
+
+    '''
+    Function to linearise the log of the forward model about the first guess
+    amounts, on the measurement grid with the first guess shift and stretch.
+    Convolving the solar spectrum with the absorption, rather than each
+    separately, keeps the solar I0 effect out of the amounts.
+
+    **Parameters:**
+
+    common : dictionary
+        Common dictionary of parameters and variables passed from the main
+        program to subroutines
+
+    grid : 1D array
+        Measurement wavelength grid over which the fit occurs
+
+    **Returns:**
+
+    F0_conv : 1D array
+        The convolved model, without the polynomial, at the first guess
+
+    J : 2D array
+        The derivative of the log of the model with respect to the ring and
+        absorber amounts, one column for each
+    '''
+
+    # Put the reference spectra on the measurement grid
+    shift, stretch = common['params'][4], common['params'][5]
+    line = np.linspace(0, 1, num = len(common['model_grid']))
+    shift_grid = common['model_grid'] + shift + line * stretch
+
+    def convolve(spec):
+        spec_conv = np.convolve(spec, common['ils'], 'same')
+        return np.interp(grid, shift_grid, spec_conv)
+
+    M = common['xsec_matrix']
+    amts0 = np.array(common['params'][6:], dtype = float)
+    F0 = common['sol'] * np.exp(M @ amts0)
+    F0_conv = convolve(F0)
+
+    J = np.column_stack([convolve(F0 * r) / F0_conv for r in M.T])
+
+    return F0_conv, J
+
+#==============================================================================
+#================================= quick_fit ==================================
+#==============================================================================
+
+def quick_fit(common, spectra, grid):
+
+    '''
+    Function to make a fast linear retrieval for a block of spectra, used to
+    screen a scan before the full fit. The Beer-Lambert law is fitted in log
+    space, linearised about the first guess and moved onto the measurement
+    grid with the first guess shift and stretch, so all the spectra are
+    solved by one linear least squares.
+
+    **Parameters:**
+
+    common : dictionary
+        Common dictionary of parameters and variables passed from the main
+        program to subroutines
+
+    spectra : 2D array
+        The spectra, corrected for dark and flat, in the fit window. Each row
+        is one spectrum
+
+    grid : 1D array
+        Measurement wavelength grid over which the fit occurs
+
+    **Returns:**
+
+    amounts : 2D array
+        The fitted ring and absorber amounts of each spectrum. nan for
+        spectra that cannot be fitted
+
+    errors : 2D array
+        The error in the fitted amounts
+
+    resid : 1D array
+        The RMS residual of the log fit of each spectrum
+    '''
+
+    # Linearise the model about the first guess on the measurement grid
+    F0_conv, J = linearise_model(common, grid)
+    amts0 = np.array(common['params'][6:], dtype = float)
+
+    # Build the design matrix, with the polynomial on a scaled grid, and
+    #  normalise the columns so the amounts are well conditioned
+    x = (grid - grid.mean()) / (grid.max() - grid.min())
+    A = np.column_stack([x**0, x, x**2, x**3, J])
+    norms = np.linalg.norm(A, axis = 0)
+    A = A / norms
+
+    # Find the optical depth of each spectrum relative to the first guess
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        B = np.log(spectra).T - np.log(F0_conv)[:, None]
+    valid = np.all(np.isfinite(B), axis = 0)
+    B[:, ~valid] = 0
+
+    # Solve all the spectra at once
+    coefs = np.linalg.lstsq(A, B, rcond = None)[0]
+    dof = max(len(grid) - A.shape[1], 1)
+    resid = np.sqrt(np.sum((B - A @ coefs)**2, axis = 0) / dof)
+    cov_diag = np.diag(np.linalg.inv(A.T @ A))
+    errs = np.sqrt(cov_diag)[:, None] * resid[None, :]
+
+    # Unscale the amounts
+    amounts = (coefs[4:] / norms[4:, None]).T + amts0
+    errors = (errs[4:] / norms[4:, None]).T
+
+    amounts[~valid] = np.nan
+    errors[~valid] = np.nan
+    resid[~valid] = np.nan
+
+    return amounts, errors, resid
+
+#==============================================================================
+#================================ clear_sky_fit ===============================
+#==============================================================================
+
+def clear_sky_fit(common, spectra, grid, references, ref_idx):
+
+    '''
+    Function to fit a block of spectra against measured clear sky reference
+    spectra, rather than the solar spectrum. The optical depth of each
+    spectrum relative to its reference is fitted on the measurement grid with
+    a polynomial, a small wavelength shift (the derivative of the log of the
+    reference) and the ring and absorber amounts. The absorbers are
+    linearised once with linearise_model, so the spectra sharing a reference
+    are solved by one linear least squares without any convolution or
+    resampling.
+
+    The amounts are differential, relative to the reference, which is taken
+    to have no plume in it.
+
+    **Parameters:**
+
+    common : dictionary
+        Common dictionary of parameters and variables passed from the main
+        program to subroutines
+
+    spectra : 2D array
+        The spectra, corrected for dark and flat, in the fit window. Each row
+        is one spectrum
+
+    grid : 1D array
+        Measurement wavelength grid over which the fit occurs
+
+    references : 2D array
+        The reference spectra, corrected for dark and flat, in the fit window.
+        Each row is one reference
+
+    ref_idx : 1D array
+        The row of references used for each spectrum, or -1 for spectra
+        without a reference
+
+    **Returns:**
+
+    amounts : 2D array
+        The fitted ring and absorber amounts of each spectrum relative to its
+        reference. nan for spectra that cannot be fitted
+
+    errors : 2D array
+        The error in the fitted amounts
+
+    resid : 1D array
+        The RMS residual of the log fit of each spectrum
+    '''
+
+    n_amts = common['xsec_matrix'].shape[1]
+    amounts = np.full([len(spectra), n_amts], np.nan)
+    errors = np.full([len(spectra), n_amts], np.nan)
+    resid = np.full(len(spectra), np.nan)
+
+    # The absorbers are the same for all the references
+    F0_conv, J = linearise_model(common, grid)
+    x = (grid - grid.mean()) / (grid.max() - grid.min())
+
+    for r in np.unique(ref_idx):
+
+        if r < 0:
+            continue
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            log_ref = np.log(references[r])
+        if not np.all(np.isfinite(log_ref)):
+            continue
+
+        # Build the design matrix and normalise the columns
+        A = np.column_stack([x**0, x, x**2, x**3,
+                             np.gradient(log_ref, grid), J])
+        norms = np.linalg.norm(A, axis = 0)
+        A = A / norms
+
+        # Find the optical depth of each spectrum relative to the reference
+        members = np.where(ref_idx == r)[0]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            B = np.log(spectra[members]).T - log_ref[:, None]
+        valid = np.all(np.isfinite(B), axis = 0)
+        B[:, ~valid] = 0
+
+        # Solve all the spectra using this reference at once
+        coefs = np.linalg.lstsq(A, B, rcond = None)[0]
+        dof = max(len(grid) - A.shape[1], 1)
+        rms = np.sqrt(np.sum((B - A @ coefs)**2, axis = 0) / dof)
+        cov_diag = np.diag(np.linalg.inv(A.T @ A))
+
+        members = members[valid]
+        amounts[members] = (coefs[5:, valid] / norms[5:, None]).T
+        errors[members] = (np.sqrt(cov_diag[5:, None]) * rms[None, valid]
+                           / norms[5:, None]).T
+        resid[members] = rms[valid]
+
+    return amounts, errors, resid
+
+#==============================================================================
+#================================== prealign ==================================
+#==============================================================================
+
+def prealign(common, spectra, grid, n_segments=4, max_shift=1.0):
+
+    '''
+    Function to estimate the wavelength shift and stretch of a block of
+    spectra by FFT cross-correlation against the ILS convolved solar spectrum,
+    to give the nonlinear fit a starting point. The fit window is split into
+    segments, the shift of each segment is found from the peak of the
+    cross-correlation and a line through these gives the shift and stretch,
+    in the form used by ifit_fwd_model.
+
+    All the spectra are resampled, filtered and correlated together.
+
+    **Parameters:**
+
+    common : dictionary
+        Common dictionary of parameters and variables passed from the main
+        program to subroutines
+
+    spectra : 2D array
+        The spectra in the fit window. Each row is one spectrum
+
+    grid : 1D array
+        Measurement wavelength grid over which the fit occurs
+
+    n_segments : int, optional
+        Number of segments to split the window into. Default is 4
+
+    max_shift : float, optional
+        The largest shift searched for (nm). Default is 1.0
+
+    **Returns:**
+
+    shift, stretch : 1D arrays
+        The estimated shift and stretch of each spectrum
+    '''
+
+    spectra = np.atleast_2d(spectra)
+    model_grid = common['model_grid']
+
+    # Resample the spectra onto an even grid
+    step = max(model_grid[1] - model_grid[0], 0.01)
+    even_grid = np.arange(grid[0], grid[-1], step)
+    i = np.clip(np.searchsorted(grid, even_grid), 1, len(grid) - 1)
+    w = (even_grid - grid[i-1]) / (grid[i] - grid[i-1])
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        log_spec = np.log(spectra[:, i-1] * (1 - w) + spectra[:, i] * w)
+    log_spec[~np.isfinite(log_spec)] = 0
+
+    # Make the reference, including the first guess absorbers so the ozone
+    #  bands line up too. This extends past the window by the largest shift
+    amts0 = np.array(common['params'][6:], dtype = float)
+    F0 = common['sol'] * np.exp(common['xsec_matrix'] @ amts0)
+    F0_conv = np.convolve(F0, common['ils'], 'same')
+    max_lag = int(max_shift / step)
+    ref_grid = np.arange(-max_lag, len(even_grid) + max_lag) * step \
+        + even_grid[0]
+    log_ref = np.log(np.interp(ref_grid, model_grid, F0_conv))
+
+    # Remove the broadband structure, leaving the narrow lines
+    smooth = max(int(1.0 / step), 3)
+    log_spec = log_spec - uniform_filter1d(log_spec, smooth, axis = 1,
+                                           mode = 'nearest')
+    log_ref = log_ref - uniform_filter1d(log_ref, smooth, mode = 'nearest')
+
+    def find_shift(lo, hi, lag0, search):
+
+        '''Find the shift of a segment from the peak of the cross-correlation
+        of the spectra against the reference, searching lags within search
+        of lag0'''
+
+        seg_spec = log_spec[:, lo:hi] * np.hanning(hi - lo)
+        seg_ref = log_ref[lo:hi + 2*max_lag]
+
+        # Correlate, with index j holding a lag of j - max_lag
+        n_fft = hi - lo + 2 * max_lag
+        corr = np.fft.irfft(np.fft.rfft(seg_ref, n_fft)
+                            * np.conj(np.fft.rfft(seg_spec, n_fft, axis = 1)),
+                            n_fft, axis = 1)[:, 2*max_lag::-1]
+
+        # Find the peak, refined with a parabola
+        lags = np.arange(2 * max_lag + 1) - max_lag
+        outside = np.abs(lags[None, :] - lag0[:, None]) > search
+        corr[outside] = -np.inf
+        k = np.clip(np.argmax(corr, axis = 1), 1, 2 * max_lag - 1)
+        rows = np.arange(len(corr))
+        c0, c1, c2 = corr[rows, k-1], corr[rows, k], corr[rows, k+1]
+        denom = c0 - 2 * c1 + c2
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            frac = np.where(np.logical_and(np.isfinite(denom), denom < 0),
+                            0.5 * (c0 - c2) / denom, 0)
+
+        return k + frac - max_lag
+
+    # Find the overall shift from the whole window, then the shift of each
+    #  segment close to it, so the short segments cannot lock onto the
+    #  wrong line
+    n_points = len(even_grid)
+    lag0 = find_shift(0, n_points, np.zeros(len(spectra)), max_lag)
+    search = max(int(0.2 / step), 2)
+    bounds = np.linspace(0, n_points, n_segments + 1).astype(int)
+    centres = []
+    shifts = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        shifts.append(find_shift(lo, hi, np.round(lag0), search) * step)
+        centres.append(even_grid[(lo + hi) // 2])
+
+    # Fit a line through the segment shifts, in terms of the fraction along
+    #  the model grid used for the stretch
+    line = (np.array(centres) - model_grid[0]) \
+        / (model_grid[-1] - model_grid[0])
+    L = np.column_stack([np.ones(n_segments), line])
+    coefs = np.linalg.lstsq(L, np.array(shifts), rcond = None)[0]
+
+    return coefs[0], coefs[1]
+
+#==============================================================================
+#=============================== triage_spectra ===============================
+#==============================================================================
+
+def triage_spectra(so2, resid, common):
+
+    '''
+    Function to choose which spectra of a scan need the full fit, given their
+    quick fit results. These are the spectra in or near the plume, those
+    with a poor quick fit residual and those the quick fit could not fit.
+
+    The common entries used are:
+        - triage_so2: SO2 amount above which a spectrum is in the plume
+          (molecules/cm2). Default is 5e16
+        - triage_margin: number of spectra either side of the plume to fully
+          fit. Default is 3
+        - triage_resid_factor: multiple of the median scan residual above
+          which a quick fit is poor. Default is 3
+
+    **Parameters:**
+
+    so2 : 1D array
+        The quick fit SO2 amount of each spectrum
+
+    resid : 1D array
+        The quick fit RMS residual of each spectrum
+
+    common : dictionary
+        Common dictionary of parameters and variables passed from the main
+        program to subroutines
+
+    **Returns:**
+
+    full_fit : 1D bool array
+        True for spectra that need the full fit
+    '''
+
+    threshold = common.get('triage_so2', 5e16)
+    margin = int(common.get('triage_margin', 3))
+    resid_factor = common.get('triage_resid_factor', 3)
+
+    # Find the plume, widened by the margin
+    in_plume = np.nan_to_num(so2) > threshold
+    full_fit = in_plume.copy()
+    for i in range(1, margin + 1):
+        full_fit[i:] |= in_plume[:-i]
+        full_fit[:-i] |= in_plume[i:]
+
+    # Add poor and failed quick fits
+    with np.errstate(invalid = 'ignore'):
+        poor = resid > resid_factor * np.nanmedian(resid)
+    full_fit |= poor | ~np.isfinite(so2)
+
+    return full_fit
+
 #==============================================================================
 #================================== ifit_fwd ==================================
 #==============================================================================
 
-def ifit_fwd_model(grid, p0, p1, p2, p3, shift, stretch, ring_amt, so2_amt,
-                   no2_amt, o3_amt):
+def ifit_fwd_model(grid, p0, p1, p2, p3, shift, stretch, *amounts):
 
     '''
     iFit forward model to fit measured UV sky spectra
@@ -159,8 +958,15 @@ def ifit_fwd_model(grid, p0, p1, p2, p3, shift, stretch, ring_amt, so2_amt,
     grid : array
         Measurement wavelength grid
 
-    *args : list
-        Forward model state vector
+    p0, p1, p2, p3 : float
+        Background polynomial coefficients
+
+    shift, stretch : float
+        Wavelength shift and stretch of the model grid
+
+    *amounts : floats
+        The ring amount followed by the amount of each absorber, in the order
+        of the columns of common['xsec_matrix']
 
     **Returns:**
         
@@ -172,19 +978,8 @@ def ifit_fwd_model(grid, p0, p1, p2, p3, shift, stretch, ring_amt, so2_amt,
     bg_poly = make_poly(com['model_grid'], [p0, p1, p2, p3])
     frs = np.multiply(com['sol'], bg_poly)
 
-    # Build gas spectra
-    so2_T = -(np.multiply(com['so2_xsec'], so2_amt))
-    no2_T = -(np.multiply(com['no2_xsec'], no2_amt))
-    o3_T  = -(np.multiply(com['o3_xsec'],  o3_amt))
-
-    # Ring effect
-    ring_T = np.multiply(com['ring'], ring_amt)
-
-    # Combine into a single array
-    exponent_data = np.column_stack((so2_T, no2_T, o3_T, ring_T))
-
-    # Sum the data
-    exponent = np.exp(np.sum(exponent_data, axis = 1))
+    # Find the transmission of the ring effect and absorbers
+    exponent = np.exp(com['xsec_matrix'] @ np.asarray(amounts))
 
     # Multipy by the fraunhofer reference spectrum
     raw_F = np.multiply(frs, exponent)
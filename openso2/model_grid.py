@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Module to choose the resolution and padding of the forward model grid for a
+spectrometer, trading the model cost against the accuracy of the SO2 columns.
+"""
+
+import time
+import logging
+import numpy as np
+import pandas as pd
+
+from openso2 import fit
+from openso2.program_setup import build_common
+
+# Candidate model grid spacings (nm) and padding either side of the fit
+#  window (nm)
+RESOLUTIONS = [0.01, 0.02, 0.025, 0.04, 0.05, 0.08, 0.1]
+PADS = [0.5, 0.75, 1.0, 1.5, 2.0, 2.5, 3.0]
+
+#==============================================================================
+#=============================== Fit With Grid ================================
+#==============================================================================
+
+def fit_with_grid(common, wavelength, spectra):
+
+    '''
+    Function to fit test spectra with a model grid
+
+    **Parameters:**
+
+    common : dict
+        Dictionary of program variables, from build_common
+
+    wavelength : array
+        The wavelength of each spectrometer pixel (nm)
+
+    spectra : 2D array
+        The test spectra, one per row, dark corrected
+
+    **Returns:**
+
+    so2 : array
+        The fitted SO2 column of each spectrum, nan if the fit failed
+
+    fit_time : float
+        The mean fit time (s)
+    '''
+
+    common['dark'] = np.zeros(len(wavelength))
+    common['idx'] = np.where(np.logical_and(common['wave_start'] <= wavelength,
+                                            wavelength <= common['wave_stop']))
+    grid = wavelength[common['idx']]
+    so2_i = common['param_names'].index('so2')
+
+    so2 = np.full(len(spectra), np.nan)
+    t0 = time.perf_counter()
+    for n, y in enumerate(spectra):
+        popt, perr, fitted_flag = fit.fit_spec(common, [wavelength, y], grid)
+        if fitted_flag:
+            so2[n] = popt[so2_i]
+
+    return so2, (time.perf_counter() - t0) / len(spectra)
+
+#==============================================================================
+#============================= Select Model Grid ==============================
+#==============================================================================
+
+def select_model_grid(settings, spec_name, wavelength, tolerance=None,
+                      resolutions=RESOLUTIONS, pads=PADS,
+                      so2_amounts=(1e17, 5e17, 2e18), peak=40000,
+                      ref_path='data_bases/Ref/'):
+
+    '''
+    Function to find the coarsest model grid resolution, and then the
+    smallest padding, that keep the fitted SO2 columns within a tolerance of
+    those from the reference grid (the finest resolution and largest
+    padding) for a spectrometer.
+
+    Noise free test spectra are made with the reference grid for each SO2
+    amount, using the spectrometer ILS and flat, and fitted with each
+    candidate grid. The resolutions are tried from fine to coarse, stopping at
+    the first that fails, and the padding is then reduced at the chosen
+    resolution in the same way. Resolutions coarser than a fifth of the ILS
+    width are not tried.
+
+    **Parameters:**
+
+    settings : dict
+        Dictionary of station settings. The model_grid_tol setting gives the
+        default tolerance
+
+    spec_name : str
+        The spectrometer serial number, used to find its ILS and flat
+
+    wavelength : array
+        The wavelength of each spectrometer pixel (nm)
+
+    tolerance : float, optional
+        Largest fractional difference in SO2 from the reference allowed.
+        Defaults to the model_grid_tol setting, or 0.01
+
+    resolutions, pads : list, optional
+        The candidate model grid spacings and paddings (nm)
+
+    so2_amounts : list, optional
+        The SO2 columns of the test spectra (molecules/cm2)
+
+    peak : float, optional
+        Peak intensity of the test spectra (counts)
+
+    ref_path : str, optional
+        The folder holding the reference files
+
+    **Returns:**
+
+    model_res : float
+        The chosen model grid spacing (nm)
+
+    model_pad : float
+        The chosen model grid padding (nm)
+
+    results : pandas.DataFrame
+        The SO2 difference and fit time of each grid tried
+    '''
+
+    if tolerance is None:
+        tolerance = settings.get('model_grid_tol', 0.01)
+
+    def make_common(res, pad):
+        return build_common({**settings, 'model_res': res, 'model_pad': pad},
+                            spec_name, ref_path=ref_path)
+
+    # Make the test spectra with the reference grid
+    ref_res, ref_pad = min(resolutions), max(pads)
+    common = make_common(ref_res, ref_pad)
+    idx = np.where(np.logical_and(common['wave_start'] <= wavelength,
+                                  wavelength <= common['wave_stop']))
+    so2_i = common['param_names'].index('so2')
+
+    # The forward model uses the common set in the fit module, which is put
+    #  back afterwards
+    fit_com = getattr(fit, 'com', None)
+    fit.com = common
+    spectra = np.zeros([len(so2_amounts), len(wavelength)])
+    try:
+        for n, amount in enumerate(so2_amounts):
+            params = np.array(common['params'], dtype=float)
+            params[so2_i] = amount
+            model = fit.ifit_fwd_model(wavelength[idx], *params)
+            spectra[n, idx[0]] = model * peak / np.nanmax(model) \
+                * common['flat']
+    finally:
+        fit.com = fit_com
+
+    # Fit them with the reference grid
+    so2_ref, ref_time = fit_with_grid(common, wavelength, spectra)
+    if np.any(np.isnan(so2_ref)):
+        raise ValueError('Reference fits of the test spectra failed')
+
+    # Only try resolutions that sample the ILS well
+    fwem = np.loadtxt(f'{ref_path}ils_params_{spec_name}.txt')[0]
+
+    rows = []
+    def try_grid(res, pad):
+        so2, fit_time = fit_with_grid(make_common(res, pad), wavelength,
+                                        spectra)
+        diff = np.max(np.abs(so2 - so2_ref) / np.abs(so2_ref))
+        passed = bool(diff <= tolerance)
+        rows.append([res, pad, diff, fit_time, ref_time / fit_time, passed])
+        logging.info(f'Model grid {res} nm, pad {pad} nm: SO2 difference '
+                     + f'{diff:.2%}, speedup {ref_time / fit_time:.2f}')
+        return passed
+
+    # Find the coarsest resolution with the reference padding
+    model_res = ref_res
+    for res in sorted(resolutions):
+        if res <= ref_res or res > fwem / 5:
+            continue
+        if not try_grid(res, ref_pad):
+            break
+        model_res = res
+
+    # Then the smallest padding at that resolution
+    model_pad = ref_pad
+    for pad in sorted(pads, reverse=True):
+        if pad >= ref_pad:
+            continue
+        if not try_grid(model_res, pad):
+            break
+        model_pad = pad
+
+    results = pd.DataFrame(rows, columns=['model_res', 'model_pad',
+                                          'so2_max_rel_diff', 'fit_time_s',
+                                          'speedup', 'passed'])
+
+    return model_res, model_pad, results
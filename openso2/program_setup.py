@@ -3,8 +3,15 @@
 Module to read in settings files to initiate the main program.
 """
 
+import numpy as np
 from tkinter import filedialog as fd
 
+from openso2.make_ils import make_ils
+from openso2.fit import parse_bounds, PARAM_NAMES
+
+# First guess amounts of the absorbers (molecules/cm2). Others start at 1e16
+FIRST_GUESS = {'so2': 1.0e16, 'no2': 1.0e17, 'o3': 1.0e19, 'bro': 1.0e14}
+
 #==============================================================================
 #================================= read_setttings =============================
 #==============================================================================
@@ -65,6 +72,201 @@ def read_settings(fname, settings = None):
 
     return settings
 
+#==============================================================================
+#=============================== update_settings ==============================
+#==============================================================================
+
+def update_settings(fname, values):
+
+    '''
+    Function to change settings in the settings file, keeping the others and
+    their order. Settings not already in the file are added at the end.
+
+    **Parameters:**
+
+    fname : str
+        File path to settings file
+
+    values : dict
+        The settings to change, with values of type float, int, bool or str
+
+    **Returns:**
+
+    None
+    '''
+
+    with open(fname, 'r') as r:
+        lines = [line.strip() for line in r.readlines() if line.strip()]
+
+    values = dict(values)
+    for i, line in enumerate(lines):
+        name = line.split(';')[0]
+        if name in values:
+            val = values.pop(name)
+            lines[i] = f'{name};{val};{type(val)}'
+
+    for name, val in values.items():
+        lines.append(f'{name};{val};{type(val)}')
+
+    with open(fname, 'w') as w:
+        w.write('\n'.join(lines) + '\n')
+
+#==============================================================================
+#================================ Build Common ================================
+#==============================================================================
+
+def build_common(settings, spec_name, fpath = 'Results/',
+                 ref_path = 'data_bases/Ref/'):
+
+    '''
+    Function to build the common dictionary of program variables used to
+    analyse scans, loading the reference spectra, flat spectrum and ILS for the
+    given spectrometer
+
+    **Parameters:**
+
+    settings : dict
+        Dictionary of the station settings, as read by read_settings
+
+    spec_name : str
+        Serial number of the spectrometer
+
+    fpath : str (optional)
+        The results folder for the scans. Default is "Results/"
+
+    ref_path : str (optional)
+        The folder holding the reference files. Default is "data_bases/Ref/"
+
+    **Returns:**
+
+    common : dict
+        Dictionary of program variables
+
+    Written by Ben Esse, January 2019
+    '''
+
+    # Create the dictionary to hold the comon parameters
+    common = {'fpath': fpath}
+
+    # Set the fit window
+    common['wave_start'] = 310
+    common['wave_stop']  = 320
+
+    # Read in reference spectra. The absorbers are set by the absorbers
+    #  setting, a comma separated list, each read from "<name>.txt"
+    absorbers = [name.strip() for name in
+                 settings.get('absorbers', 'so2,no2,o3').split(',')
+                 if name.strip() != '']
+    if 'so2' not in absorbers:
+        raise ValueError('The absorbers setting must include so2')
+    grid, sol  = np.loadtxt(f'{ref_path}sol.txt',  unpack = True)
+    grid, ring = np.loadtxt(f'{ref_path}ring.txt', unpack = True)
+    xsecs = [np.loadtxt(f'{ref_path}{name}.txt', unpack = True)[1]
+             for name in absorbers]
+
+    # Extract the fit window, padded either side so the convolution and
+    #  wavelength shift do not reach the edges of the model grid
+    model_pad = settings.get('model_pad', 2)
+    fit_idx = np.where(np.logical_and(grid > common['wave_start'] - model_pad,
+                                      grid < common['wave_stop'] + model_pad))
+
+    # Set the model grid, and the matrix of the ring spectrum and absorber
+    #  cross-sections, signed so the optical depth is xsec_matrix @ amounts
+    common['model_grid']  = grid[fit_idx]
+    common['sol']         = sol[fit_idx]
+    common['xsec_matrix'] = np.column_stack([ring] + [-x for x in xsecs]
+                                            )[fit_idx]
+    common['absorbers']   = absorbers
+    common['param_names'] = PARAM_NAMES[:7] + absorbers
+
+    # Resample onto a coarser model grid if requested, trading accuracy for
+    #  speed. The reference spectra are on a 0.01 nm grid
+    model_res = max(settings.get('model_res', 0.01), 0.01)
+    if model_res > 0.01:
+        model_grid = np.arange(common['model_grid'][0],
+                               common['model_grid'][-1], model_res)
+        common['sol'] = np.interp(model_grid, common['model_grid'],
+                                  common['sol'])
+        common['xsec_matrix'] = np.column_stack([
+            np.interp(model_grid, common['model_grid'], col)
+            for col in common['xsec_matrix'].T])
+        common['model_grid'] = model_grid
+
+    # Get spectrometer flat spectrum
+    x, flat = np.loadtxt(f'{ref_path}flat_{spec_name}.txt', unpack = True)
+    idx = np.where(np.logical_and(x > common['wave_start'],
+                                  x < common['wave_stop']))
+    common['flat'] = flat[idx]
+
+    # Get spectrometer ILS
+    ils_fpath = f'{ref_path}ils_params_{spec_name}.txt'
+    FWHM, k, a_w, a_k = np.loadtxt(ils_fpath)
+    common['ils'] = make_ils(model_res, FWHM, k, a_w, a_k)
+
+    # Set first guess for parameters
+    common['params'] = [1.0, 1.0, 1.0, 1.0, -0.2, 0.05, 1.0] \
+        + [FIRST_GUESS.get(name, 1.0e16) for name in absorbers]
+
+    # Set the fit solver and its options, see fit_spec and the solvers in
+    #  openso2.fit
+    common['fit_solver'] = settings.get('fit_solver', 'curve_fit')
+    common['varpro_iterations'] = settings.get('varpro_iterations', 2)
+    common['fit_method'] = settings.get('fit_method', 'trf')
+    common['fit_x_scale'] = settings.get('fit_x_scale', 'jac')
+    common['fit_bounds'] = parse_bounds(settings.get('fit_bounds', ''),
+                                        common['param_names'])
+    for key in ['fit_ftol', 'fit_xtol', 'fit_gtol']:
+        common[key] = settings.get(key, 1e-8)
+
+    # Set the fit budgets, see fit_spec and analyse_scan. A fit_maxfev of 0
+    #  uses the curve_fit default
+    common['fit_maxfev'] = settings.get('fit_maxfev', 0)
+    common['fit_maxfev_behind'] = settings.get('fit_maxfev_behind', 100)
+    common['fit_tol_behind'] = settings.get('fit_tol_behind', 1e-4)
+    common['fit_time_factor'] = settings.get('fit_time_factor', 3)
+    common['fit_min_time'] = settings.get('fit_min_time', 0.1)
+
+    # Set the tiered fit, see analyse_scan and triage_spectra
+    common['tiered_fit'] = settings.get('tiered_fit', False)
+    common['triage_so2'] = settings.get('triage_so2', 5e16)
+    common['triage_margin'] = settings.get('triage_margin', 3)
+    common['triage_resid_factor'] = settings.get('triage_resid_factor', 3)
+
+    # Set how the first guess shift and stretch are estimated, one of "none",
+    #  "scan" or "spectrum", see analyse_scan
+    common['prealign'] = settings.get('prealign', 'none')
+
+    # Set whether to fit the shift and stretch once per scan, see
+    #  calibrate_scan
+    common['shared_calibration'] = settings.get('shared_calibration', False)
+
+    # Set the number of angular segments each scan is split into, and the
+    #  number of processes used to fit them, see analyse_scan. By default
+    #  there is one segment for each process
+    common['analysis_workers'] = settings.get('analysis_workers', 1)
+    common['fit_segments'] = settings.get('fit_segments',
+                                          common['analysis_workers'])
+
+    # Set the reference spectrum, "solar" to fit against the solar spectrum
+    #  or "clear_sky" to fit against measured clear sky spectra, see
+    #  find_clear_sky_refs
+    common['reference_mode'] = settings.get('reference_mode', 'solar')
+    common['clear_sky_so2'] = settings.get('clear_sky_so2', 5e16)
+    common['clear_sky_max_age'] = settings.get('clear_sky_max_age', 3600)
+
+    # Set the station name and spectrometer
+    common['station_name'] = settings['station_name']
+    common['spec_name'] = spec_name
+
+    # Set the station motor details
+    common['steps_per_degree'] = settings['steps_per_degree']
+    common['home_offset'] = settings['home_offset']
+
+    # Create loop counter
+    common['scan_no'] = 0
+
+    return common
+
 #==============================================================================
 #============================== Get Station Info ==============================
 #==============================================================================
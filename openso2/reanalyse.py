@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Module to reanalyse stored scans across a process pool, for example to
+reprocess a campaign after the reference spectra are updated.
+"""
+
+import os
+import glob
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import datetime as dt
+from multiprocessing import Pool, cpu_count
+
+from openso2.analyse_scan import analyse_scan, get_spec_details
+from openso2.catalog import parse_scan_fname, open_catalog
+from openso2.program_setup import build_common
+from openso2.dark_library import DarkLibrary
+from openso2.clear_sky import ClearSkyLibrary
+
+# Common dictionary built once in each worker process
+_common = None
+
+#==============================================================================
+#================================= Find Scans =================================
+#==============================================================================
+
+def find_scans(res_path, station, start_date, stop_date, catalog_path=None):
+
+    '''
+    Function to find the scan files for a station between two dates
+
+    **Parameters:**
+
+    res_path : str
+        The results folder, holding a folder for each day named "yyyy-mm-dd"
+
+    station : str
+        The station name
+
+    start_date, stop_date : datetime.date
+        The first and last days to include
+
+    catalog_path : str, optional
+        File path to the scan catalog. If given the scans are found from the
+        catalog instead of listing the day folders
+
+    **Returns:**
+
+    scan_paths : list
+        File paths to the scans, ordered by time
+    '''
+
+    # Pull from the catalog if one is given
+    catalog = open_catalog(catalog_path)
+    if catalog is not None:
+        start = dt.datetime.combine(start_date, dt.time.min)
+        stop = dt.datetime.combine(stop_date, dt.time.max)
+        return catalog.list_files(station=station, kind='spectra',
+                                  start=start, stop=stop)
+
+    scan_paths = []
+    date = start_date
+    while date <= stop_date:
+
+        # Find the scans for this station in the day folder
+        fnames = glob.glob(f'{res_path}{date}/spectra/*_{station}_*.npy')
+        scan_paths += sorted(fnames, key=lambda f: parse_scan_fname(f)['timestamp'])
+
+        date += dt.timedelta(days=1)
+
+    return scan_paths
+
+#==============================================================================
+#=============================== Init Worker ==================================
+#==============================================================================
+
+def _init_worker(settings, spec_name, ref_path, extra):
+
+    '''Build the common, loading the reference spectra, in each worker
+    process, adding the libraries shared by the run'''
+
+    global _common
+    _common = build_common(settings, spec_name, ref_path=ref_path)
+    _common.update(extra)
+
+#==============================================================================
+#================================ Settings Key ================================
+#==============================================================================
+
+def settings_key(settings, spec_name, ref_path):
+
+    '''
+    Function to make a short key for the analysis settings, recorded with
+    each scan in the checkpoint so that a run with different settings does
+    not skip the scans already analysed
+
+    **Parameters:**
+
+    settings : dict
+        Dictionary of the station settings
+
+    spec_name : str
+        Serial number of the spectrometer
+
+    ref_path : str
+        The folder holding the reference files
+
+    **Returns:**
+
+    key : str
+        The settings key
+    '''
+
+    text = json.dumps([settings, spec_name, ref_path], sort_keys=True,
+                      default=str)
+
+    return hashlib.md5(text.encode()).hexdigest()[:12]
+
+#==============================================================================
+#============================== Analyse Worker ================================
+#==============================================================================
+
+def _analyse_worker(args):
+
+    '''Analyse a single scan in a worker process'''
+
+    scan_path, save_path, catalog_path = args
+
+    # Copy the common so each scan starts from the initial fit parameters
+    common = dict(_common)
+    common['scan_no'] = parse_scan_fname(scan_path)['scan_no']
+    common['catalog_path'] = catalog_path
+
+    # Save to the "so2" folder of the scan day if no folder is given
+    if save_path is None:
+        common['fpath'] = os.path.dirname(os.path.dirname(scan_path)) + '/'
+        os.makedirs(common['fpath'] + 'so2/', exist_ok=True)
+    else:
+        os.makedirs(save_path, exist_ok=True)
+
+    df = analyse_scan(scan_path, True, save_path, **common)
+
+    if df is None:
+        return scan_path, 0, False
+
+    return scan_path, len(df), True
+
+#==============================================================================
+#================================ Reanalyse ===================================
+#==============================================================================
+
+def reanalyse(scan_paths, settings, spec_name=None, save_path=None,
+              n_workers=None, checkpoint=None, catalog_path=None,
+              ref_path='data_bases/Ref/',
+              dark_library_path='Station/dark_library.npz',
+              clear_sky_path=None):
+
+    '''
+    Function to reanalyse a list of scans across a pool of worker processes,
+    each of which builds its own common. Progress is written to a checkpoint
+    file so that an interrupted run can be resumed, skipping the scans that
+    are already complete. Each scan is recorded with a key of the settings,
+    so a run with different settings analyses all the scans again.
+
+    **Parameters:**
+
+    scan_paths : list
+        File paths to the scans to analyse
+
+    settings : dict
+        Dictionary of the station settings, as read by read_settings
+
+    spec_name : str, optional
+        Serial number of the spectrometer. If None it is found from the station
+        name in the first scan file name
+
+    save_path : str, optional
+        The folder in which to save the results. If None they are saved to the
+        "so2" folder of each scan day
+
+    n_workers : int, optional
+        The number of worker processes. Defaults to the number of cores
+
+    checkpoint : str, optional
+        File path to the checkpoint file. If None progress is not recorded
+
+    catalog_path : str, optional
+        File path to the scan catalog in which to record the analysis
+
+    ref_path : str, optional
+        The folder holding the reference files
+
+    dark_library_path : str, optional
+        The saved dark library of the station, used for spectra measured at
+        a different integration time to the scan dark that have no dark saved
+        with the scan. Ignored if the file does not exist
+
+    clear_sky_path : str, optional
+        File used for the clear sky library of the run when the
+        reference_mode setting is "clear_sky", shared by the workers. If None
+        a temporary file is used
+
+    **Returns:**
+
+    summary : dict
+        Dictionary holding the number of scans analysed ("n_scans"), failed
+        ("n_failed") and skipped ("n_skipped"), the number of spectra analysed
+        ("n_spectra"), the run time ("run_time", s) and the throughput
+        ("scans_per_s" and "spectra_per_s")
+    '''
+
+    summary = {'n_scans': 0, 'n_failed': 0, 'n_skipped': 0,
+               'n_spectra': 0, 'run_time': 0.0, 'scans_per_s': 0.0,
+               'spectra_per_s': 0.0}
+
+    if len(scan_paths) == 0:
+        return summary
+
+    # Get the spectrometer from the scan file name
+    if spec_name is None:
+        spec_name = get_spec_details(scan_paths[0])[1]
+
+    # Read the checkpoint to find the scans completed with these settings
+    key = settings_key(settings, spec_name, ref_path)
+    done = set()
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        with open(checkpoint, 'r') as r:
+            for line in r:
+                parts = line.rstrip('\n').split('\t', 1)
+                if len(parts) == 2 and parts[0] == key:
+                    done.add(parts[1])
+
+    todo = [f for f in scan_paths if f not in done]
+    summary['n_skipped'] = len(scan_paths) - len(todo)
+    if summary['n_skipped'] > 0:
+        logging.info('Resuming reanalysis, skipping '
+                     + f'{summary["n_skipped"]} scans')
+
+    if len(todo) == 0:
+        return summary
+
+    if n_workers is None:
+        n_workers = cpu_count()
+
+    logging.info(f'Reanalysing {len(todo)} scans on {n_workers} workers')
+
+    t0 = time.time()
+    args = [[f, save_path, catalog_path] for f in todo]
+
+    # Load the station dark library if there is one
+    extra = {}
+    if dark_library_path is not None and os.path.isfile(dark_library_path):
+        dark_library = DarkLibrary(settings)
+        dark_library.load(dark_library_path)
+        extra['dark_library'] = dark_library
+        logging.info(f'Using the dark library {dark_library_path}')
+
+    # Create the clear sky library of the run, kept in a file so that the
+    #  workers share it
+    tmp_fpath = None
+    if settings.get('reference_mode', 'solar') == 'clear_sky':
+        if clear_sky_path is None:
+            fd, tmp_fpath = tempfile.mkstemp(suffix='.npz')
+            os.close(fd)
+            os.remove(tmp_fpath)
+            clear_sky_path = tmp_fpath
+        extra['clear_sky_library'] = ClearSkyLibrary(settings,
+                                                     clear_sky_path)
+
+    with Pool(n_workers, initializer=_init_worker,
+              initargs=(settings, spec_name, ref_path, extra)) as pool:
+
+        for scan_path, n_spec, ok in pool.imap_unordered(_analyse_worker, args):
+
+            # Record progress
+            if ok:
+                summary['n_scans'] += 1
+                summary['n_spectra'] += n_spec
+                if checkpoint is not None:
+                    with open(checkpoint, 'a') as a:
+                        a.write(f'{key}\t{scan_path}\n')
+            else:
+                summary['n_failed'] += 1
+
+            # Report throughput
+            n_complete = summary['n_scans'] + summary['n_failed']
+            if n_complete % 10 == 0 or n_complete == len(todo):
+                run_time = time.time() - t0
+                logging.info(f'{n_complete}/{len(todo)} scans complete, '
+                             + f'{n_complete/run_time:.2f} scans/s, '
+                             + f'{summary["n_spectra"]/run_time:.1f} '
+                             + 'spectra/s')
+
+    if tmp_fpath is not None and os.path.isfile(tmp_fpath):
+        os.remove(tmp_fpath)
+
+    summary['run_time'] = time.time() - t0
+    summary['scans_per_s'] = summary['n_scans'] / summary['run_time']
+    summary['spectra_per_s'] = summary['n_spectra'] / summary['run_time']
+
+    return summary
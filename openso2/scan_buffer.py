@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Module to pass scans from acquisition to analysis through a ring buffer in
+shared memory, so the analysis does not have to read the scan back from disk.
+"""
+
+import io
+import sqlite3
+import logging
+import threading
+import numpy as np
+from multiprocessing import Lock
+
+from openso2.catalog import open_catalog, calc_checksum
+from openso2.shared_refs import create_shared_block, attach_shared_block, \
+                                release_shared_block
+
+# Background threads saving scans to disk
+_writers = []
+
+#==============================================================================
+#================================= Scan Buffer ================================
+#==============================================================================
+
+class ScanBuffer:
+
+    '''
+    Ring buffer of scan slots held in shared memory. The acquisition writes
+    each scan directly into a free slot, then hands the slot to its consumers
+    (the analysis process and the writer saving it to disk). The slot is
+    reused once every consumer has released it.
+
+    The buffer can be passed to other processes, which attach to the same
+    memory.
+
+    **Parameters:**
+
+    n_slots : int
+        Number of scans held in the buffer
+
+    shape : tuple
+        Shape of each scan array, (specs_per_scan, 7 + n_pixels)
+    '''
+
+    def __init__(self, n_slots, shape):
+
+        self.n_slots = n_slots
+        self.shape = tuple(shape)
+
+        # Each slot holds the scan, then one counter per slot of the number of
+        #  consumers yet to release it (-1 while being written)
+        scan_bytes = int(np.prod(self.shape)) * 8
+        size = n_slots * scan_bytes + n_slots * 8
+        self._block, buf, self.spec = create_shared_block(size)
+        self._owner = True
+        self._lock = Lock()
+        self._map(buf)
+        self._users[:] = 0
+
+    def _map(self, buf):
+
+        '''Build the numpy views of the slots and counters'''
+
+        self._slots = np.ndarray((self.n_slots,) + self.shape, dtype=np.float64,
+                                 buffer=buf)
+        self._users = np.ndarray(self.n_slots, dtype=np.int64, buffer=buf,
+                                 offset=self._slots.nbytes)
+
+    def __getstate__(self):
+
+        return {'n_slots': self.n_slots, 'shape': self.shape,
+                'spec': self.spec, '_lock': self._lock}
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._block, buf = attach_shared_block(self.spec)
+        self._owner = False
+        self._map(buf)
+
+#==============================================================================
+#================================ Claim Slot ==================================
+#==============================================================================
+
+    def claim(self):
+
+        '''
+        Function to claim a free slot to write a scan into
+
+        **Parameters:**
+
+        None
+
+        **Returns:**
+
+        slot : int or None
+            The slot index, or None if every slot is in use
+        '''
+
+        with self._lock:
+            free = np.where(self._users == 0)[0]
+            if len(free) == 0:
+                return None
+            slot = int(free[0])
+            self._users[slot] = -1
+
+        return slot
+
+#==============================================================================
+#=============================== Slot Access ==================================
+#==============================================================================
+
+    def array(self, slot):
+
+        '''Return the scan array of a slot'''
+
+        return self._slots[slot]
+
+    def publish(self, slot, n_users):
+
+        '''Hand a written slot to its consumers'''
+
+        with self._lock:
+            self._users[slot] = n_users
+
+    def release(self, slot):
+
+        '''Release a slot once a consumer has finished with it'''
+
+        with self._lock:
+            self._users[slot] = max(self._users[slot] - 1, 0)
+
+#==============================================================================
+#==================================== Close ===================================
+#==============================================================================
+
+    def close(self):
+
+        '''Release the shared memory. Only acts in the creating process'''
+
+        if not self._owner or self._block is None:
+            return
+
+        self._slots = None
+        self._users = None
+        release_shared_block(self._block, self.spec)
+        self._block = None
+
+#==============================================================================
+#================================= Save Scan ==================================
+#==============================================================================
+
+def save_scan(fpath, scan_data, common, buffer=None, slot=None):
+
+    '''
+    Function to save a scan to disk in the Open SO2 format and record it in the
+    scan catalog
+
+    **Parameters:**
+
+    fpath : str
+        File path to save the scan to
+
+    scan_data : array
+        The scan, with the info columns followed by the spectrum for each row
+
+    common : dict
+        Common dictionary of program variables
+
+    buffer : ScanBuffer, optional
+        The buffer holding the scan. If given the slot is released once saved
+
+    slot : int, optional
+        The buffer slot holding the scan
+
+    **Returns:**
+
+    None
+    '''
+
+    try:
+        # Write the file from memory so the checksum is found without
+        #  rereading
+        buf = io.BytesIO()
+        np.save(buf, scan_data.astype('float16'))
+        with open(fpath, 'wb') as w:
+            w.write(buf.getvalue())
+
+        # Record the scan in the catalog, leaving out any extra darks
+        catalog = open_catalog(common.get('catalog_path'))
+        if catalog is not None:
+            specs = scan_data[scan_data[:, 0] >= 0]
+            try:
+                catalog.add_file(fpath, kind='spectra', status='acquired',
+                                 spectrometer=common.get('spec_name'),
+                                 info=specs[:, :7], spec=specs[:, 7:],
+                                 checksum=calc_checksum(data=buf.getvalue()),
+                                 keep_status=True)
+            except sqlite3.Error:
+                logging.warning('Failed to catalog scan', exc_info=True)
+
+    finally:
+        if buffer is not None:
+            buffer.release(slot)
+
+#==============================================================================
+#============================== Save Scan Async ===============================
+#==============================================================================
+
+def save_scan_async(fpath, scan_data, common, buffer=None, slot=None):
+
+    '''
+    Function to save a scan on a background thread so the acquisition can
+    carry on. Takes the same parameters as save_scan.
+
+    **Returns:**
+
+    thread : threading.Thread
+        The writer thread, which should be joined before the program exits
+    '''
+
+    thread = threading.Thread(target=save_scan,
+                              args=[fpath, scan_data, common, buffer, slot])
+    thread.start()
+
+    # Keep track of the writer so it can be waited on
+    _writers.append(thread)
+    _writers[:] = [t for t in _writers if t.is_alive()]
+
+    return thread
+
+#==============================================================================
+#============================== Wait For Saves ================================
+#==============================================================================
+
+def wait_for_saves():
+
+    '''Function to wait for any scans still being saved in the background'''
+
+    for thread in _writers:
+        thread.join()
+
+    _writers.clear()
@@ -8,6 +8,9 @@ import logging
 import datetime
 import atexit
 import time
+
+from openso2.coadd import CoaddAccumulator
+from openso2.scan_buffer import save_scan, save_scan_async
 try:
     import board
     import digitalio
@@ -171,7 +174,8 @@ class Scanner:
 #================================ Acuire Scan =================================
 #==============================================================================
 
-def acquire_scan(Scanner, Spectrometer, common, settings):
+def acquire_scan(Scanner, Spectrometer, common, settings, buffer = None,
+                 int_times = None, dark_library = None):
 
     '''
     Function to perform a scan.
@@ -182,7 +186,7 @@ def acquire_scan(Scanner, Spectrometer, common, settings):
         Object to control the scanner head consisting of a stepper motor and a
         microswitch
 
-    Spectrometer : Seabreeze.Spectrometer object
+    Spectrometer : openso2 Spectrometer object
         Object to control the spectrometer
         
     common : dict
@@ -191,6 +195,24 @@ def acquire_scan(Scanner, Spectrometer, common, settings):
     settings : dict
         Dictionary of the program settings
 
+    buffer : openso2 ScanBuffer (optional)
+        Shared memory buffer to write the scan into. If given (and a slot is
+        free) the scan is handed to the analysis in memory and saved to disk
+        on a background thread. The slot is recorded in common["scan_slot"]
+        and must be released by both the analysis and the writer
+
+    int_times : array (optional)
+        Integration time (ms) for each step of the scan, e.g. from an
+        AngleExposureTable. If None common["spec_int_time"] is used throughout.
+        The dark spectrum in the first row is taken at common["spec_int_time"].
+        A dark for each other integration time used is added after the
+        spectra, with a spec_n of -1, see split_scan_darks
+
+    dark_library : openso2 DarkLibrary (optional)
+        Library of dark spectra. If given the dark is only measured when the
+        library has no fresh dark for the scan, otherwise it is reused. Darks
+        are also kept covering the range of int_times
+
     **Returns:**
 
     fpath : str
@@ -199,8 +221,26 @@ def acquire_scan(Scanner, Spectrometer, common, settings):
     Written by Ben Esse, January 2019
     '''
 
-    # Create array to hold scan data
-    scan_data = np.zeros((settings['specs_per_scan'], 2055))
+    # Find the other integration times used in the scan, each of which needs
+    #  its own dark saved with the scan
+    int_time = common['spec_int_time']
+    dark_times = []
+    if int_times is not None:
+        dark_times = sorted(set(float(t) for t in int_times[1:])
+                            - {float(int_time)})
+    n_specs = settings['specs_per_scan']
+    n_rows = n_specs + len(dark_times)
+
+    # Create array to hold scan data, in the buffer if there is space. Rows
+    #  of the slot beyond the scan are left as zeros
+    slot = None
+    if buffer is not None and buffer.shape[0] >= n_rows:
+        slot = buffer.claim()
+    if slot is not None:
+        buffer.array(slot)[:] = 0
+        scan_data = buffer.array(slot)[:n_rows]
+    else:
+        scan_data = np.zeros((n_rows, 2055))
 
     # Return the scanner position to home
     Scanner.find_home()
@@ -220,11 +260,47 @@ def acquire_scan(Scanner, Spectrometer, common, settings):
     fname += f'{settings["station_name"]}'          # Station name
     fname += f'_v_1_1_Block{common["scan_no"]}.npy' # Version and scan number
 
-    # Take the dark spectrum
-    dark = Spectrometer.intensities()
-    dark_data = np.array([0, h, m, s, Scanner.position, 1, 
-                         common['spec_int_time']])
-    scan_data[0] = np.append(dark_data, dark)
+    # Create array to hold the peak intensity of each spectrum
+    scan_peaks = np.zeros(settings['specs_per_scan'])
+
+    # Create array to hold the noise estimate of each spectrum
+    scan_noise = np.full(settings['specs_per_scan'], np.nan)
+
+    # Get the intensity at which a spectrum is saturated
+    saturation = settings.get('saturation_int', 65000)
+
+    # Create the accumulator to coadd the readouts, rejecting spikes
+    accumulator = make_accumulator(scan_data.shape[1] - 7, settings)
+
+    # Take the dark spectrum at the scan integration time, or reuse one from
+    #  the library
+    Spectrometer.integration_time_micros(int_time * 1000)
+    if dark_library is None:
+        dark = Spectrometer.intensities()
+        dark_coadds = 1
+    else:
+        update_darks(Spectrometer, dark_library, int_time, int_times,
+                     accumulator)
+        dark = dark_library.get(common['spec_int_time'], dark_library.coadds)
+        dark_coadds = dark_library.coadds
+    scan_data[0, :7] = [0, h, m, s, Scanner.position, dark_coadds,
+                        common['spec_int_time']]
+    scan_data[0, 7:] = dark
+
+    # Add the darks for the other integration times, from the library if it
+    #  covers them, otherwise measured now
+    for i, t in enumerate(dark_times):
+        other_dark, other_coadds = None, dark_coadds
+        if dark_library is not None:
+            other_dark = dark_library.get(t)
+        if other_dark is None:
+            Spectrometer.integration_time_micros(t * 1000)
+            other_dark, other_coadds = Spectrometer.intensities(), 1
+        scan_data[n_specs+i, :7] = [-1, h, m, s, Scanner.position,
+                                    other_coadds, t]
+        scan_data[n_specs+i, 7:] = other_dark
+    if len(dark_times) > 0:
+        Spectrometer.integration_time_micros(int_time * 1000)
 
     # Move scanner to start position
     logging.info('Moving to start position')
@@ -232,7 +308,7 @@ def acquire_scan(Scanner, Spectrometer, common, settings):
 
     # Begin stepping through the scan
     logging.info('Begin scanning')
-    for step_no in range(1, settings['specs_per_scan']):
+    for step_no in range(1, n_specs):
 
         # Get time
         t = datetime.datetime.now()
@@ -240,17 +316,26 @@ def acquire_scan(Scanner, Spectrometer, common, settings):
         m = t.minute
         s = t.second
 
-        # Acquire spectrum
-        spec_int = np.zeros(len(dark))
-        for i in range(settings['coadds']):
-            spec_int = np.add(spec_int, Spectrometer.intensities())
-        spec_int = np.divide(spec_int, settings['coadds'])
+        # Set the integration time for this angle
+        if int_times is not None and int_times[step_no] != int_time:
+            int_time = int_times[step_no]
+            Spectrometer.integration_time_micros(int_time * 1000)
 
-        # Add the data to the array
+        # Acquire spectrum, averaging directly into the scan array. The
+        #  remaining coadds are skipped if the first readout is saturated, as
+        #  the spectrum will be rejected anyway
+        spec_int, coadds, scan_noise[step_no] = \
+            Spectrometer.coadd(settings['coadds'], out=scan_data[step_no, 7:],
+                               saturation=saturation, accumulator=accumulator)
+        if coadds < settings['coadds']:
+            logging.debug(f'Spectrum {step_no} saturated, skipping coadds')
+
+        scan_peaks[step_no] = spec_int.max()
+
+        # Add the info to the array
         # Has the format N_acq, Hour, Min, Sec, MotorPos, Coadds, Int time
-        spec_data = np.array([step_no, h, m, s, Scanner.position, 1,
-                              common['spec_int_time']])
-        scan_data[step_no] = np.append(spec_data, spec_int)
+        scan_data[step_no, :7] = [step_no, h, m, s, Scanner.position, coadds,
+                                  int_time]
 
         # Step the scanner
         Scanner.step(settings['steps_per_spec'])
@@ -258,10 +343,127 @@ def acquire_scan(Scanner, Spectrometer, common, settings):
     # Scan complete
     logging.info('Scan complete')
 
+    # Return to the scan integration time
+    if int_time != common['spec_int_time']:
+        Spectrometer.integration_time_micros(common['spec_int_time'] * 1000)
+
+    # Record the peak intensities and integration times for the exposure
+    #  control. The scan maximum is scaled to the scan integration time
+    scan_peaks[0] = dark.max()
+    scan_int_times = scan_data[:n_specs, 6].copy()
+    common['scan_peaks'] = scan_peaks
+    common['scan_int_times'] = scan_int_times
+    common['scan_noise'] = scan_noise
+    common['scan_max_int'] = float(np.max(scan_peaks / scan_int_times)
+                                   * common['spec_int_time'])
+
+    # Round the scan to the precision it is saved with, so that analysing it
+    #  in memory gives the same results as analysing the saved file
+    scan_data[:] = scan_data.astype(np.float16)
+
     # Save the scan data
     fpath = common['fpath'] + 'spectra/' + fname
 
-    np.save(fpath, scan_data.astype('float16'))
+    # Hand the scan to the analysis and save it in the background if it is in
+    #  the buffer, otherwise save it now
+    common['scan_slot'] = slot
+    if slot is not None:
+        buffer.publish(slot, 2)
+        save_scan_async(fpath, scan_data, common, buffer, slot)
+    else:
+        save_scan(fpath, scan_data, common)
 
     # Return the filepath to the saved scan
     return fpath
+
+#==============================================================================
+#============================== Make Accumulator ==============================
+#==============================================================================
+
+def make_accumulator(n_pixels, settings):
+
+    '''
+    Function to create the coadd accumulator for a scan from the settings
+    spike_sigma and spike_glitch_fraction (both optional)
+
+    **Parameters:**
+
+    n_pixels : int
+        Number of pixels in each readout
+
+    settings : dict
+        Dictionary of the program settings
+
+    **Returns:**
+
+    accumulator : openso2 CoaddAccumulator
+        The accumulator
+    '''
+
+    return CoaddAccumulator(n_pixels,
+                            spike_sigma=settings.get('spike_sigma', 6),
+                            glitch_fraction=settings.get('spike_glitch_fraction',
+                                                         0.1))
+
+#==============================================================================
+#================================ Update Darks ================================
+#==============================================================================
+
+def update_darks(Spectrometer, dark_library, int_time, int_times = None,
+                 accumulator = None):
+
+    '''
+    Function to measure any darks the library needs for the next scan. This is
+    a dark for the scan integration time, plus darks at the shortest and
+    longest integration times of the scan so that the others can be
+    interpolated. Should be called with the scanner at the home position.
+
+    **Parameters:**
+
+    Spectrometer : openso2 Spectrometer object
+        Object to control the spectrometer
+
+    dark_library : openso2 DarkLibrary
+        The library of dark spectra
+
+    int_time : float
+        Integration time of the scan (ms), which the spectrometer is set to
+
+    int_times : array (optional)
+        Integration time (ms) of each step of the scan
+
+    accumulator : openso2 CoaddAccumulator (optional)
+        Accumulator used to coadd the darks. If None the spectrometer's own
+        is used
+
+    **Returns:**
+
+    None
+    '''
+
+    temperature = Spectrometer.temperature()
+
+    # Find the darks that need measuring
+    to_measure = []
+    if not dark_library.is_fresh(int_time, temperature=temperature):
+        to_measure.append(int_time)
+    if int_times is not None:
+        for t in {min(int_times), max(int_times)}:
+            if t != int_time \
+                    and dark_library.get(t, temperature=temperature) is None:
+                to_measure.append(t)
+
+    # Measure them, finishing at the scan integration time
+    to_measure.sort(key=lambda t: t == int_time)
+    for t in to_measure:
+
+        Spectrometer.integration_time_micros(t * 1000)
+
+        dark, coadds, noise = Spectrometer.coadd(dark_library.coadds,
+                                                 accumulator=accumulator)
+
+        dark_library.add(dark, t, coadds, temperature)
+        logging.info(f'Measured dark at {t} ms')
+
+    if len(to_measure) > 0 and to_measure[-1] != int_time:
+        Spectrometer.integration_time_micros(int_time * 1000)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Module to hold the reference arrays of the common dictionary in shared memory,
+so that analysis processes attach to one read-only copy instead of each
+receiving their own.
+"""
+
+import os
+import atexit
+import logging
+import tempfile
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, fall back to a memory-mapped file
+    shared_memory = None
+
+# Shared blocks attached in this process, held so the memory stays mapped
+_attached = {}
+
+#==============================================================================
+#============================= Shared References ==============================
+#==============================================================================
+
+class SharedReferences:
+
+    '''
+    Holds the numpy arrays of a common dictionary (reference spectra, flat,
+    ILS, etc.) in a single shared memory block. Uses
+    multiprocessing.shared_memory where available, otherwise a memory-mapped
+    file in /dev/shm (or the temporary folder).
+
+    This is only of use when the processes are spawned, as forked processes
+    already share the arrays of the parent. The block is released when close
+    is called or the program exits.
+
+    **Parameters:**
+
+    common : dict
+        Common dictionary of program variables. All numpy array values are
+        placed in shared memory
+    '''
+
+    def __init__(self, common):
+
+        # Find the arrays to share and lay them out in the block, aligning
+        #  each to 64 bytes
+        layout = {}
+        size = 0
+        for key, val in common.items():
+            if isinstance(val, np.ndarray):
+                size = -(-size // 64) * 64
+                layout[key] = [size, val.shape, val.dtype.str]
+                size += val.nbytes
+        size = max(size, 1)
+
+        # Create the block
+        self._block, buf, self.spec = create_shared_block(size)
+        self.spec['layout'] = layout
+
+        # Copy the arrays into the block
+        for key, [offset, shape, dtype] in layout.items():
+            arr = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+            arr[...] = common[key]
+
+        # Form the common dictionary to pass to other processes
+        self.common = {key: val for key, val in common.items()
+                       if key not in layout}
+        self.common['shared_refs'] = self.spec
+
+        atexit.register(self.close)
+
+        logging.debug(f'Placed {len(layout)} reference arrays ({size} bytes) '
+                      + 'in shared memory')
+
+#==============================================================================
+#==================================== Close ===================================
+#==============================================================================
+
+    def close(self):
+
+        '''Release the shared memory block'''
+
+        if self.spec is None:
+            return
+
+        _attached.pop(self.spec['name'], None)
+        release_shared_block(self._block, self.spec)
+        self._block = None
+        self.spec = None
+
+#==============================================================================
+#=============================== Attach Common ================================
+#==============================================================================
+
+def attach_common(common):
+
+    '''
+    Function to attach to the shared reference arrays of a common dictionary
+    created by SharedReferences. The arrays are returned as read-only views of
+    the shared block.
+
+    **Parameters:**
+
+    common : dict
+        Common dictionary. If it holds no shared references it is returned
+        unchanged
+
+    **Returns:**
+
+    common : dict
+        Copy of the common dictionary with the reference arrays attached
+    '''
+
+    if 'shared_refs' not in common:
+        return common
+
+    spec = common['shared_refs']
+
+    # Attach to the block, reusing it if already attached in this process
+    if spec['name'] not in _attached:
+
+        block, buf = attach_shared_block(spec, readonly=True)
+
+        arrays = {}
+        for key, [offset, shape, dtype] in spec['layout'].items():
+            arr = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+            arr.flags.writeable = False
+            arrays[key] = arr
+
+        _attached[spec['name']] = [block, arrays]
+
+    # Build the attached common
+    common = {key: val for key, val in common.items() if key != 'shared_refs'}
+    common.update(_attached[spec['name']][1])
+
+    return common
+
+#==============================================================================
+#============================ Create Shared Block =============================
+#==============================================================================
+
+def create_shared_block(size):
+
+    '''
+    Function to create a block of shared memory, using
+    multiprocessing.shared_memory where available and otherwise a
+    memory-mapped file in /dev/shm (or the temporary folder)
+
+    **Parameters:**
+
+    size : int
+        Size of the block in bytes
+
+    **Returns:**
+
+    block : SharedMemory or numpy.memmap
+        The block object, which must be kept to keep the memory mapped
+
+    buf : buffer
+        Buffer of the block for building numpy arrays
+
+    spec : dict
+        Picklable description of the block used to attach to it
+    '''
+
+    size = max(int(size), 1)
+
+    if shared_memory is not None:
+        block = shared_memory.SharedMemory(create=True, size=size)
+        spec = {'kind': 'shm', 'name': block.name, 'size': size}
+        buf = block.buf
+
+    else:
+        folder = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, fpath = tempfile.mkstemp(prefix='openso2_', dir=folder)
+        os.close(fd)
+        block = np.memmap(fpath, dtype=np.uint8, mode='w+', shape=(size,))
+        spec = {'kind': 'mmap', 'name': fpath, 'size': size}
+        buf = block
+
+    return block, buf, spec
+
+#==============================================================================
+#============================ Attach Shared Block =============================
+#==============================================================================
+
+def attach_shared_block(spec, readonly=False):
+
+    '''
+    Function to attach to a block created by create_shared_block
+
+    **Parameters:**
+
+    spec : dict
+        Description of the block returned by create_shared_block
+
+    readonly : bool, optional
+        Whether to map a memory-mapped file read-only. Default is False
+
+    **Returns:**
+
+    block : SharedMemory or numpy.memmap
+        The block object, which must be kept to keep the memory mapped
+
+    buf : buffer
+        Buffer of the block for building numpy arrays
+    '''
+
+    if spec['kind'] == 'shm':
+        block = shared_memory.SharedMemory(name=spec['name'])
+        buf = block.buf
+
+    else:
+        mode = 'r' if readonly else 'r+'
+        block = np.memmap(spec['name'], dtype=np.uint8, mode=mode,
+                          shape=(spec['size'],))
+        buf = block
+
+    return block, buf
+
+#==============================================================================
+#============================ Release Shared Block ============================
+#==============================================================================
+
+def release_shared_block(block, spec):
+
+    '''Function to release a block created by create_shared_block'''
+
+    if spec['kind'] == 'shm':
+        try:
+            block.close()
+        except BufferError:
+            # Arrays in this process still view the block. It is unmapped when
+            #  they are released
+            pass
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+
+    else:
+        try:
+            os.remove(spec['name'])
+        except FileNotFoundError:
+            pass
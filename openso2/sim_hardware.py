@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated scanner and spectrometer, so the acquisition and analysis can be run
+without the station hardware, e.g. to benchmark or soak test on a server.
+"""
+
+import time
+import logging
+import numpy as np
+
+from openso2 import fit
+from openso2.scanner import Scanner
+from openso2.analyse_scan import get_spec_details
+from openso2.program_setup import build_common
+
+#==============================================================================
+#================================ Station Grid ================================
+#==============================================================================
+
+def station_wavelengths(station, n_pixels=2048):
+
+    '''
+    Function to get the wavelength grid used to analyse scans from a station,
+    from the calibration in get_spec_details
+
+    **Parameters:**
+
+    station : str
+        The station name
+
+    n_pixels : int, optional
+        Number of spectrometer pixels. Default is 2048
+
+    **Returns:**
+
+    wavelength : array
+        The wavelength of each pixel (nm)
+    '''
+
+    scanner, spec_name, intercept, c1, c2, c3 = \
+        get_spec_details(f'x_x_{station}_')
+
+    pixel_no = np.arange(n_pixels) + 1
+
+    return intercept + c1 * pixel_no + c2 * pixel_no**2 + c3 * pixel_no**3
+
+#==============================================================================
+#================================== Sim Clock =================================
+#==============================================================================
+
+class SimClock:
+
+    '''
+    Clock shared by the simulated hardware. Each simulated delay (integration,
+    motor step) advances the clock and sleeps for the delay multiplied by the
+    time scale, so a time scale of 0.01 runs 100 times faster than real time
+    and 0 runs as fast as possible.
+
+    **Parameters:**
+
+    time_scale : float, optional
+        Ratio of real to simulated time. Default is 1
+    '''
+
+    def __init__(self, time_scale=1.0):
+
+        self.time_scale = time_scale
+        self.t = 0.0
+
+    def sleep(self, dt):
+
+        '''Advance the clock by dt seconds'''
+
+        self.t += dt
+        if self.time_scale > 0:
+            time.sleep(dt * self.time_scale)
+
+#==============================================================================
+#================================== Sky Model =================================
+#==============================================================================
+
+class SkyModel:
+
+    '''
+    Model of the sky seen by the scanner: a brightness that falls away from
+    the zenith and a Gaussian SO2 plume across the scan, whose amount varies
+    with time. Spectra are built with the iFit forward model.
+
+    The settings used are:
+        - sim_brightness (optional): zenith brightness at the peak of the
+          spectrum (counts/ms). Default is 300
+        - sim_zenith (optional): scan angle of the zenith (degrees). Default
+          is the middle of the scan
+        - sim_plume_angle (optional): scan angle of the plume centre
+          (degrees). Default is 20 degrees past the zenith
+        - sim_plume_width (optional): standard deviation of the plume
+          (degrees). Default is 8
+        - sim_plume_so2 (optional): peak SO2 slant column of the plume
+          (molecules/cm2). Default is 1e18
+        - sim_plume_period (optional): period of the variation in plume
+          amount (s). Default is 600
+        - sim_plume_amplitude (optional): fractional amplitude of the
+          variation in plume amount. Default is 0.5
+        - sim_shift (optional): wavelength shift of the spectra from the
+          first guess of the fit (nm). Default is 0
+        - sim_stretch (optional): wavelength stretch of the spectra from the
+          first guess of the fit (nm). Default is 0
+        - sim_shift_drift, sim_stretch_drift (optional): drift of the shift
+          and stretch with time (nm/hour). Default is 0
+
+    **Parameters:**
+
+    common : dict
+        Common dictionary holding the references, as made by build_common
+
+    settings : dict
+        Dictionary of station settings
+
+    wavelength : array
+        Wavelength grid of the spectrometer
+    '''
+
+    def __init__(self, common, settings, wavelength):
+
+        self.common = common
+        self.wavelength = wavelength
+
+        # Get the angles covered by a scan
+        spd = settings['steps_per_degree']
+        start = settings['steps_to_start'] / spd - settings['home_offset']
+        stop = start + settings['specs_per_scan'] * settings['steps_per_spec'] \
+            / spd
+
+        self.brightness = settings.get('sim_brightness', 300)
+        self.zenith = settings.get('sim_zenith', (start + stop) / 2)
+        self.plume_angle = settings.get('sim_plume_angle', self.zenith + 20)
+        self.plume_width = settings.get('sim_plume_width', 8)
+        self.plume_so2 = settings.get('sim_plume_so2', 1e18)
+        self.period = settings.get('sim_plume_period', 600)
+        self.amplitude = settings.get('sim_plume_amplitude', 0.5)
+
+        # Find the pixels covered by the forward model
+        grid = common['model_grid']
+        self.idx = np.where(np.logical_and(wavelength > grid[0] + 0.5,
+                                           wavelength < grid[-1] - 0.5))
+
+        # Set the model parameters, other than the gas amounts. The shift
+        #  and stretch are offset from the first guess of the fit, and drift
+        #  with time
+        p = common['params']
+        self.shift = p[4] + settings.get('sim_shift', 0)
+        self.stretch = p[5] + settings.get('sim_stretch', 0)
+        self.shift_drift = settings.get('sim_shift_drift', 0) / 3600
+        self.stretch_drift = settings.get('sim_stretch_drift', 0) / 3600
+        self.amounts = np.array(p[6:], dtype=float)
+        self.so2_i = common.get('absorbers', ['so2']).index('so2') + 1
+
+        # Find the peak of the clear sky spectrum, used to scale the spectra
+        fit.com = common
+        self._norm = np.nanmax(fit.ifit_fwd_model(wavelength[self.idx], 1, 0,
+                                                  0, 0, self.shift,
+                                                  self.stretch,
+                                                  *self._amounts(0)))
+
+#==============================================================================
+#================================ Plume Amount ================================
+#==============================================================================
+
+    def so2(self, angle, t=0.0):
+
+        '''
+        Function to get the SO2 slant column at a scan angle and time
+
+        **Parameters:**
+
+        angle : float or array
+            Scan angle (degrees)
+
+        t : float, optional
+            Simulated time (s)
+
+        **Returns:**
+
+        so2 : float or array
+            SO2 slant column (molecules/cm2)
+        '''
+
+        amount = self.plume_so2 * (1 + self.amplitude
+                                   * np.sin(2 * np.pi * t / self.period))
+
+        return amount * np.exp(-0.5 * ((angle - self.plume_angle)
+                                       / self.plume_width)**2)
+
+    def calibration(self, t=0.0):
+
+        '''
+        Function to get the wavelength shift and stretch of the spectra at a
+        time
+
+        **Parameters:**
+
+        t : float, optional
+            Simulated time (s)
+
+        **Returns:**
+
+        shift, stretch : float
+            The shift and stretch of the model grid (nm)
+        '''
+
+        return self.shift + self.shift_drift * t, \
+            self.stretch + self.stretch_drift * t
+
+    def _amounts(self, so2):
+
+        '''The ring and absorber amounts of the model, with the given SO2'''
+
+        amounts = self.amounts.copy()
+        amounts[self.so2_i] = so2
+
+        return amounts
+
+#==============================================================================
+#================================== Spectrum ==================================
+#==============================================================================
+
+    def spectrum(self, angle, int_time, t=0.0):
+
+        '''
+        Function to build the noise free sky spectrum at a scan angle
+
+        **Parameters:**
+
+        angle : float
+            Scan angle (degrees)
+
+        int_time : float
+            Integration time (ms)
+
+        t : float, optional
+            Simulated time (s)
+
+        **Returns:**
+
+        spectrum : array
+            The sky spectrum (counts), without any dark signal
+        '''
+
+        # The forward model uses the common set in the fit module
+        fit.com = self.common
+
+        x = self.wavelength[self.idx]
+        model = fit.ifit_fwd_model(x, 1, 0, 0, 0, *self.calibration(t),
+                                   *self._amounts(self.so2(angle, t)))
+
+        # Scale the spectrum so the clear sky peak gives the brightness,
+        #  falling away from the zenith
+        cos_z = np.cos(np.radians(angle - self.zenith))
+        scale = self.brightness * int_time * max(0.3 + 0.7 * cos_z, 0.05)
+        model = model * scale / self._norm
+
+        # Extend the edges of the model across the rest of the detector
+        ok = np.isfinite(model)
+
+        return np.interp(self.wavelength, x[ok], model[ok])
+
+#==============================================================================
+#================================ Sim Scanner =================================
+#==============================================================================
+
+class SimScanner(Scanner):
+
+    '''
+    Simulated scanner head, with a stepper motor that can be moved and a
+    microswitch that is on for a range of steps before the home position.
+
+    **Parameters:**
+
+    steps_per_rev : int
+        Number of steps in a full rotation of the scanner head
+
+    home_position : int, optional
+        Absolute step at which the microswitch turns off when stepping
+        backward, i.e. the home position. Default is 0
+
+    switch_width : int, optional
+        Number of steps over which the microswitch is on. Default is 100
+
+    start_position : int, optional
+        Absolute step at which the scanner head starts. Default is half a
+        rotation from home
+
+    clock : SimClock, optional
+        Clock used for the motor timing. If None the motor does not sleep
+    '''
+
+    def __init__(self, steps_per_rev, home_position=0, switch_width=100,
+                 start_position=None, clock=None):
+
+        self.steps_per_rev = int(steps_per_rev)
+        self.home_position = home_position
+        self.switch_width = switch_width
+        self.clock = clock
+
+        if start_position is None:
+            start_position = home_position + self.steps_per_rev // 2
+        self.abs_position = start_position % self.steps_per_rev
+
+        self.uswitch = _SimSwitch(self)
+        self.motor = _SimMotor()
+        self.position = 0
+        self.step_type = 'single'
+
+    def step(self, steps = 1, direction = 'backward'):
+
+        '''Move the motor by a given number of steps, see Scanner.step'''
+
+        sign = 1 if direction == 'backward' else -1
+        self.abs_position = (self.abs_position + sign * steps) \
+            % self.steps_per_rev
+        self.position += sign * steps
+
+        # Each step takes about 10 ms
+        if self.clock is not None:
+            self.clock.sleep(0.01 * steps)
+
+class _SimSwitch:
+
+    '''Microswitch of a SimScanner'''
+
+    def __init__(self, scanner):
+        self.scanner = scanner
+
+    @property
+    def value(self):
+        s = self.scanner
+        offset = (s.home_position - s.abs_position) % s.steps_per_rev
+        return 0 < offset <= s.switch_width
+
+class _SimMotor:
+
+    '''Stepper motor of a SimScanner'''
+
+    def release(self):
+        pass
+
+#==============================================================================
+#============================== Sim Spectrometer ==============================
+#==============================================================================
+
+class SimSpectrometer:
+
+    '''
+    Simulated spectrometer with the same interface as a python-seabreeze
+    Spectrometer, to be wrapped by openso2.spectrometer.Spectrometer. Spectra
+    are taken from a SkyModel at the angle the scanner points to. While the
+    scanner is before the scan start position it sees only the dark signal.
+
+    The settings used are:
+        - sim_dark_offset (optional): dark offset (counts). Default is 1000
+        - sim_dark_rate (optional): dark current (counts/ms). Default is 0.5
+        - sim_read_noise (optional): read noise (counts). Default is 10
+        - sim_hardware_averaging (optional): whether the device averages
+          scans itself. Default is False
+
+    **Parameters:**
+
+    sky : SkyModel
+        Model of the sky spectra
+
+    scanner : Scanner or SimScanner
+        The scanner, used to find where the spectrometer points
+
+    settings : dict
+        Dictionary of station settings
+
+    clock : SimClock, optional
+        Clock used for the integration timing. If None readouts do not sleep
+
+    serial_number : str, optional
+        Serial number reported. Default is the spectrometer of the station
+
+    seed : int, optional
+        Seed for the noise
+    '''
+
+    def __init__(self, sky, scanner, settings, clock=None, serial_number=None,
+                 seed=None):
+
+        self.sky = sky
+        self.scanner = scanner
+        self.settings = settings
+        self.clock = clock
+        self.rng = np.random.default_rng(seed)
+
+        if serial_number is None:
+            serial_number = get_spec_details(
+                f'x_x_{settings["station_name"]}_')[1]
+        self.serial_number = serial_number
+
+        self.dark_offset = settings.get('sim_dark_offset', 1000)
+        self.dark_rate = settings.get('sim_dark_rate', 0.5)
+        self.read_noise = settings.get('sim_read_noise', 10)
+
+        self.int_time = 100
+        self.scans_to_average = 1
+        self.f = _SimFeatures(self, settings.get('sim_hardware_averaging',
+                                                 False))
+
+        # Cache of the noise free spectrum for the current pointing
+        self._cache_key = None
+        self._cache = None
+
+        logging.info(f'Simulating spectrometer {serial_number}')
+
+    def wavelengths(self):
+        return self.sky.wavelength
+
+    def integration_time_micros(self, int_time_micros):
+        self.int_time = int_time_micros / 1000
+
+    def close(self):
+        pass
+
+    def intensities(self):
+
+        '''Take a readout, averaged over the scans to average'''
+
+        # Wait for the integration
+        if self.clock is not None:
+            self.clock.sleep(self.int_time * self.scans_to_average / 1000)
+            t = self.clock.t
+        else:
+            t = 0.0
+
+        # Find the noise free spectrum at the current pointing, updated every
+        #  simulated second
+        pos = self.scanner.position
+        key = (pos, self.int_time, int(t))
+        if key != self._cache_key:
+            signal = np.full(len(self.sky.wavelength),
+                             self.dark_offset + self.dark_rate * self.int_time)
+            if pos >= self.settings['steps_to_start']:
+                angle = pos / self.settings['steps_per_degree'] \
+                    - self.settings['home_offset']
+                signal += self.sky.spectrum(angle, self.int_time, t)
+            self._cache_key = key
+            self._cache = signal
+
+        # Add shot and read noise, reduced by the averaging
+        sigma = np.sqrt(self._cache + self.read_noise**2) \
+            / np.sqrt(self.scans_to_average)
+        spec = self._cache + self.rng.normal(0, 1, len(self._cache)) * sigma
+
+        return np.clip(spec, 0, 65535)
+
+class _SimFeatures:
+
+    '''Feature access of a SimSpectrometer, mirroring seabreeze'''
+
+    def __init__(self, spec, hardware_averaging):
+        if hardware_averaging:
+            self.spectrum_processing = _SimProcessing(spec)
+
+class _SimProcessing:
+
+    '''Scans to average feature of a SimSpectrometer'''
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def set_scans_to_average(self, n):
+        self.spec.scans_to_average = n
+
+#==============================================================================
+#============================= Make Sim Hardware ==============================
+#==============================================================================
+
+def make_sim_hardware(settings, ref_path='data_bases/Ref/'):
+
+    '''
+    Function to create a simulated scanner and spectrometer for a station.
+    The timing is set by the sim_time_scale setting (optional, default 1)
+
+    **Parameters:**
+
+    settings : dict
+        Dictionary of station settings
+
+    ref_path : str, optional
+        The folder holding the reference files
+
+    **Returns:**
+
+    scanner : SimScanner
+        The simulated scanner
+
+    device : SimSpectrometer
+        The simulated spectrometer, to be wrapped by
+        openso2.spectrometer.Spectrometer
+    '''
+
+    clock = SimClock(settings.get('sim_time_scale', 1.0))
+
+    scanner = SimScanner(round(settings['steps_per_degree'] * 360),
+                         clock=clock)
+
+    spec_name = get_spec_details(f'x_x_{settings["station_name"]}_')[1]
+    common = build_common(settings, spec_name, ref_path=ref_path)
+    sky = SkyModel(common, settings,
+                   station_wavelengths(settings['station_name']))
+
+    device = SimSpectrometer(sky, scanner, settings, clock=clock,
+                             serial_number=spec_name)
+
+    return scanner, device
@@ -6,7 +6,12 @@ Module to connect to the spectrometer
 
 import logging
 import numpy as np
-import seabreeze.spectrometers as sb
+try:
+    import seabreeze.spectrometers as sb
+except ImportError:
+    sb = None
+
+from openso2.coadd import CoaddAccumulator
 
 class Spectrometer:
 
@@ -14,6 +19,12 @@ class Spectrometer:
     Spectrometer class to control the spectrometer.  Designed to work with an
     Ocean Optics USB series spectrometer using the python-seabreeze library
 
+    The wavelength calibration is read once on connection. Coadds are
+    averaged on the computer, rejecting spikes and estimating the noise. If
+    hardware averaging is requested and the spectrometer supports it, they
+    are instead averaged on the device (scans-to-average) to save USB
+    transfers, without spike rejection or a noise estimate.
+
     **Parameters:**
 
     spec_name : str
@@ -25,10 +36,19 @@ class Spectrometer:
 
     initial_coadds : int
         The initial number of coadds. Default is 10.
+
+    hardware_averaging : bool
+        Whether to average the coadds on the device if supported. Default is
+        False
+
+    device : object
+        A connected seabreeze Spectrometer (or object with the same interface)
+        to use instead of connecting to one
     '''
 
     # Initialise
-    def __init__(self, spec_name=None, init_int_time=100, init_coadds=10):
+    def __init__(self, spec_name=None, init_int_time=100, init_coadds=10,
+                 hardware_averaging=False, device=None):
 
         '''
         Connects to the spectrometer and sets the integration time and coadds
@@ -36,14 +56,39 @@ class Spectrometer:
 
         # Connect to the spectormeter. If None then it connects to the first
         #  found
-        if spec_name != None:
+        if device is not None:
+            self.spec = device
+        elif spec_name != None:
             self.spec = sb.Spectrometer.from_serial_number(spec_name)
         else:
             self.spec = sb.Spectrometer.from_first_available()
 
-        logging.info(f'Connected to spectrometer {self.spec.serial_number}')
+        self.serial_number = str(self.spec.serial_number)
+        logging.info(f'Connected to spectrometer {self.serial_number}')
+
+        # Read the wavelength calibration once
+        self._wavelengths = np.array(self.spec.wavelengths())
+        self.n_pixels = len(self._wavelengths)
+
+        # Check for on device averaging
+        self._processing = None
+        self._scans_to_average = None
+        if hardware_averaging:
+            try:
+                self._processing = self.spec.f.spectrum_processing
+                self._set_scans_to_average(1)
+                logging.info('Using spectrometer scans to average')
+
+            # Not all models support it
+            except Exception:
+                self._processing = None
+
+        # Create the accumulator used to coadd on the computer
+        self.accumulator = CoaddAccumulator(self.n_pixels)
+        self.noise = np.nan
 
         # Set the spectrometer integration time and coadds
+        self.int_time = None
         self.update_int_time(init_int_time)
         self.update_coadds(init_coadds)
 
@@ -56,8 +101,16 @@ class Spectrometer:
         '''Update the spectrometer integration time'''
 
         # Update the integration time of the class and the actual spectrometer
-        self.int_time = int_time
-        self.spec.integration_time_micros(self.int_time * 1000)
+        if int_time != self.int_time:
+            self.int_time = int_time
+            int_time_micros = int(round(self.int_time * 1000))
+            self.spec.integration_time_micros(int_time_micros)
+
+    def integration_time_micros(self, int_time_micros):
+
+        '''Update the spectrometer integration time, given in microseconds'''
+
+        self.update_int_time(int_time_micros / 1000)
 
 #==============================================================================
 #================================ Update Coadds ===============================
@@ -67,10 +120,107 @@ class Spectrometer:
 
         '''Update the spectrometer coadds'''
 
-        # Update the class coadds. Note that the coadds are performed on the
-        #  computer not the spectrometer
+        # Update the class coadds. These are averaged on the device if
+        #  possible when measured
         self.coadds = coadds
 
+    def _set_scans_to_average(self, n):
+
+        '''Set the number of scans averaged on the device'''
+
+        if n != self._scans_to_average:
+            self._processing.set_scans_to_average(n)
+            self._scans_to_average = n
+
+#==============================================================================
+#================================ Wavelengths =================================
+#==============================================================================
+
+    def wavelengths(self):
+
+        '''Return the wavelength calibration, read on connection'''
+
+        return self._wavelengths
+
+#==============================================================================
+#================================ Intensities =================================
+#==============================================================================
+
+    def intensities(self):
+
+        '''Take a single readout'''
+
+        if self._processing is not None:
+            self._set_scans_to_average(1)
+
+        return self.spec.intensities()
+
+#==============================================================================
+#==================================== Coadd ===================================
+#==============================================================================
+
+    def coadd(self, coadds=None, out=None, saturation=None, accumulator=None):
+
+        '''
+        Measure a spectrum averaged over a number of coadds
+
+        **Parameters:**
+
+        coadds : int, optional
+            The number of coadds. Defaults to the coadds attribute
+
+        out : array, optional
+            Array to write the averaged spectrum into
+
+        saturation : float, optional
+            If given and the first readout reaches this intensity the
+            remaining coadds are skipped
+
+        accumulator : openso2 CoaddAccumulator, optional
+            Accumulator used to coadd on the computer. Defaults to the
+            accumulator attribute
+
+        **Returns:**
+
+        spectrum : array
+            The averaged spectrum
+
+        coadds : int
+            The number of coadds taken
+
+        noise : float
+            The noise estimate of the spectrum, nan if not known
+        '''
+
+        if coadds is None:
+            coadds = self.coadds
+        if out is None:
+            out = np.zeros(self.n_pixels)
+        if accumulator is None:
+            accumulator = self.accumulator
+
+        # Take the first readout on its own to check for saturation
+        first = self.intensities()
+        if coadds == 1 or (saturation is not None
+                           and first.max() >= saturation):
+            out[:] = first
+            return out, 1, np.nan
+
+        # Average the rest on the device in one readout
+        if self._processing is not None:
+            self._set_scans_to_average(coadds - 1)
+            rest = self.spec.intensities()
+            out[:] = (first + (coadds - 1) * rest) / coadds
+            return out, coadds, np.nan
+
+        # Otherwise average on the computer, rejecting spikes
+        accumulator.reset(out)
+        accumulator.add(first)
+        for i in range(1, coadds):
+            accumulator.add(self.spec.intensities())
+
+        return out, coadds, accumulator.noise()
+
 #==============================================================================
 #================================ Get Spectrum ================================
 #==============================================================================
@@ -97,30 +247,40 @@ class Spectrometer:
 
         spectrum, 2D numpy array
             The measured spectrum in the form [[wavelength], [intensities]],
-            averaged over the number of coadds
+            averaged over the number of coadds. The noise estimate of the
+            spectrum is stored in the noise attribute
 
         '''
 
-        # Create an empty array to hold the measurement
-        intensities = np.zeros([self.coadds, self.spec.pixels()])
-
-        for n in range(self.coadds):
-            intensities[n] = self.spec.intensities()
-
-        # Average across the readings
-        intensity = np.average(intensities, axis=0)
-
-        # Get the wavelength data
-        wavelength = self.spec.wavelengths()
+        intensity, coadds, self.noise = self.coadd()
 
         # Return the spectrum
-        return np.column_stack((wavelength, intensity))
+        return np.column_stack((self._wavelengths, intensity))
 
+#==============================================================================
+#================================ Temperature =================================
+#==============================================================================
 
+    def temperature(self):
 
+        '''
+        Read the detector temperature (degC), returning None if the
+        spectrometer cannot report it
+        '''
 
+        try:
+            return float(self.spec.f.temperature.temperature_get_all()[0])
 
+        # Not all models have a temperature sensor
+        except Exception:
+            return None
 
+#==============================================================================
+#==================================== Close ===================================
+#==============================================================================
 
+    def close(self):
 
+        '''Disconnect from the spectrometer'''
 
+        self.spec.close()
@@ -7,6 +7,7 @@ stations.
 import os
 import pysftp
 import glob
+import sqlite3
 import logging
 from datetime import datetime as dt
 from paramiko.ssh_exception import SSHException
@@ -40,7 +41,7 @@ class Station:
 #================================ Sync Folder =================================
 #==============================================================================
 
-    def sync(self, local_dir, remote_dir):
+    def sync(self, local_dir, remote_dir, catalog=None):
 
         '''
         Function to sync a local folder with a remote one.
@@ -53,6 +54,11 @@ class Station:
         remote_dir : str
             File path to the remote folder
 
+        catalog : ScanCatalog, optional
+            Catalog of the local files. If given the files to sync are found
+            from the catalog rather than listing the local folder, and synced
+            files are added to it
+
         **Returns:**
 
         new_fnames : list
@@ -69,25 +75,23 @@ class Station:
         try:
             with pysftp.Connection(**self.cinfo, cnopts=cnopts) as sftp:
 
-                # Get the file names in the local directory
-                local_files = glob.glob(local_dir + '*')
-                local_files = [fn.split('\\')[-1] for fn in local_files]
-
                 # Get the file names in the remote directory
                 remote_files = sftp.listdir(remote_dir)
 
-                # Iterate through and copy any that are missing in the host
-                #  directory
-                for fname in remote_files:
+                # Find the files that are missing in the host directory
+                missing_fnames = find_missing(local_dir, remote_files, catalog)
+
+                # Iterate through and copy them across
+                for fname in missing_fnames:
 
-                    # Check if in the local directory
-                    if fname not in local_files:
+                    # Copy the file across
+                    sftp.get(remote_dir + fname, local_dir + fname)
 
-                        # Copy the file across
-                        sftp.get(remote_dir + fname, local_dir + fname)
+                    # Add file list
+                    new_fnames.append(fname)
 
-                        # Add file list
-                        new_fnames.append(fname)
+                    # Record in the catalog
+                    catalog_synced(catalog, local_dir + fname, remote_dir)
 
             # Set error message as false
             err = [False, '']
@@ -213,7 +217,7 @@ class Station:
 #================================ Sync Station ================================
 #==============================================================================
 
-def sync_station(station, local_dir, remote_dir, queue):
+def sync_station(station, local_dir, remote_dir, queue, catalog=None):
 
     '''
     Function to sync the status and files of a station
@@ -232,6 +236,9 @@ def sync_station(station, local_dir, remote_dir, queue):
     queue : multiprocessing Queue
         The queue in which to put the outputs
 
+    catalog : ScanCatalog, optional
+        Catalog of the local files, used to find and record the synced files
+
     **Returns:**
 
     name : str
@@ -259,7 +266,7 @@ def sync_station(station, local_dir, remote_dir, queue):
 
     # If the connection was succesful then sync files
     if stat_err[0] == False:
-        synced_fnames, sync_err = station.sync(local_dir, remote_dir)
+        synced_fnames, sync_err = station.sync(local_dir, remote_dir, catalog)
         err = [False, '']
     else:
         synced_fnames = []
@@ -300,7 +307,7 @@ def get_station_status(gui, station):
 #================================ Sync Station ================================
 #==============================================================================
 
-def sync_psudostation(station, local_dir, remote_dir, queue):
+def sync_psudostation(station, local_dir, remote_dir, queue, catalog=None):
 
     from shutil import copy2
 
@@ -313,29 +320,106 @@ def sync_psudostation(station, local_dir, remote_dir, queue):
     status_msg = 'testing'
     err = [False, '']
 
-    local_files = glob.glob(local_dir + '*')
     remote_files = glob.glob(remote_dir + '*')
-
-    local_files.sort()
     remote_files.sort()
-
-    local_files = [fn.split('\\')[-1] for fn in local_files]
-    remote_files = [fn.split('\\')[-1] for fn in remote_files]
+    remote_files = [os.path.basename(fn) for fn in remote_files]
 
     synced_fnames = []
 
     # Iterate through and copy any that are missing in the host
     #  directory
-    for fname in remote_files:
+    for fname in find_missing(local_dir, remote_files, catalog):
 
-        # Check if in the local directory
-        if fname not in local_files:
+        # Copy the file across
+        copy2(remote_dir + fname, local_dir + fname)
 
-            # Copy the file across
-            copy2(remote_dir + fname, local_dir + fname)
+        # Add file list
+        synced_fnames.append(fname)
 
-            # Add file list
-            synced_fnames.append(fname)
+        # Record in the catalog
+        catalog_synced(catalog, local_dir + fname, remote_dir)
 
     # Place the results as a list in the queue
     queue.put([name, status_time, status_msg, synced_fnames, err])
+
+#==============================================================================
+#================================ Find Missing ================================
+#==============================================================================
+
+def find_missing(local_dir, remote_files, catalog=None):
+
+    '''
+    Function to find which remote files are missing from the local directory
+
+    **Parameters:**
+
+    local_dir : str
+        File path to the local directory
+
+    remote_files : list
+        File names in the remote directory
+
+    catalog : ScanCatalog, optional
+        Catalog of the local files. If given it is queried instead of listing
+        the local directory, and only the files it does not hold are checked
+        for on disk
+
+    **Returns:**
+
+    missing_fnames : list
+        The remote file names that are not held locally
+    '''
+
+    if catalog is not None:
+        try:
+            # Leave out files already held but not yet catalogued
+            missing = catalog.missing_fnames(remote_files, local_dir=local_dir)
+            return [fname for fname in missing
+                    if not os.path.isfile(local_dir + fname)]
+        except sqlite3.Error:
+            logging.warning('Failed to query scan catalog', exc_info=True)
+
+    # Get the file names in the local directory
+    local_files = set(os.path.basename(fn) for fn in glob.glob(local_dir + '*'))
+
+    return [fname for fname in remote_files if fname not in local_files]
+
+#==============================================================================
+#=============================== Catalog Synced ===============================
+#==============================================================================
+
+def catalog_synced(catalog, fpath, remote_dir):
+
+    '''
+    Function to record a synced file in the catalog, if one is given
+
+    **Parameters:**
+
+    catalog : ScanCatalog or None
+        Catalog of the local files
+
+    fpath : str
+        File path to the synced local file
+
+    remote_dir : str
+        File path to the remote directory the file was synced from, used to
+        identify the type of file
+
+    **Returns:**
+
+    None
+    '''
+
+    if catalog is None:
+        return
+
+    # Identify the file type from the folder
+    if 'spectra' in remote_dir:
+        kind = 'spectra'
+    else:
+        kind = 'so2'
+
+    try:
+        catalog.add_file(fpath, kind=kind, status='synced')
+    except sqlite3.Error:
+        logging.warning('Failed to catalog synced file', exc_info=True)
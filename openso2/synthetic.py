@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Module to generate synthetic scan datasets, in the same format as the station
+records, with the true SO2 columns and fluxes, for benchmarks and accuracy
+checks.
+"""
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+import datetime as dt
+
+from openso2.exposure import snap_int_time
+from openso2.analyse_scan import get_spec_details
+from openso2.program_setup import build_common
+from openso2.scan_buffer import save_scan
+from openso2.calc_scan_flux import calc_scan_flux, get_station_data
+from openso2.sim_hardware import SimClock, SimScanner, SkyModel, \
+                                 SimSpectrometer, station_wavelengths
+
+#==============================================================================
+#=============================== Synthetic Scan ===============================
+#==============================================================================
+
+def synth_scan(device, scanner, settings, int_time):
+
+    '''
+    Function to simulate a scan in the Open SO2 format, starting at the time
+    of the simulated clock
+
+    **Parameters:**
+
+    device : SimSpectrometer
+        The simulated spectrometer
+
+    scanner : SimScanner
+        The simulated scanner read by the spectrometer
+
+    settings : dict
+        Dictionary of station settings
+
+    int_time : float
+        Integration time of the scan (ms)
+
+    **Returns:**
+
+    scan_data : array
+        The scan, with the info columns followed by the spectrum for each row
+
+    so2 : array
+        The true SO2 slant column of each row (molecules/cm2), 0 for the dark
+    '''
+
+    clock = device.clock
+    sky = device.sky
+    coadds = settings['coadds']
+    n_specs = settings['specs_per_scan']
+
+    scan_data = np.zeros((n_specs, len(sky.wavelength) + 7))
+    so2 = np.zeros(n_specs)
+
+    # Average the coadds on the simulated device
+    device.integration_time_micros(int_time * 1000)
+    device.scans_to_average = coadds
+
+    # Take the dark at the home position
+    scanner.position = 0
+    h, m, s = _hms(clock.t)
+    scan_data[0, :7] = [0, h, m, s, 0, coadds, int_time]
+    scan_data[0, 7:] = device.intensities()
+
+    # Step through the scan
+    scanner.step(settings['steps_to_start'])
+    for step_no in range(1, n_specs):
+
+        h, m, s = _hms(clock.t)
+        scan_data[step_no, 7:] = device.intensities()
+        scan_data[step_no, :7] = [step_no, h, m, s, scanner.position, coadds,
+                                  int_time]
+
+        # Record the plume seen during the readout
+        angle = scanner.position / settings['steps_per_degree'] \
+            - settings['home_offset']
+        so2[step_no] = sky.so2(angle, clock.t)
+
+        scanner.step(settings['steps_per_spec'])
+
+    return scan_data, so2
+
+def _hms(t):
+
+    '''Split seconds since midnight into hours, minutes and seconds'''
+
+    t = int(t)
+    return t // 3600, (t // 60) % 60, t % 60
+
+#==============================================================================
+#============================== Generate Dataset ==============================
+#==============================================================================
+
+def generate_dataset(out_path, settings, start_date, n_days=1,
+                     scan_interval=300, start_hour=None, stop_hour=None,
+                     windspeed=10.0, plume_az=260.0, plume_height=915.0,
+                     volc_loc=(16.7103, -62.1773), stat_info=None, seed=0,
+                     catalog_path=None, ref_path='data_bases/Ref/'):
+
+    '''
+    Function to write days of synthetic scans for a station, in the folder
+    layout of the station results ("yyyy-mm-dd/spectra/"), along with the
+    true SO2 columns and fluxes in "yyyy-mm-dd/truth/".
+
+    The sky and plume are set by the sim_ settings used by SkyModel. The sky
+    brightness follows the sun through the day, and the integration time of
+    each scan is chosen to reach the target intensity. The wind speed varies
+    by +/-20% over each hour.
+
+    The true flux of each scan is found with calc_scan_flux from the true SO2
+    columns at the scan angles, so it is the flux a perfect retrieval would
+    give.
+
+    **Parameters:**
+
+    out_path : str
+        The results folder to write to
+
+    settings : dict
+        Dictionary of station settings. The station_name gives the station,
+        and hence spectrometer and wavelength calibration
+
+    start_date : datetime.date
+        The first day to generate
+
+    n_days : int, optional
+        Number of days to generate. Default is 1
+
+    scan_interval : float, optional
+        Time between the start of each scan (s). Default is 300
+
+    start_hour, stop_hour : float, optional
+        Hours of the day to scan between. Default to the start_time and
+        stop_time settings
+
+    windspeed : float, optional
+        Mean wind speed (m/s). Default is 10
+
+    plume_az : float, optional
+        Plume azimuth in degrees clockwise from North. Default is 260
+
+    plume_height : float, optional
+        Plume height (m). Default is 915
+
+    volc_loc : tuple, optional
+        Volcano location (lat, lon). Default is Soufriere Hills
+
+    stat_info : list, optional
+        Station [lat, lon, alt, az]. Defaults to get_station_data
+
+    seed : int, optional
+        Seed for the noise, so datasets can be reproduced. Default is 0
+
+    catalog_path : str, optional
+        Scan catalog in which to record the scans
+
+    ref_path : str, optional
+        The folder holding the reference files
+
+    **Returns:**
+
+    scan_paths : list
+        File paths of the scans written
+    '''
+
+    station = settings['station_name']
+    if start_hour is None:
+        start_hour = settings['start_time']
+    if stop_hour is None:
+        stop_hour = settings['stop_time']
+    if stat_info is None:
+        stat_info = get_station_data(station)
+
+    # Build the simulated hardware
+    spec_name = get_spec_details(f'x_x_{station}_')[1]
+    common = build_common(settings, spec_name, ref_path=ref_path)
+    sky = SkyModel(common, settings, station_wavelengths(station))
+    clock = SimClock(0)
+    scanner = SimScanner(round(settings['steps_per_degree'] * 360),
+                         clock=clock)
+    device = SimSpectrometer(sky, scanner, settings, clock=clock,
+                             serial_number=spec_name, seed=seed)
+
+    # Information used to save the scans
+    save_common = {'catalog_path': catalog_path, 'spec_name': spec_name}
+
+    clear_brightness = sky.brightness
+    scan_paths = []
+
+    for day in range(n_days):
+
+        date = start_date + dt.timedelta(days=day)
+        day_path = f'{out_path}{date}/'
+        for folder in ['spectra', 'so2', 'truth']:
+            os.makedirs(f'{day_path}{folder}/', exist_ok=True)
+
+        so2_truth = []
+        flux_truth = []
+
+        scan_no = 0
+        t = start_hour * 3600
+        while t < stop_hour * 3600:
+
+            # Set the sky brightness from the time of day and choose the
+            #  integration time
+            elevation = np.sin(np.pi * (t / 3600 - 6) / 12)
+            sky.brightness = clear_brightness * max(0.3 + 0.7 * elevation,
+                                                    0.05)
+            int_time = snap_int_time(settings['target_int'] / sky.brightness,
+                                     settings)
+
+            # Simulate the scan
+            clock.t = t
+            scan_data, so2 = synth_scan(device, scanner, settings, int_time)
+
+            # Save in the station format
+            h, m, s = _hms(t)
+            fname = f'{date.strftime("%Y%m%d")}_{h:02d}{m:02d}{s:02d}_' \
+                    + f'{station}_v_1_1_Block{scan_no}.npy'
+            fpath = f'{day_path}spectra/{fname}'
+            save_scan(fpath, scan_data, save_common)
+            scan_paths.append(fpath)
+
+            # Find the true flux
+            angles = scan_data[1:, 4] / settings['steps_per_degree'] \
+                - settings['home_offset']
+            truth = pd.DataFrame({'fname': fname,
+                                  'spec_n': np.arange(1, len(so2)),
+                                  'angle': angles,
+                                  'so2': so2[1:],
+                                  'so2_e': 0.0,
+                                  'fit_quality': 1})
+            wind = windspeed * (1 + 0.2 * np.sin(2 * np.pi * t / 3600))
+            flux, flux_err = calc_scan_flux(truth, stat_info, volc_loc, wind,
+                                            plume_az, plume_height)
+
+            so2_truth.append(truth[['fname', 'spec_n', 'angle', 'so2']])
+            flux_truth.append([fname, f'{h:02d}:{m:02d}:{s:02d}', int_time,
+                               wind, plume_az, plume_height, flux])
+
+            scan_no += 1
+            t += scan_interval
+
+        # Save the ground truth for the day
+        pd.concat(so2_truth).to_csv(f'{day_path}truth/so2_truth.csv',
+                                    index=False)
+        pd.DataFrame(flux_truth,
+                     columns=['fname', 'time', 'int_time', 'windspeed',
+                              'plume_az', 'plume_height', 'flux']
+                     ).to_csv(f'{day_path}truth/flux_truth.csv', index=False)
+
+        logging.info(f'Generated {scan_no} scans for {date}')
+
+    return scan_paths
+
+#==============================================================================
+#================================= Read Truth =================================
+#==============================================================================
+
+def read_truth(day_path):
+
+    '''
+    Function to read the ground truth of a synthetic day
+
+    **Parameters:**
+
+    day_path : str
+        The day folder ("yyyy-mm-dd/") of a synthetic dataset
+
+    **Returns:**
+
+    so2_truth : pandas.DataFrame
+        The true SO2 column of each spectrum, indexed by file name and
+        spectrum number
+
+    flux_truth : pandas.DataFrame
+        The true flux of each scan, indexed by file name
+    '''
+
+    so2_truth = pd.read_csv(f'{day_path}truth/so2_truth.csv',
+                            index_col=['fname', 'spec_n'])
+    flux_truth = pd.read_csv(f'{day_path}truth/flux_truth.csv',
+                             index_col='fname')
+
+    return so2_truth, flux_truth
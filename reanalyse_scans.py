@@ -0,0 +1,88 @@
+#!/usr/bin/python3.7
+"""
+Script to reanalyse the stored scans of a station over a range of dates.
+
+Example:
+    python3 reanalyse_scans.py LOVE 2019-07-01 2019-07-31
+"""
+
+import argparse
+import datetime
+import logging
+
+from openso2.program_setup import read_settings
+from openso2.reanalyse import find_scans, reanalyse
+
+#==============================================================================
+#============================== Parse arguments ===============================
+#==============================================================================
+
+parser = argparse.ArgumentParser(description='Reanalyse Open SO2 scans')
+parser.add_argument('station', help='Station name')
+parser.add_argument('start_date', help='First day to analyse (yyyy-mm-dd)')
+parser.add_argument('stop_date', help='Last day to analyse (yyyy-mm-dd)')
+parser.add_argument('--settings', default='data_bases/station_settings.txt',
+                    help='Station settings file')
+parser.add_argument('--results', default='Results/',
+                    help='Results folder holding the scans')
+parser.add_argument('--save_path', default=None,
+                    help='Folder to save the results. Defaults to the so2 '
+                         + 'folder of each day')
+parser.add_argument('--spectrometer', default=None,
+                    help='Spectrometer serial number. Defaults to the '
+                         + 'spectrometer of the station')
+parser.add_argument('--workers', type=int, default=None,
+                    help='Number of worker processes. Defaults to the number '
+                         + 'of cores')
+parser.add_argument('--checkpoint', default=None,
+                    help='Checkpoint file used to resume an interrupted run')
+parser.add_argument('--dark_library', default='Station/dark_library.npz',
+                    help='Saved station dark library, used for spectra '
+                         + 'without a matching dark in the scan file')
+parser.add_argument('--clear_sky_library', default=None,
+                    help='File for the clear sky library of the run, used '
+                         + 'with the clear_sky reference mode. Defaults to '
+                         + 'a temporary file')
+parser.add_argument('--catalog', default=None,
+                    help='Scan catalog used to find the scans and record '
+                         + 'the analysis')
+
+#==============================================================================
+#=========================== Begin the main program ===========================
+#==============================================================================
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+
+    # Read in the station settings
+    settings = read_settings(args.settings)
+
+    # Find the scans to analyse
+    start_date = datetime.date.fromisoformat(args.start_date)
+    stop_date = datetime.date.fromisoformat(args.stop_date)
+    scan_paths = find_scans(args.results, args.station, start_date,
+                            stop_date, args.catalog)
+
+    # Default checkpoint is named after the run
+    if args.checkpoint is None:
+        args.checkpoint = f'{args.results}reanalysis_{args.station}_' \
+                          + f'{start_date}_{stop_date}.txt'
+
+    summary = reanalyse(scan_paths, settings,
+                        spec_name=args.spectrometer,
+                        save_path=args.save_path,
+                        n_workers=args.workers,
+                        checkpoint=args.checkpoint,
+                        catalog_path=args.catalog,
+                        dark_library_path=args.dark_library,
+                        clear_sky_path=args.clear_sky_library)
+
+    logging.info(f'Reanalysis complete: {summary["n_scans"]} scans analysed, '
+                 + f'{summary["n_failed"]} failed, '
+                 + f'{summary["n_skipped"]} skipped, '
+                 + f'{summary["scans_per_s"]:.2f} scans/s, '
+                 + f'{summary["spectra_per_s"]:.1f} spectra/s')
@@ -0,0 +1,81 @@
+#!/usr/bin/python3.7
+"""
+Script to benchmark the speed and accuracy of the analysis on a synthetic
+dataset. The results are added to a history file and compared with the last
+run of the same label to catch regressions.
+
+Example:
+    python3 run_benchmarks.py --scans 20 --label baseline
+"""
+
+import sys
+import json
+import argparse
+import logging
+
+from openso2.program_setup import read_settings, build_common
+from openso2.analyse_scan import get_spec_details
+from openso2.benchmark import prepare_dataset, run_benchmark, \
+                              append_history, load_history, find_regressions
+
+#==============================================================================
+#============================== Parse arguments ===============================
+#==============================================================================
+
+parser = argparse.ArgumentParser(description='Benchmark the Open SO2 '
+                                             + 'analysis')
+parser.add_argument('--scans', type=int, default=10,
+                    help='Number of scans to analyse')
+parser.add_argument('--label', default='default',
+                    help='Name of the configuration being benchmarked')
+parser.add_argument('--data', default='Synthetic/benchmark/',
+                    help='Folder of the synthetic dataset, generated if '
+                         + 'missing')
+parser.add_argument('--settings', default='data_bases/station_settings.txt',
+                    help='Station settings file')
+parser.add_argument('--history', default='Results/benchmarks.jsonl',
+                    help='History file to add the results to')
+parser.add_argument('--tolerance', type=float, default=0.1,
+                    help='Fractional change allowed before a metric is '
+                         + 'flagged as a regression')
+parser.add_argument('--fail_on_regression', action='store_true',
+                    help='Exit with an error if a regression is found')
+
+#==============================================================================
+#=========================== Begin the main program ===========================
+#==============================================================================
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+
+    # Read in the station settings and build the analysis common
+    settings = read_settings(args.settings)
+    spec_name = get_spec_details(f'x_x_{settings["station_name"]}_')[1]
+    common = build_common(settings, spec_name)
+
+    # Get the dataset
+    scan_paths, so2_truth, flux_truth = prepare_dataset(args.data, settings,
+                                                        args.scans)
+
+    # Run the benchmark
+    record, results, fluxes = run_benchmark(scan_paths, common, so2_truth,
+                                            flux_truth, label=args.label)
+    print(json.dumps(record, indent=2))
+
+    # Compare with the last run
+    history = load_history(args.history, args.label)
+    regressions = {}
+    if len(history) > 0:
+        regressions = find_regressions(record, history[-1], args.tolerance)
+        for key, change in regressions.items():
+            logging.warning(f'Regression in {key}: {change:+.1%} worse than '
+                            + f'{history[-1]["commit"]}')
+
+    append_history(args.history, record)
+
+    if args.fail_on_regression and len(regressions) > 0:
+        sys.exit(1)
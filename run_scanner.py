@@ -2,19 +2,22 @@
 
 import os
 import sys
-import numpy as np
 import time
-import seabreeze.spectrometers as sb
-from multiprocessing import Process
+from multiprocessing import Process, BoundedSemaphore, cpu_count
 import datetime
 import logging
 
 from openso2.scanner import Scanner, acquire_scan
-from openso2.analyse_scan import analyse_scan, update_int_time
+from openso2.spectrometer import Spectrometer
+from openso2.analyse_scan import analyse_scan
+from openso2.exposure import ExposureController, AngleExposureTable
 from openso2.call_gps import sync_gps_time
-from openso2.program_setup import read_settings
+from openso2.program_setup import read_settings, build_common
 from openso2.julian_time import hms_to_julian
-from openso2.make_ils import make_ils
+from openso2.scan_buffer import ScanBuffer, wait_for_saves
+from openso2.dark_library import DarkLibrary
+from openso2.clear_sky import ClearSkyLibrary
+from openso2.sim_hardware import make_sim_hardware
 
 #==============================================================================
 #=============================== Set up logging ===============================
@@ -79,12 +82,9 @@ if __name__ == '__main__':
     logger.info('Station awake')
 
 #==============================================================================
-#====================== Create common and settings dicts ======================
+#============================= Read in settings ===============================
 #==============================================================================
 
-    # Create an empty dictionary to hold the comon parameters
-    common = {'fpath': fpath}
-
     # Read in the station operation settings file
     settings = read_settings('data_bases/station_settings.txt')
 
@@ -92,86 +92,93 @@ if __name__ == '__main__':
 #=============================== Sync GPS Time ================================
 #==============================================================================
 
+    # Check if the hardware is simulated. If a number of scans to simulate is
+    #  given they are run straight away, ignoring the start and stop times
+    simulate = settings.get('simulate', False)
+    run_anytime = simulate and settings.get('sim_scans', 0) > 0
+
     # Sync time with the GPS
-    sync_gps_time()
+    if not simulate:
+        sync_gps_time()
 
 #==============================================================================
 #======================== Connect to the spectrometer =========================
 #==============================================================================
 
-    # Find connected spectrometers
-    devices = sb.list_devices()
-
-    # Connect to spectrometer
-    spec = sb.Spectrometer(devices[0])
-
-    # Set intial integration time
-    common['spec_int_time'] = settings['start_int_time']
-    spec.integration_time_micros(common['spec_int_time'] * 1000)
+    # Create the simulated hardware if used
+    if simulate:
+        sim_scanner, sim_device = make_sim_hardware(settings)
+        logging.info('Simulating the station hardware')
+    else:
+        sim_device = None
+
+    # Connect to the first spectrometer found. Coadds are only averaged on
+    #  the device if hardware_averaging is set, as this skips the spike
+    #  rejection and noise estimate
+    spec = Spectrometer(init_int_time=settings['start_int_time'],
+                        init_coadds=settings['coadds'],
+                        hardware_averaging=settings.get('hardware_averaging',
+                                                        False),
+                        device=sim_device)
 
     # Record serial number in settings
-    settings['Spectrometer'] = str(spec.serial_number)
+    settings['Spectrometer'] = spec.serial_number
     logging.info('Spectrometer ' + settings['Spectrometer'] + ' Connected')
 
 #==============================================================================
-#============================ Read in ref spectra =============================
+#======================= Create common and ref spectra ========================
 #==============================================================================
 
-    # Set the fit window
-    common['wave_start'] = 310
-    common['wave_stop']  = 320
-
-    # Read in reference spectra
-    grid, so2_xsec = np.loadtxt('data_bases/Ref/so2.txt',  unpack = True)
-    grid, o3_xsec  = np.loadtxt('data_bases/Ref/o3.txt',   unpack = True)
-    grid, no2_xsec = np.loadtxt('data_bases/Ref/no2.txt',  unpack = True)
-    grid, sol      = np.loadtxt('data_bases/Ref/sol.txt',  unpack = True)
-    grid, ring     = np.loadtxt('data_bases/Ref/ring.txt', unpack = True)
-
-    # Extract the fit window
-    fit_idx = np.where(np.logical_and(grid > common['wave_start'] - 2,
-                                      grid < common['wave_stop'] + 2))
-
-    # Set the model grid
-    common['model_grid'] = grid[fit_idx]
-    common['so2_xsec']   = so2_xsec[fit_idx]
-    common['o3_xsec']    = o3_xsec[fit_idx]
-    common['no2_xsec']   = no2_xsec[fit_idx]
-    common['sol']        = sol[fit_idx]
-    common['ring']       = ring[fit_idx]
-
-    # Get spectrometer flat spectrum
-    x, flat = np.loadtxt(f'data_bases/Ref/flat_{settings["Spectrometer"]}.txt',
-                         unpack = True)
-    idx = np.where(np.logical_and(x > common['wave_start'], 
-                                  x < common['wave_stop']))
-    common['flat'] = flat[idx]
-
-    # Get spectrometer ILS
-    #ils_fpath = f'data_bases/Ref/ils_{settings["Spectrometer"]}.txt'
-    #common['ils'] = np.loadtxt(ils_fpath)
-    
-    ils_fpath = f'data_bases/Ref/ils_params_{settings["Spectrometer"]}.txt'
-    FWHM, k, a_w, a_k = np.loadtxt(ils_fpath)
-    common['ils'] = make_ils(0.01, FWHM, k, a_w, a_k)
-
-    # Set first guess for parameters
-    common['params'] = [1.0, 1.0, 1.0, 1.0, -0.2, 0.05, 1.0, 1.0e16, 1.0e17, 
-                        1.0e19]
-
-    # Set the station name
-    common['station_name'] = settings['station_name']
-
-    # Set the station motor details and add to the common
-    common['steps_per_degree'] = settings['steps_per_degree']
-    common['home_offset'] = settings['home_offset']
-
-    # Create loop counter
-    common['scan_no'] = 0
+    # Create the common dictionary, reading in the reference spectra
+    common = build_common(settings, settings['Spectrometer'], fpath)
+
+    # Set intial integration time
+    common['spec_int_time'] = settings['start_int_time']
+
+    # Set the scan catalog location
+    common['catalog_path'] = 'Results/catalog.db'
+
+    # Create the buffer used to hand scans to the analysis in memory. This
+    #  holds the scan being acquired plus those being analysed or saved, with
+    #  room for a dark for each integration time if these vary with angle
+    scan_rows = settings['specs_per_scan']
+    if settings.get('per_angle_exposure', False):
+        scan_rows += settings['specs_per_scan'] - 1
+    scan_buffer = ScanBuffer(5, (scan_rows, 2055))
+
+    # Create the exposure controller, and the table of integration times for
+    #  each angle if used
+    exposure = ExposureController(settings)
+    if settings.get('per_angle_exposure', False):
+        angle_exposure = AngleExposureTable(settings)
+    else:
+        angle_exposure = None
+
+    # Create the library of dark spectra, reloading any saved darks
+    if settings.get('dark_refresh', 0) > 0:
+        dark_library = DarkLibrary(settings)
+        dark_library.load('Station/dark_library.npz')
+    else:
+        dark_library = None
+
+    # Create the library of clear sky spectra, kept in a file as each scan
+    #  is analysed in its own process
+    if settings.get('reference_mode', 'solar') == 'clear_sky':
+        clear_sky_library = ClearSkyLibrary(settings,
+                                            'Station/clear_sky_library.npz')
+    else:
+        clear_sky_library = None
 
     # Create list to hold active processes
     processes = []
 
+    # Create the slots shared by the analysis processes for their pools, so
+    #  the analyses running at once do not fit with more processes than
+    #  analysis_workers, or the number of cores, between them
+    n_slots = min(common['analysis_workers'], cpu_count())
+    if n_slots > 1:
+        common['worker_slots'] = BoundedSemaphore(n_slots)
+
 #==============================================================================
 #========================== Begin the scanning loop ===========================
 #==============================================================================
@@ -181,7 +188,7 @@ if __name__ == '__main__':
     jul_t = hms_to_julian(timestamp)
 
     # If before scan time, wait
-    if jul_t < settings['start_time']:
+    if jul_t < settings['start_time'] and not run_anytime:
         logger.info('Station idle')
 
         # Check time every 10s
@@ -195,24 +202,51 @@ if __name__ == '__main__':
             jul_t = hms_to_julian(timestamp)
 
     # Connect to the scanner
-    scanner = Scanner(step_type = settings['step_type'])
+    if simulate:
+        scanner = sim_scanner
+    else:
+        scanner = Scanner(step_type = settings['step_type'])
+
+    # Time the scans with the simulated clock when simulating, as the
+    #  simulation may run faster than real time
+    if simulate:
+        scan_clock = lambda: sim_scanner.clock.t
+    else:
+        scan_clock = time.time
 
     # Begin loop
-    while jul_t < settings['stop_time']:
+    while jul_t < settings['stop_time'] or run_anytime:
+
+        # Stop once the simulated scans are complete
+        if run_anytime and common['scan_no'] >= settings['sim_scans']:
+            break
 
         # Log status change and scan number
         log_status('Active')
         logging.info('Begin scan ' + str(common['scan_no']))
 
+        # Get the integration time of each angle
+        if angle_exposure is not None:
+            int_times = angle_exposure.int_times(common['spec_int_time'])
+        else:
+            int_times = None
+
         # Scan!
-        common['scan_fpath'] = acquire_scan(scanner, spec, common, settings)
+        scan_start = scan_clock()
+        common['scan_fpath'] = acquire_scan(scanner, spec, common, settings,
+                                            scan_buffer, int_times,
+                                            dark_library)
 
         # Log scan completion
         logging.info('Scan ' + str(common['scan_no']) + ' complete')
 
-        # Update the spectrometer integration time
-        common['spec_int_time'] = update_int_time(common, settings)
-        spec.integration_time_micros(common['spec_int_time'] * 1000)
+        # Update the spectrometer integration time from the scan intensity
+        common['spec_int_time'] = exposure.update(common['scan_max_int'],
+                                                  common['spec_int_time'])
+        spec.update_int_time(common['spec_int_time'])
+        if angle_exposure is not None:
+            angle_exposure.update(common['scan_peaks'],
+                                  common['scan_int_times'])
 
         # Clear any finished processes from the processes list
         processes = [pro for pro in processes if pro.is_alive()]
@@ -221,10 +255,21 @@ if __name__ == '__main__':
         #  start another to prevent too many processes running at once
         if len(processes) <= 2:
 
-            # Create new process to handle fitting of the last scan
-            p = Process(target = analyse_scan, 
-                        args = [True, common['scan_fpath']],
-                        kwargs = common)
+            # Set the analysis deadline from the time taken by the scan, so
+            #  the analysis keeps pace with the acquisition. Off unless the
+            #  analysis_deadline setting is above 0
+            deadline_factor = settings.get('analysis_deadline', 0)
+            if deadline_factor > 0:
+                common['analysis_deadline'] = time.time() + deadline_factor \
+                                              * (scan_clock() - scan_start)
+
+            # Create new process to handle fitting of the last scan, passing
+            #  the scan in memory through the buffer
+            p = Process(target = analyse_scan,
+                        args = [common['scan_fpath'], True],
+                        kwargs = {**common, 'scan_buffer': scan_buffer,
+                                  'dark_library': dark_library,
+                                  'clear_sky_library': clear_sky_library})
 
             # Add to array of active processes
             processes.append(p)
@@ -238,6 +283,10 @@ if __name__ == '__main__':
                   f"scan {common['scan_no']} not analysed"
             logging.warning(msg)
 
+            # Release the scan from the buffer
+            if common['scan_slot'] is not None:
+                scan_buffer.release(common['scan_slot'])
+
         # Update the scan number
         common['scan_no'] += 1
 
@@ -252,6 +301,17 @@ if __name__ == '__main__':
     for p in processes:
         p.join()
 
+    # Save the dark library for the next run
+    if dark_library is not None:
+        dark_library.save('Station/dark_library.npz')
+
+    # Disconnect from the spectrometer
+    spec.close()
+
+    # Wait for the last scans to be saved
+    wait_for_saves()
+    scan_buffer.close()
+
     # Change the station status
     log_status('Asleep')
     logging.info('Station going to sleep')
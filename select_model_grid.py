@@ -0,0 +1,68 @@
+#!/usr/bin/python3.7
+"""
+Script to choose the coarsest forward model grid and smallest padding that
+keep the SO2 columns within a tolerance of the reference grid for the station
+spectrometer, and save them to the station settings.
+
+Example:
+    python3 select_model_grid.py --tolerance 0.01 --save
+"""
+
+import argparse
+import logging
+
+from openso2.program_setup import read_settings, update_settings
+from openso2.analyse_scan import get_spec_details
+from openso2.sim_hardware import station_wavelengths
+from openso2.model_grid import select_model_grid
+
+#==============================================================================
+#============================== Parse arguments ===============================
+#==============================================================================
+
+parser = argparse.ArgumentParser(description='Choose the Open SO2 model grid '
+                                             + 'resolution and padding')
+parser.add_argument('--settings', default='data_bases/station_settings.txt',
+                    help='Station settings file')
+parser.add_argument('--tolerance', type=float, default=None,
+                    help='Largest fractional SO2 difference from the '
+                         + 'reference grid. Defaults to the model_grid_tol '
+                         + 'setting, or 0.01')
+parser.add_argument('--save', action='store_true',
+                    help='Write the chosen model_res and model_pad to the '
+                         + 'settings file')
+parser.add_argument('--out', default=None,
+                    help='CSV file to save the grids tried to')
+
+#==============================================================================
+#=========================== Begin the main program ===========================
+#==============================================================================
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+
+    # Read in the station settings and find the spectrometer
+    settings = read_settings(args.settings)
+    station = settings['station_name']
+    spec_name = get_spec_details(f'x_x_{station}_')[1]
+
+    # Test the model grids
+    model_res, model_pad, results = \
+        select_model_grid(settings, spec_name, station_wavelengths(station),
+                          tolerance=args.tolerance)
+    print(results.to_string(index=False))
+    print(f'Chosen model grid: model_res {model_res} nm, model_pad '
+          + f'{model_pad} nm')
+
+    if args.out is not None:
+        results.to_csv(args.out, index=False)
+
+    # Save to the settings, so the station uses the chosen grid
+    if args.save:
+        update_settings(args.settings, {'model_res': float(model_res),
+                                        'model_pad': float(model_pad)})
+        logging.info(f'Model grid saved to {args.settings}')
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+Test configuration, making the openso2 package importable from the tests.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
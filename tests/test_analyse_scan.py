@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the scan analysis, run on a short simulated scan.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from openso2.program_setup import read_settings, build_common
+from openso2.analyse_scan import analyse_scan, summarise_fits, \
+                                 get_spec_details
+from openso2.scan_buffer import save_scan
+from openso2.synthetic import synth_scan
+from openso2.sim_hardware import SimClock, SimScanner, SkyModel, \
+                                 SimSpectrometer, station_wavelengths
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REF_PATH = f'{ROOT}/data_bases/Ref/'
+
+#==============================================================================
+#================================== Fixtures ==================================
+#==============================================================================
+
+@pytest.fixture(scope='module')
+def sim_scan(tmp_path_factory):
+
+    '''Simulate a short scan, returning its path, true SO2 and settings'''
+
+    settings = read_settings(f'{ROOT}/data_bases/station_settings.txt')
+    settings['specs_per_scan'] = 13
+    settings['steps_per_spec'] = 200
+
+    station = settings['station_name']
+    spec_name = get_spec_details(f'x_x_{station}_')[1]
+    common = build_common(settings, spec_name, ref_path=REF_PATH)
+    sky = SkyModel(common, settings, station_wavelengths(station))
+    clock = SimClock(0)
+    clock.t = 12 * 3600
+    scanner = SimScanner(round(settings['steps_per_degree'] * 360),
+                         clock=clock)
+    device = SimSpectrometer(sky, scanner, settings, clock=clock,
+                             serial_number=spec_name, seed=0)
+
+    scan_data, so2 = synth_scan(device, scanner, settings, 100)
+
+    fpath = f'{tmp_path_factory.mktemp("spectra")}/' \
+            + f'20190701_120000_{station}_v_1_1_Block0.npy'
+    save_scan(fpath, scan_data, {'catalog_path': None})
+
+    return fpath, so2, settings, spec_name
+
+def _analyse(sim_scan, **extra):
+
+    '''Analyse the simulated scan with the extra settings'''
+
+    fpath, so2, settings, spec_name = sim_scan
+    common = build_common({**settings, **extra}, spec_name,
+                          ref_path=REF_PATH)
+    common['scan_no'] = 0
+
+    return analyse_scan(fpath, save_results=False, **common)
+
+#==============================================================================
+#=================================== Tests ====================================
+#==============================================================================
+
+def test_synthetic_scan(sim_scan):
+
+    '''The fitted SO2 should follow the true SO2 of the simulated scan'''
+
+    so2 = sim_scan[1]
+    df = _analyse(sim_scan)
+
+    assert (df['fit_quality'] == 1).all()
+    assert np.allclose(df['so2'].to_numpy(dtype=float), so2[1:], rtol=0.1,
+                       atol=3e16)
+
+def test_summarise_fits():
+
+    df = pd.DataFrame({'fit_time': [0.1, 0.5, 0.2, 0.0],
+                       'nfev': [10, 40, 20, 0],
+                       'warm_start': [False, True, True, False],
+                       'fit_status': ['converged', 'max_evals', 'clear_sky',
+                                      'low_intensity'],
+                       'budget_limited': [False, True, False, False]})
+
+    summary = summarise_fits(df)
+
+    assert summary['n_fits'] == 4
+    assert np.isclose(summary['fit_time_total'], 0.8)
+    assert np.isclose(summary['fit_time_max'], 0.5)
+    assert summary['slowest_spectrum'] == 1
+    assert summary['nfev_mean'] == 17.5
+    assert summary['nfev_max'] == 40
+    assert summary['n_warm_start'] == 2
+    assert summary['n_failed'] == 1
+    assert summary['n_budget_limited'] == 1
+    assert summary['n_converged'] == 1
+    assert summary['n_max_evals'] == 1
+    assert summary['n_clear_sky'] == 1
+    assert summary['n_quick'] == 0
+
+def test_pooled_segments(sim_scan):
+
+    '''Fitting the segments in a pool should match fitting them in turn'''
+
+    serial = _analyse(sim_scan, analysis_workers=1, fit_segments=4)
+    pooled = _analyse(sim_scan, analysis_workers=2, fit_segments=4)
+
+    for col in ['so2', 'so2_e', 'fit_quality']:
+        assert np.allclose(pooled[col].to_numpy(dtype=float),
+                           serial[col].to_numpy(dtype=float),
+                           rtol=1e-9, atol=0, equal_nan=True)
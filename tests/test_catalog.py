@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the scan catalog.
+"""
+
+import os
+import threading
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from openso2.catalog import ScanCatalog
+
+def _fname(n):
+    return f'20190701_12{n // 60:02d}{n % 60:02d}_LOVE_v_1_1_Block{n}.npy'
+
+def _set_status(db_path, fpath, result):
+    try:
+        ScanCatalog(db_path).set_status(fpath, 'analysed')
+        result.value = 1
+    except Exception:
+        result.value = -1
+
+#==============================================================================
+#=============================== Missing Fnames ===============================
+#==============================================================================
+
+def test_missing_fnames(tmp_path):
+
+    catalog = ScanCatalog(str(tmp_path / 'catalog.db'))
+    spectra = os.path.join(str(tmp_path), 'spectra')
+    so2 = os.path.join(str(tmp_path), 'so2')
+    for n in range(3):
+        catalog.add_file(os.path.join(spectra, _fname(n)))
+    catalog.add_file(os.path.join(so2, _fname(0)), kind='so2')
+
+    fnames = [_fname(n) for n in range(5)]
+
+    # Only names catalogued in the given folder are found, in order
+    assert catalog.missing_fnames(fnames, local_dir=spectra) == fnames[3:]
+    assert catalog.missing_fnames(fnames, local_dir=spectra + '/') \
+        == fnames[3:]
+    assert catalog.missing_fnames(fnames, local_dir=so2) == fnames[1:]
+    assert catalog.missing_fnames(fnames, kind='so2') == fnames[1:]
+    assert catalog.missing_fnames(fnames) == fnames[3:]
+
+def test_missing_fnames_many(tmp_path):
+
+    # More names than SQLite allows parameters in one query
+    catalog = ScanCatalog(str(tmp_path / 'catalog.db'))
+    catalog.add_file(os.path.join(str(tmp_path), _fname(1500)))
+    fnames = [_fname(n) for n in range(2000)]
+
+    missing = catalog.missing_fnames(fnames, local_dir=str(tmp_path))
+
+    assert len(missing) == 1999
+    assert _fname(1500) not in missing
+
+#==============================================================================
+#============================== Fork During Write =============================
+#==============================================================================
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='Needs fork')
+def test_fork_during_write(tmp_path):
+
+    # Fork processes that update the catalog while a writer thread, like the
+    #  scan saving thread, is part way through adding files
+    db_path = str(tmp_path / 'catalog.db')
+    catalog = ScanCatalog(db_path)
+    fpath = os.path.join(str(tmp_path), _fname(0))
+    catalog.add_file(fpath)
+
+    stop = threading.Event()
+    def write():
+        n = 1
+        while not stop.is_set():
+            catalog.add_file(os.path.join(str(tmp_path), _fname(n)),
+                             info=np.zeros([2, 7]), checksum='')
+            n += 1
+    writer = threading.Thread(target=write)
+    writer.start()
+
+    ctx = multiprocessing.get_context('fork')
+    failed = 0
+    try:
+        for i in range(20):
+            result = ctx.Value('i', 0)
+            p = ctx.Process(target=_set_status, args=[db_path, fpath, result])
+            p.start()
+            p.join(10)
+            if p.is_alive():
+                p.kill()
+                p.join()
+            if result.value != 1:
+                failed += 1
+    finally:
+        stop.set()
+        writer.join()
+
+    assert failed == 0
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the streaming coadder.
+"""
+
+import numpy as np
+
+from openso2.coadd import CoaddAccumulator
+
+#==============================================================================
+#=================================== Tests ====================================
+#==============================================================================
+
+def test_mean_and_noise():
+
+    rng = np.random.default_rng(0)
+    reads = 1000 + rng.normal(0, 10, [50, 200])
+
+    coadder = CoaddAccumulator(200)
+    for readout in reads:
+        assert coadder.add(readout)
+
+    assert coadder.n_reads == 50
+    assert np.allclose(coadder.mean, reads.mean(axis=0))
+    assert np.allclose(coadder.std(), reads.std(axis=0, ddof=1))
+    assert abs(coadder.noise() - 10 / np.sqrt(50)) < 0.2
+
+def test_spike_rejected():
+
+    rng = np.random.default_rng(1)
+    reads = 1000 + rng.normal(0, 10, [20, 200])
+    reads[10, 50] = 60000
+
+    coadder = CoaddAccumulator(200)
+    for readout in reads:
+        coadder.add(readout)
+
+    # The spike is left out of the average of that pixel only
+    assert coadder.n_rejected == 1
+    assert coadder.count[50] == 19
+    assert abs(coadder.mean[50] - np.delete(reads[:, 50], 10).mean()) < 1e-9
+
+def test_glitch_dropped():
+
+    rng = np.random.default_rng(2)
+    reads = 1000 + rng.normal(0, 10, [20, 200])
+    reads[5] = 0
+
+    coadder = CoaddAccumulator(200)
+    accepted = [coadder.add(readout) for readout in reads]
+
+    assert not accepted[5]
+    assert coadder.n_dropped == 1
+    assert coadder.n_reads == 19
+    assert np.allclose(coadder.mean, np.delete(reads, 5, axis=0).mean(axis=0))
+
+def test_reset_into_row():
+
+    scan = np.zeros([2, 100])
+    coadder = CoaddAccumulator(100)
+    coadder.reset(out=scan[1])
+    for _ in range(3):
+        coadder.add(np.full(100, 500.0))
+
+    assert np.all(scan[1] == 500)
+    assert np.all(scan[0] == 0)
+    assert np.isnan(CoaddAccumulator(100).noise())
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the dark spectrum library.
+"""
+
+import numpy as np
+
+from openso2.dark_library import DarkLibrary
+
+def _dark(int_time):
+    return 500 + 0.1 * int_time * np.arange(10)
+
+#==============================================================================
+#=================================== Tests ====================================
+#==============================================================================
+
+def test_exact_match():
+
+    library = DarkLibrary({'coadds': 10})
+    library.add(_dark(100), 100, 10, timestamp=1000)
+
+    assert np.array_equal(library.get(100, now=1000), _dark(100))
+    assert np.array_equal(library.get(100, coadds=10, now=1000), _dark(100))
+
+def test_interpolated():
+
+    library = DarkLibrary({'coadds': 10})
+    library.add(_dark(100), 100, 10, timestamp=1000)
+    library.add(_dark(300), 300, 10, timestamp=1000)
+    library.add(_dark(1000), 1000, 10, timestamp=1000)
+
+    # The dark is linear in the integration time, so is interpolated exactly
+    assert np.allclose(library.get(150, now=1000), _dark(150))
+    assert np.allclose(library.get(700, now=1000), _dark(700))
+
+    # Integration times outside the entries are not extrapolated
+    assert library.get(50, now=1000) is None
+    assert library.get(2000, now=1000) is None
+
+def test_stale_entries_skipped():
+
+    library = DarkLibrary({'dark_refresh': 600, 'dark_max_temp_diff': 2})
+    library.add(_dark(100), 100, 10, temperature=20, timestamp=1000)
+    library.add(_dark(200), 200, 10, temperature=20, timestamp=1000)
+    library.add(_dark(400), 400, 10, temperature=20, timestamp=1500)
+
+    # Only fresh darks are interpolated between
+    assert np.allclose(library.get(300, now=1500), _dark(300))
+    assert library.get(300, now=1700) is None
+    assert np.array_equal(library.get(400, now=1700), _dark(400))
+
+    # Nor are darks used once the detector temperature has moved
+    assert library.get(300, temperature=25, now=1500) is None
+
+def test_most_coadds_preferred():
+
+    library = DarkLibrary({'coadds': 10})
+    library.add(_dark(100), 100, 10, timestamp=1000)
+    library.add(_dark(100) + 1, 100, 50, timestamp=1000)
+    library.add(_dark(300), 300, 10, timestamp=1000)
+
+    assert np.array_equal(library.get(100, coadds=10, now=1000), _dark(100))
+    assert np.array_equal(library.get(100, now=1000), _dark(100) + 1)
+    assert np.allclose(library.get(200, now=1000), _dark(200) + 0.5)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the integration time rounding.
+"""
+
+from openso2.exposure import snap_int_time
+
+SETTINGS = {'min_int_time': 50, 'max_int_time': 5000, 'int_time_step': 50}
+
+#==============================================================================
+#=================================== Tests ====================================
+#==============================================================================
+
+def test_snap_int_time():
+
+    assert snap_int_time(200, SETTINGS) == 200
+    assert snap_int_time(224, SETTINGS) == 200
+    assert snap_int_time(226, SETTINGS) == 250
+    assert isinstance(snap_int_time(226.0, SETTINGS), int)
+
+def test_snap_int_time_limits():
+
+    assert snap_int_time(0, SETTINGS) == 50
+    assert snap_int_time(-100, SETTINGS) == 50
+    assert snap_int_time(1e6, SETTINGS) == 5000
+
+def test_snap_int_time_offset_steps():
+
+    # Steps are counted from the minimum integration time
+    settings = {'min_int_time': 30, 'max_int_time': 200, 'int_time_step': 40}
+
+    assert snap_int_time(75, settings) == 70
+    assert snap_int_time(95, settings) == 110
+    assert snap_int_time(500, settings) == 190